@@ -14,6 +14,9 @@ class BaseAdmin(admin.ModelAdmin):
             obj.created_by = request.user
         else:
             obj.modified_by = request.user
+        if hasattr(obj, 'import_fingerprint'):
+            # Make the next import compare the fields again
+            obj.import_fingerprint = None
         obj.save()
 
 
@@ -3,20 +3,30 @@ from __future__ import unicode_literals
 
 # python
 import base64
+import calendar
+import copy
+import functools
+import hashlib
+import json
 import re
 import struct
 import time
 import urllib.parse
+from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta
 from dateutil.parser import parse as dateutil_parse
 
 # django and drf
 from django.contrib.auth import get_user_model
 from django.utils import translation
-from django.core.exceptions import ValidationError
+from django.core.exceptions import FieldDoesNotExist, ValidationError
 from django.conf import settings
 from django.core.urlresolvers import NoReverseMatch
-from django.db.models import Q
+from django.utils.http import (
+    RFC3986_SUBDELIMS, http_date, parse_etags, parse_http_date_safe, quote_etag, urlquote
+)
+from django.db.models import Count, Max, Prefetch, Q
+from django.http import HttpResponseNotModified
 from django.shortcuts import get_object_or_404
 from django.utils.translation import ugettext_lazy as _
 from rest_framework import (
@@ -26,6 +36,7 @@ from rest_framework.settings import api_settings
 from rest_framework.reverse import reverse
 from rest_framework.response import Response
 from rest_framework.exceptions import ParseError
+from rest_framework.utils import encoders
 
 
 # 3rd party
@@ -39,6 +50,7 @@ import pytz
 
 # events
 from events import utils
+from events.api_cache import fragment_key, get_fragment_cache
 from events.custom_elasticsearch_search_backend import (
     CustomEsSearchQuerySet as SearchQuerySet
 )
@@ -87,6 +99,54 @@ def urlquote_id(link):
     return link
 
 
+@functools.lru_cache(maxsize=10000)
+def quote_id(pk):
+    """
+    Quote an id like reverse() followed by urlquote_id() does.
+    """
+    quoted = urlquote(str(pk), safe=RFC3986_SUBDELIMS + '/~:@')
+    if ':' in quoted:
+        quoted = urllib.parse.quote(quoted)
+    return quoted
+
+
+class IdURLBuilder(object):
+    """
+    Builds the `@id` URLs of a request. The URL of each detail view is
+    resolved once, and the quoted ids are formatted into it.
+    """
+    placeholder = 'idplaceholder'
+    # Ids which the router does not match are left to reverse()
+    unmatched_id = re.compile(r'[/.]')
+
+    def __init__(self, request):
+        self.request = request
+        self.templates = {}
+
+    def reverse(self, view_name, pk):
+        return urlquote_id(reverse(view_name, kwargs={'pk': pk}, request=self.request))
+
+    def url(self, view_name, pk):
+        template = self.templates.get(view_name)
+        if template is None:
+            template = self.reverse(view_name, self.placeholder).split(self.placeholder)
+            self.templates[view_name] = template
+        pk = str(pk)
+        if len(template) != 2 or self.unmatched_id.search(pk):
+            return self.reverse(view_name, pk)
+        return template[0] + quote_id(pk) + template[1]
+
+
+def get_url_builder(context):
+    """
+    Return the IdURLBuilder shared by the serializers of a request.
+    """
+    builder = context.get('url_builder')
+    if builder is None:
+        builder = context['url_builder'] = IdURLBuilder(context['request'])
+    return builder
+
+
 def generate_id(namespace):
     t = time.time() * 1000
     postfix = base64.b32encode(struct.pack(">Q", int(t)).lstrip(b'\x00'))
@@ -138,12 +198,31 @@ class JSONLDRelatedField(relations.HyperlinkedRelatedField):
         else:
             return True
 
+    def get_expanded_serializer(self):
+        # One serializer serves all the related objects of this field
+        serializer = getattr(self, '_expanded_serializer', None)
+        if serializer is None:
+            if isinstance(self.related_serializer, str):
+                self.related_serializer = globals().get(self.related_serializer, None)
+            serializer = self.related_serializer(hide_ld_context=self.hide_ld_context,
+                                                 context=self.context)
+            self._expanded_serializer = serializer
+        return serializer
+
     def to_representation(self, obj):
-        if isinstance(self.related_serializer, str):
-            self.related_serializer = globals().get(self.related_serializer, None)
         if self.is_expanded():
-            return self.related_serializer(obj, hide_ld_context=self.hide_ld_context,
-                                           context=self.context).data
+            serializer = self.get_expanded_serializer()
+            serializer.instance = obj
+            return serializer.to_representation(obj)
+        if 'request' in self.context and not self.context.get('format'):
+            try:
+                link = get_url_builder(self.context).url(self.view_name, obj.pk)
+            except NoReverseMatch:
+                link = None
+            if link is not None:
+                return {
+                    '@id': link
+                }
         link = super(JSONLDRelatedField, self).to_representation(obj)
         link = urlquote_id(link)
         return {
@@ -208,32 +287,37 @@ class ISO8601DurationField(serializers.Field):
 
 
 class MPTTModelSerializer(serializers.ModelSerializer):
-    def __init__(self, *args, **kwargs):
-        super(MPTTModelSerializer, self).__init__(*args, **kwargs)
+    def get_fields(self):
+        fields = super(MPTTModelSerializer, self).get_fields()
         for field_name in 'lft', 'rght', 'tree_id', 'level':
-            if field_name in self.fields:
-                del self.fields[field_name]
+            if field_name in fields:
+                del fields[field_name]
+        return fields
 
 
 class TranslatedModelSerializer(serializers.ModelSerializer):
     def __init__(self, *args, **kwargs):
         super(TranslatedModelSerializer, self).__init__(*args, **kwargs)
-        model = self.Meta.model
+        self.translated_fields = self.get_translated_fields()
+
+    def get_translated_fields(self):
         try:
-            trans_opts = translator.get_options_for_model(model)
+            trans_opts = translator.get_options_for_model(self.Meta.model)
         except NotRegistered:
-            self.translated_fields = []
-            return
+            return []
+        return trans_opts.fields.keys()
 
-        self.translated_fields = trans_opts.fields.keys()
+    def get_fields(self):
+        fields = super(TranslatedModelSerializer, self).get_fields()
         lang_codes = [x[0] for x in settings.LANGUAGES]
         # Remove the pre-existing data in the bundle.
-        for field_name in self.translated_fields:
+        for field_name in self.get_translated_fields():
             for lang in lang_codes:
                 key = "%s_%s" % (field_name, lang)
-                if key in self.fields:
-                    del self.fields[key]
-            del self.fields[field_name]
+                if key in fields:
+                    del fields[key]
+            del fields[field_name]
+        return fields
 
     # def get_field(self, model_field):
     #     kwargs = {}
@@ -350,16 +434,16 @@ class LinkedEventsSerializer(TranslatedModelSerializer, MPTTModelSerializer):
         serializers
     """
 
+    # Fields built by get_fields(), per serializer class and languages
+    _field_plans = {}
+
     def __init__(self, instance=None, files=None,
                  context=None, partial=False, many=None,
                  allow_add_remove=False, hide_ld_context=False, **kwargs):
         super(LinkedEventsSerializer, self).__init__(
             instance=instance, context=context, **kwargs)
-        if 'created_by' in self.fields:
-            del self.fields['created_by']
-        if 'modified_by' in self.fields:
-            del self.fields['modified_by']
 
+        # Copied fields are not expanded, so this is done per instance
         if context is not None:
             include_fields = context.get('include', [])
             for field_name in include_fields:
@@ -380,6 +464,22 @@ class LinkedEventsSerializer(TranslatedModelSerializer, MPTTModelSerializer):
             if 'disable_camelcase' in request.QUERY_PARAMS:
                 self.disable_camelcase = True
 
+    def get_fields(self):
+        """
+        Build the fields of each serializer class once and return copies
+        of them, as building them from the model is slow and happens for
+        every nested serializer too.
+        """
+        key = (type(self), tuple(x[0] for x in settings.LANGUAGES))
+        fields = LinkedEventsSerializer._field_plans.get(key)
+        if fields is None:
+            fields = super(LinkedEventsSerializer, self).get_fields()
+            for field_name in 'created_by', 'modified_by':
+                if field_name in fields:
+                    del fields[field_name]
+            LinkedEventsSerializer._field_plans[key] = fields
+        return copy.deepcopy(fields)
+
     def to_representation(self, obj):
         """
         Before sending to renderer there's a need to do additional work on
@@ -392,12 +492,9 @@ class LinkedEventsSerializer(TranslatedModelSerializer, MPTTModelSerializer):
         ret = super(LinkedEventsSerializer, self).to_representation(obj)
         if 'id' in ret and 'request' in self.context:
             try:
-                ret['@id'] = reverse(self.view_name,
-                                        kwargs={u'pk': ret['id']},
-                                        request=self.context['request'])
+                ret['@id'] = get_url_builder(self.context).url(self.view_name, ret['id'])
             except NoReverseMatch:
-                ret['@id'] = str(ret['id'])
-            ret['@id'] = urlquote_id(ret['@id'])
+                ret['@id'] = urlquote_id(str(ret['id']))
 
         # Context is hidden if:
         # 1) hide_ld_context is set to True
@@ -440,21 +537,179 @@ def _clean_qp(query_params):
     return query_params
 
 
+# Query parameters understood by _filter_event_queryset
+EVENT_FILTER_PARAMS = ('text', 'last_modified_since', 'start', 'end', 'bbox',
+                       'data_source', 'location', 'keyword', 'recurring',
+                       'max_duration', 'min_duration')
+
+
+def _event_usage_filter(params):
+    """
+    Return a Q object selecting the keywords or places which have events
+    matching the event filter params, answered from their event usage
+    columns. Returns None if the events themselves need to be filtered.
+    """
+    used = [key for key in EVENT_FILTER_PARAMS if params.get(key)]
+    if not used:
+        return Q(event_count__gt=0)
+    if used == ['start']:
+        dt = parse_time(params['start'], is_start=True)
+        return Q(event_count__gt=0, last_event_time__gte=dt)
+    if used == ['end']:
+        dt = parse_time(params['end'], is_start=False)
+        return Q(event_count__gt=0, first_event_time__lte=dt)
+    # The usage columns cannot tell whether a single event falls between
+    # both bounds, so anything more specific needs the events.
+    return None
+
+
+class ConditionalGetMixin(object):
+    """
+    Computes the validators of list and detail responses for
+    conditional_get.
+
+    Where possible this is done before serializing, with one query: the
+    latest last_modified_time and `validator_fields` of the filtered
+    queryset together with its exact count, or the values of a single
+    object.
+
+    Responses which embed related objects (?include=) and lists which are
+    not counted (cursor pagination and count estimates) get an ETag
+    computed from the serialized data instead, which saves the transfer
+    only.
+    """
+    # Modification times of served fields which change without
+    # last_modified_time
+    validator_fields = ()
+
+    def get_detail_queryset(self):
+        return self.filter_queryset(self.get_queryset())
+
+    def can_validate_first(self, detail):
+        params = self.request.QUERY_PARAMS
+        if params.get('include'):
+            return False
+        if detail:
+            return True
+        paginator = self.paginator
+        if params.get(getattr(paginator, 'pagination_query_param', None)) == 'cursor':
+            return False
+        if params.get(getattr(paginator, 'count_query_param', None)) == 'estimate':
+            return False
+        return True
+
+    def get_validators(self, detail):
+        """
+        Return the (unquoted) ETag and the Last-Modified time of the
+        response, or None if the object does not exist. Lists have no
+        Last-Modified time, as rows leaving a list do not move the
+        latest modification time of the rest.
+        """
+        fields = ('last_modified_time',) + tuple(self.validator_fields)
+        if detail:
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            values = self.get_detail_queryset()\
+                .filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})\
+                .values_list(*fields).first()
+            if values is None:
+                return None
+        else:
+            queryset = self.filter_queryset(self.get_queryset()).order_by()
+            # The cached counts of the paginator could miss deletions
+            result = queryset.aggregate(Count('pk'), *[Max(field) for field in fields])
+            values = [result['%s__max' % field] for field in fields]
+            values.append(result['pk__count'])
+            return self.get_etag(values), None
+        return self.get_etag(values), values[0]
+
+    def get_etag(self, values):
+        request = self.request
+        data = json.dumps([
+            request.get_full_path(),
+            request.accepted_renderer.format,
+            translation.get_language(),
+            values,
+        ], cls=encoders.JSONEncoder)
+        return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
+def _not_modified(request, etag, last_modified=None):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        # If-Modified-Since is ignored when If-None-Match is given
+        etags = parse_etags(if_none_match)
+        return etag in etags or '*' in etags
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_modified_since is None or last_modified is None:
+        return False
+    return calendar.timegm(last_modified.utctimetuple()) <= if_modified_since
+
+
+def conditional_get(method):
+    """
+    Decorate the list and retrieve methods of a ConditionalGetMixin view
+    to answer matching If-None-Match and If-Modified-Since requests with
+    304 Not Modified, before querying and serializing the objects where
+    the view can validate them first. Lists are validated by the ETag
+    only.
+    """
+    @functools.wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        detail = (self.lookup_url_kwarg or self.lookup_field) in kwargs
+        if not self.can_validate_first(detail):
+            response = method(self, request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            etag = self.get_etag(response.data)
+            if _not_modified(request, etag):
+                response = HttpResponseNotModified()
+            response['ETag'] = quote_etag(etag)
+            return response
+
+        validators = self.get_validators(detail)
+        if validators is None:
+            return method(self, request, *args, **kwargs)
+        etag, last_modified = validators
+        if _not_modified(request, etag, last_modified):
+            response = HttpResponseNotModified()
+        else:
+            response = method(self, request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        response['ETag'] = quote_etag(etag)
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(calendar.timegm(last_modified.utctimetuple()))
+        return response
+    return wrapper
+
+
 class KeywordSerializer(LinkedEventsSerializer):
     view_name = 'keyword-detail'
 
     class Meta:
         model = Keyword
+        exclude = ('first_event_time', 'last_event_time', 'usage_modified_time')
 
 
-class KeywordViewSet(viewsets.ReadOnlyModelViewSet):
+class KeywordViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Keyword.objects.all()
     serializer_class = KeywordSerializer
+    validator_fields = ('usage_modified_time',)
+
+    @conditional_get
+    def list(self, request, *args, **kwargs):
+        return super(KeywordViewSet, self).list(request, *args, **kwargs)
+
+    @conditional_get
+    def retrieve(self, request, *args, **kwargs):
+        return super(KeywordViewSet, self).retrieve(request, *args, **kwargs)
 
     def get_queryset(self):
         """
         Return Keyword queryset. If request has parameter show_all_keywords=1
         all Keywords are returned, otherwise only which have events.
+        Unfiltered and single bound (start or end) listings are answered
+        from the event usage columns maintained on Keyword.
         Additional query parameters:
         event.data_source
         event.start
@@ -468,12 +723,15 @@ class KeywordViewSet(viewsets.ReadOnlyModelViewSet):
                 data_source = data_source.lower()
                 queryset = queryset.filter(data_source=data_source)
         else:
-            events = Event.objects.all()
             params = _clean_qp(self.request.QUERY_PARAMS)
-            events = _filter_event_queryset(events, params)
-            keyword_ids = events.values_list('keywords',
-                                             flat=True).distinct().order_by()
-            queryset = queryset.filter(id__in=keyword_ids)
+            usage_filter = _event_usage_filter(params)
+            if usage_filter is not None:
+                queryset = queryset.filter(usage_filter)
+            else:
+                events = _filter_event_queryset(Event.objects.all(), params)
+                keyword_ids = events.values_list('keywords',
+                                                 flat=True).distinct().order_by()
+                queryset = queryset.filter(id__in=keyword_ids)
         # Optionally filter keywords by filter parameter,
         # can be used e.g. with typeahead.js
         val = self.request.QUERY_PARAMS.get('filter')
@@ -489,16 +747,29 @@ class PlaceSerializer(LinkedEventsSerializer, GeoModelSerializer):
 
     class Meta:
         model = Place
+        exclude = ('first_event_time', 'last_event_time', 'usage_modified_time',
+                   'import_fingerprint')
 
 
-class PlaceViewSet(GeoModelAPIView, viewsets.ReadOnlyModelViewSet):
+class PlaceViewSet(ConditionalGetMixin, GeoModelAPIView, viewsets.ReadOnlyModelViewSet):
     queryset = Place.objects.all()
     serializer_class = PlaceSerializer
+    validator_fields = ('usage_modified_time',)
+
+    @conditional_get
+    def list(self, request, *args, **kwargs):
+        return super(PlaceViewSet, self).list(request, *args, **kwargs)
+
+    @conditional_get
+    def retrieve(self, request, *args, **kwargs):
+        return super(PlaceViewSet, self).retrieve(request, *args, **kwargs)
 
     def get_queryset(self):
         """
         Return Place queryset. If request has parameter show_all_places=1
         all Places are returned, otherwise only which have events.
+        Unfiltered and single bound (start or end) listings are answered
+        from the event usage columns maintained on Place.
         Additional query parameters:
         event.data_source
         event.start
@@ -508,12 +779,15 @@ class PlaceViewSet(GeoModelAPIView, viewsets.ReadOnlyModelViewSet):
         if self.request.QUERY_PARAMS.get('show_all_places'):
             pass
         else:
-            events = Event.objects.all()
             params = _clean_qp(self.request.QUERY_PARAMS)
-            events = _filter_event_queryset(events, params)
-            location_ids = events.values_list('location_id',
-                                              flat=True).distinct().order_by()
-            queryset = queryset.filter(id__in=location_ids)
+            usage_filter = _event_usage_filter(params)
+            if usage_filter is not None:
+                queryset = queryset.filter(usage_filter)
+            else:
+                events = _filter_event_queryset(Event.objects.all(), params)
+                location_ids = events.values_list('location_id',
+                                                  flat=True).distinct().order_by()
+                queryset = queryset.filter(id__in=location_ids)
         return queryset
 
 register_view(PlaceViewSet, 'place')
@@ -677,6 +951,9 @@ class EventSerializer(LinkedEventsSerializer, GeoModelAPIView):
         if instance.end_time:
             instance.has_end_time = True
 
+        # the event no longer matches its imported source record
+        instance.import_fingerprint = None
+
         # save changes
         instance.save()
 
@@ -724,7 +1001,188 @@ class EventSerializer(LinkedEventsSerializer, GeoModelAPIView):
 
     class Meta:
         model = Event
-        exclude = ['has_start_time', 'has_end_time', 'is_recurring_super']
+        exclude = ['has_start_time', 'has_end_time', 'is_recurring_super',
+                   'duration', 'import_fingerprint']
+
+
+class _Row(object):
+    """
+    Attribute access to a .values() row, for the code which expects
+    model instances.
+    """
+    def __init__(self, values):
+        self.__dict__ = values
+
+
+class FastEventListSerializer(object):
+    """
+    Read-only serializer for event list pages, enabled with the
+    EVENT_LIST_FAST_SERIALIZER setting. It gives the same data as
+    EventSerializer, but works from .values() rows with converters
+    compiled from the EventSerializer fields once per page. The related
+    ids, offers and links of a page are fetched with one query each,
+    ordered by id like the prefetches of EventViewSet.
+
+    Construct it with the serializer context and check `supported`:
+    expanded related objects and fields it does not know are left to
+    EventSerializer.
+    """
+    model = Event
+
+    def __init__(self, context):
+        self.context = context
+        self.urls = get_url_builder(context)
+        self.serializer = EventSerializer(context=context)
+        self.fields = []
+        # Format suffixed URLs are left to the regular serializer too
+        self.supported = not (context.get('include') or context.get('format'))
+        if self.supported:
+            for name, field in self.serializer.fields.items():
+                if field.write_only:
+                    continue
+                compiled = self.compile_field(field)
+                if compiled is None:
+                    self.supported = False
+                    break
+                self.fields.append((name,) + compiled)
+
+        lang_codes = [x[0] for x in settings.LANGUAGES]
+        self.translated_fields = [
+            (field_name, getattr(self.model, field_name),
+             ['%s_%s' % (field_name, lang) for lang in lang_codes[1:]])
+            for field_name in self.serializer.translated_fields]
+
+    def compile_field(self, field):
+        """
+        Return (kind, source, argument) for a field, or None if it cannot
+        be serialized from a row.
+        """
+        source = field.source
+        if '.' in source or source == '*':
+            return None
+        if isinstance(field, relations.ManyRelatedField):
+            if not isinstance(field.child_relation, JSONLDRelatedField):
+                return None
+            return ('links', source, field.child_relation.view_name)
+        if isinstance(field, serializers.ListSerializer):
+            return ('nested', source, field.child)
+        try:
+            model_field = self.model._meta.get_field(source)
+        except FieldDoesNotExist:
+            return None
+        if not model_field.concrete:
+            return None
+        if isinstance(field, JSONLDRelatedField):
+            return ('link', model_field.attname, field.view_name)
+        if isinstance(field, relations.PrimaryKeyRelatedField):
+            return ('value', model_field.attname, None)
+        if isinstance(field, (serializers.BaseSerializer, relations.RelatedField,
+                              serializers.SerializerMethodField, serializers.ModelField)):
+            return None
+        return ('value', source, field.to_representation)
+
+    def get_columns(self, queryset):
+        columns = ['id', 'start_time', 'end_time', 'has_start_time', 'has_end_time']
+        for name, kind, source, arg in self.fields:
+            if kind in ('value', 'link'):
+                columns.append(source)
+        lang_codes = [x[0] for x in settings.LANGUAGES]
+        for field_name, descriptor, lang_columns in self.translated_fields:
+            columns += ['%s_%s' % (field_name, lang) for lang in lang_codes]
+        columns += list(queryset.query.extra_select)
+        columns += list(queryset.query.annotation_select)
+        return list(OrderedDict.fromkeys(columns))
+
+    def get_rows_queryset(self, queryset):
+        return queryset.prefetch_related(None).values(*self.get_columns(queryset))
+
+    def get_related(self, ids):
+        """
+        Return the related values of the listed events per field, keyed
+        by event id.
+        """
+        related = {}
+        for name, kind, source, arg in self.fields:
+            values = related[name] = defaultdict(list)
+            if kind == 'links':
+                descriptor = getattr(self.model, source)
+                if hasattr(descriptor, 'through'):
+                    m2m_field = descriptor.field
+                    rows = descriptor.through.objects\
+                        .filter(**{m2m_field.m2m_field_name() + '__in': ids})\
+                        .values_list(m2m_field.m2m_field_name(), m2m_field.m2m_reverse_field_name())\
+                        .order_by(m2m_field.m2m_reverse_field_name())
+                else:
+                    rel_field = descriptor.related.field
+                    rows = rel_field.model.objects.filter(**{rel_field.attname + '__in': ids})\
+                        .values_list(rel_field.attname, 'pk').order_by('pk')
+                for event_id, pk in rows:
+                    values[event_id].append(pk)
+            elif kind == 'nested':
+                rel_field = getattr(self.model, source).related.field
+                objs = rel_field.model.objects.filter(**{rel_field.attname + '__in': ids})
+                for obj in objs.order_by('pk'):
+                    values[getattr(obj, rel_field.attname)].append(obj)
+        return related
+
+    def to_representation(self, row, related):
+        event_id = row['id']
+        url = self.urls.url
+        ret = OrderedDict()
+        for name, kind, source, arg in self.fields:
+            if kind == 'value':
+                value = row[source]
+                if value is not None and arg is not None:
+                    value = arg(value)
+                ret[name] = value
+            elif kind == 'link':
+                pk = row[source]
+                ret[name] = None if pk is None else {'@id': url(arg, pk)}
+            elif kind == 'links':
+                ret[name] = [{'@id': url(arg, pk)} for pk in related[name].get(event_id, ())]
+            else:
+                ret[name] = [arg.to_representation(obj) for obj in related[name].get(event_id, ())]
+
+        # As in TranslatedModelSerializer
+        obj = _Row(row)
+        default_lang = settings.LANGUAGES[0][0]
+        for field_name, descriptor, lang_columns in self.translated_fields:
+            d = {}
+            d[default_lang] = descriptor.__get__(obj, self.model)
+            for lang, column in zip([x[0] for x in settings.LANGUAGES[1:]], lang_columns):
+                if row[column] is not None:
+                    d[lang] = row[column]
+            if all(val is None for val in d.values()):
+                d = None
+            ret[field_name] = d
+
+        # As in LinkedEventsSerializer, for the items of a list
+        if 'id' in ret:
+            try:
+                ret['@id'] = url(self.serializer.view_name, ret['id'])
+            except NoReverseMatch:
+                ret['@id'] = urlquote_id(str(ret['id']))
+        jsonld_context = getattr(self.model, 'jsonld_context', None)
+        if isinstance(jsonld_context, (dict, list)):
+            ret['@context'] = jsonld_context
+        else:
+            ret['@context'] = 'http://schema.org'
+        ret['@type'] = getattr(self.model, 'jsonld_type', self.model.__name__)
+
+        # As in EventSerializer
+        if 'start_time' in ret and not row['has_start_time']:
+            ret['start_time'] = row['start_time'].astimezone(LOCAL_TZ).strftime('%Y-%m-%d')
+        if 'end_time' in ret and not row['has_end_time']:
+            if row['end_time'] - row['start_time'] <= timedelta(days=1):
+                ret['end_time'] = None
+        if 'days_left' in row:
+            ret['days_left'] = int(row['days_left'])
+        return ret
+
+    def serialize(self, rows):
+        rows = list(rows)
+        related = self.get_related([row['id'] for row in rows])
+        return [self.to_representation(row, related) for row in rows]
 
 
 def parse_time(time_str, is_start):
@@ -778,13 +1236,14 @@ class LinkedEventsOrderingFilter(filters.OrderingFilter):
 
 class EventOrderingFilter(LinkedEventsOrderingFilter):
     def filter_queryset(self, request, queryset, view):
-        queryset = super(EventOrderingFilter, self).filter_queryset(request, queryset, view)
         ordering = self.get_ordering(request, queryset, view)
         if not ordering:
-            ordering = []
+            return queryset
         if 'days_left' in [x.lstrip('-') for x in ordering]:
-            queryset = queryset.extra(select={'days_left': 'date_part(\'day\', end_time - start_time)'})
-        return queryset
+            queryset = queryset.extra(select={'days_left': 'date_part(\'day\', events_event.duration)'})
+            # Sort by the indexed duration column instead of the expression
+            ordering = [x.replace('days_left', 'duration') for x in ordering]
+        return queryset.order_by(*ordering)
 
 
 def parse_duration(duration):
@@ -804,6 +1263,54 @@ def parse_duration(duration):
 
     return int(val) * mul
 
+
+# PostgreSQL text search configurations of the per-language search
+# vector columns maintained by a trigger (see migration 0010)
+TEXT_SEARCH_CONFIGS = {
+    'fi': 'finnish',
+    'sv': 'swedish',
+    'en': 'english',
+}
+
+
+def _text_search_columns():
+    # Unqualified, as the event query may be aliased in a subquery. No
+    # other table has these columns.
+    languages = [x[0] for x in settings.LANGUAGES]
+    return [('search_vector_%s' % lang, TEXT_SEARCH_CONFIGS[lang])
+            for lang in languages if lang in TEXT_SEARCH_CONFIGS]
+
+
+def _text_search_query(text):
+    """
+    Convert free text to a tsquery string matching events which have
+    words starting with every word of the text.
+    """
+    words = re.findall(r'\w+', text.lower(), flags=re.U)
+    return ' & '.join('%s:*' % word for word in words)
+
+
+def _text_search_params(query):
+    params = []
+    for column, config in _text_search_columns():
+        params += [config, query]
+    return params
+
+
+def _rank_by_text(queryset, text):
+    """
+    Order the results of a `text` filter by text search rank.
+    """
+    query = _text_search_query(text)
+    if not query:
+        return queryset
+    rank = ' + '.join('ts_rank(%s, to_tsquery(%%s, %%s))' % column
+                      for column, config in _text_search_columns())
+    return queryset.extra(select={'text_rank': rank},
+                          select_params=_text_search_params(query),
+                          order_by=['-text_rank'])
+
+
 def _filter_event_queryset(queryset, params, srs=None):
     """
     Filter events queryset by params
@@ -813,17 +1320,26 @@ def _filter_event_queryset(queryset, params, srs=None):
     # which are marked translatable in translation.py
     val = params.get('text', None)
     if val:
-        val = val.lower()
-        # Free string search from all translated fields
-        fields = EventTranslationOptions.fields
-        # and these languages
-        languages = [x[0] for x in settings.LANGUAGES]
-        qset = Q()
-        for field in fields:
-            for lang in languages:
-                kwarg = {field + '_' + lang + '__icontains': val}
-                qset |= Q(**kwarg)
-        queryset = queryset.filter(qset)
+        query = _text_search_query(val)
+        if query:
+            # Word prefix search using the indexed text search vectors
+            conds = ['%s @@ to_tsquery(%%s, %%s)' % column
+                     for column, config in _text_search_columns()]
+            queryset = queryset.extra(
+                where=['(%s)' % ' OR '.join(conds)],
+                params=_text_search_params(query))
+        else:
+            val = val.lower()
+            # Free string search from all translated fields
+            fields = EventTranslationOptions.fields
+            # and these languages
+            languages = [x[0] for x in settings.LANGUAGES]
+            qset = Q()
+            for field in fields:
+                for lang in languages:
+                    kwarg = {field + '_' + lang + '__icontains': val}
+                    qset |= Q(**kwarg)
+            queryset = queryset.filter(qset)
 
     val = params.get('last_modified_since', None)
     # This should be in format which dateutil.parser recognizes, e.g.
@@ -877,19 +1393,17 @@ def _filter_event_queryset(queryset, params, srs=None):
     val = params.get('max_duration', None)
     if val:
         dur = parse_duration(val)
-        cond = 'end_time - start_time <= %s :: interval'
-        queryset = queryset.extra(where=[cond], params=[str(dur)])
+        queryset = queryset.filter(duration__lte=timedelta(seconds=dur))
 
     val = params.get('min_duration', None)
     if val:
         dur = parse_duration(val)
-        cond = 'end_time - start_time >= %s :: interval'
-        queryset = queryset.extra(where=[cond], params=[str(dur)])
+        queryset = queryset.filter(duration__gte=timedelta(seconds=dur))
 
     return queryset
 
 
-class EventViewSet(viewsets.ModelViewSet, JSONAPIViewSet):
+class EventViewSet(ConditionalGetMixin, viewsets.ModelViewSet, JSONAPIViewSet):
     """
     # Filtering retrieved events
 
@@ -945,23 +1459,57 @@ class EventViewSet(viewsets.ModelViewSet, JSONAPIViewSet):
 
     [See the result](?include=location,keywords "json")
 
+    # Paging through all events
+
+    Deep pages of the default paging get slower the further you go.
+    Harvesters walking the whole result set should use cursor paging
+    instead:
+
+        event/?pagination=cursor&sort=last_modified_time
+
+    Follow the `next` link in `meta` until it is `null`. The results are
+    ordered by `start_time` (default) or `last_modified_time`, optionally
+    descending, and `count` is not calculated.
+
+    [See the result](?pagination=cursor&sort=last_modified_time "json")
+
+    Counting large result sets is expensive too. With `count=estimate`,
+    very large results report an estimated `count`, and
+    `count_is_exact` in `meta` is `false`.
+
+    # Polling for changes
+
+    Responses carry an `ETag` header. Send it back in `If-None-Match` to
+    get an empty `304 Not Modified` response while the results are
+    unchanged. Single events also carry a `Last-Modified` header, which
+    can be sent back in `If-Modified-Since`; lists are validated by the
+    `ETag` only.
+
     # Response data for the current URL
 
     """
     queryset = Event.objects.all()
-    # Use select_ and prefetch_related() to reduce the amount of queries
+    # Use select_ and prefetch_related() to reduce the amount of queries.
+    # The related objects are listed by id, as in FastEventListSerializer.
     queryset = queryset.select_related('location')
-    queryset = queryset.prefetch_related(
-        'offers', 'keywords', 'external_links', 'sub_events')
+    queryset = queryset.prefetch_related(*[
+        Prefetch(name, queryset=model.objects.order_by('id'))
+        for name, model in (('offers', Offer), ('keywords', Keyword),
+                            ('external_links', EventLink), ('sub_events', Event))])
     serializer_class = EventSerializer
     filter_backends = (EventOrderingFilter,)
-    ordering_fields = ('start_time', 'end_time', 'days_left')
+    ordering_fields = ('start_time', 'end_time', 'days_left',
+                       'last_modified_time')
+    cursor_ordering_fields = ('start_time', 'last_modified_time')
 
     def get_object(self):
         # Overridden to prevent queryset filtering from being applied
         # outside list views.
         return get_object_or_404(Event.objects.all(), pk=self.kwargs['pk'])
 
+    def get_detail_queryset(self):
+        return Event.objects.all()
+
     def filter_queryset(self, queryset):
         """
         TODO: convert to use proper filter framework
@@ -975,8 +1523,140 @@ class EventViewSet(viewsets.ModelViewSet, JSONAPIViewSet):
             )
         queryset = _filter_event_queryset(queryset, self.request.QUERY_PARAMS,
                                           srs=self.srs)
+        # Best text matches first, unless the client wants another order
+        text = self.request.QUERY_PARAMS.get('text')
+        if text and not self.request.QUERY_PARAMS.get('sort'):
+            queryset = _rank_by_text(queryset, text)
         return queryset
 
+    def get_fragment_variant(self, context, queryset=None):
+        """
+        Describe the request parameters which affect the rendered events,
+        for the fragment cache keys.
+        """
+        # Sorting by days_left adds it to the events
+        days_left = queryset is not None and 'days_left' in queryset.query.extra_select
+        return [
+            self.request.build_absolute_uri('/'),
+            context.get('format'),
+            sorted(context['include']),
+            [x[0] for x in settings.LANGUAGES],
+            translation.get_language(),
+            self.srs.srid,
+            days_left,
+        ]
+
+    def get_embedded_versions(self, ids, context):
+        """
+        Return the number and the latest modification times of the
+        objects which ?include= embeds in each of the events, for the
+        fragment cache keys. Changes to the embedded objects do not
+        modify the events.
+        """
+        include = set(context['include'])
+        paths = [name for name in ('location', 'keywords') if name in include]
+        if 'sub_events' in include:
+            # The sub events embed the included objects too
+            paths += ['sub_events__' + path for path in paths] + ['sub_events']
+
+        versions = defaultdict(list)
+        for path in paths:
+            fields = ['last_modified_time']
+            if not path.endswith('sub_events'):
+                fields.append('usage_modified_time')
+            aggregates = dict(('max_%s' % field, Max('%s__%s' % (path, field)))
+                              for field in fields)
+            aggregates['count'] = Count('%s__id' % path, distinct=True)
+            rows = Event.objects.filter(id__in=ids).order_by().values('id')\
+                .annotate(**aggregates)
+            for row in rows:
+                times = [row['max_%s' % field] for field in fields]
+                versions[row['id']] += [row['count']] + [t and t.isoformat() for t in times]
+        return versions
+
+    def render_events(self, rows, queryset, context, fast_serializer, fragment_cache):
+        """
+        Return the rendered events of the (id, last_modified_time) rows
+        in order, taking them from the fragment cache where possible.
+        The other events are loaded from the filtered queryset and
+        serialized together.
+        """
+        variant = self.get_fragment_variant(context, queryset)
+        embedded = self.get_embedded_versions([row['id'] for row in rows], context)
+        keys = [fragment_key(row['id'], row['last_modified_time'],
+                             [variant, embedded.get(row['id'])])
+                for row in rows]
+        cached = fragment_cache.get_many([key for key in keys if key is not None])
+
+        rendered = {}
+        missing = [row['id'] for row, key in zip(rows, keys) if key not in cached]
+        if missing:
+            queryset = queryset.filter(id__in=missing)
+            if fast_serializer is not None:
+                data = fast_serializer.serialize(fast_serializer.get_rows_queryset(queryset))
+            else:
+                data = EventSerializer(queryset, many=True, context=context).data
+            rendered = dict((event['id'], event) for event in data)
+            fragment_cache.set_many(dict(
+                (key, rendered[row['id']]) for row, key in zip(rows, keys)
+                if key is not None and key not in cached and row['id'] in rendered))
+
+        events = []
+        for row, key in zip(rows, keys):
+            event = cached[key] if key in cached else rendered.get(row['id'])
+            # Skip events deleted in between
+            if event is not None:
+                events.append(event)
+        return events
+
+    @conditional_get
+    def list(self, request, *args, **kwargs):
+        context = self.get_serializer_context()
+        fast_serializer = None
+        if getattr(settings, 'EVENT_LIST_FAST_SERIALIZER', False):
+            fast_serializer = FastEventListSerializer(context)
+            if not fast_serializer.supported:
+                fast_serializer = None
+        fragment_cache = get_fragment_cache()
+        if fast_serializer is None and fragment_cache is None:
+            return super(EventViewSet, self).list(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        if fragment_cache is not None:
+            # Page through the cache keys only
+            rows = queryset.prefetch_related(None).values(
+                'id', 'start_time', 'last_modified_time')
+        else:
+            rows = fast_serializer.get_rows_queryset(queryset)
+        page = self.paginate_queryset(rows)
+        events = list(rows) if page is None else page
+
+        if fragment_cache is not None:
+            data = self.render_events(events, queryset, context, fast_serializer,
+                                      fragment_cache)
+        else:
+            data = fast_serializer.serialize(events)
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+    @conditional_get
+    def retrieve(self, request, *args, **kwargs):
+        # With the related objects prefetched in the same order as in lists
+        instance = get_object_or_404(self.queryset, pk=self.kwargs['pk'])
+        context = self.get_serializer_context()
+        fragment_cache = get_fragment_cache()
+        if fragment_cache is None:
+            return Response(EventSerializer(instance, context=context).data)
+        embedded = self.get_embedded_versions([instance.id], context)
+        key = fragment_key(instance.id, instance.last_modified_time,
+                           [self.get_fragment_variant(context), embedded.get(instance.id)])
+        data = fragment_cache.get_many([key]).get(key) if key is not None else None
+        if data is None:
+            data = OrderedDict(EventSerializer(instance, context=context).data)
+            if key is not None:
+                fragment_cache.set_many({key: data})
+        return Response(data)
 
     def get_authorized_publisher(self, request, data):
         user = request.user
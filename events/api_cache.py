@@ -0,0 +1,140 @@
+"""
+Caches of rendered API objects.
+
+The serialized form of an object is cached as a fragment, keyed by the
+object id, its last_modified_time and the request variant (see
+fragment_key). Saving an object bumps its last_modified_time, so stale
+fragments are simply not looked up again; they age out of the cache.
+Objects embedding related objects are keyed by the versions of those
+too.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+class LocalFragmentCache(object):
+    """
+    Keeps the `max_size` most recently used fragments in the memory of
+    the process, each for at most `timeout` seconds.
+
+    The cached objects are returned as such, so they must not be
+    modified.
+    """
+    def __init__(self, max_size=None, timeout=None):
+        if max_size is None:
+            max_size = getattr(settings, 'EVENT_FRAGMENT_CACHE_SIZE', 10000)
+        if timeout is None:
+            timeout = getattr(settings, 'EVENT_FRAGMENT_CACHE_TIMEOUT', 3600)
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is None:
+                    continue
+                expires, value = entry
+                if expires < now:
+                    del self._data[key]
+                    continue
+                self._data.move_to_end(key)
+                found[key] = value
+        return found
+
+    def set_many(self, fragments):
+        expires = time.monotonic() + self.timeout
+        with self._lock:
+            for key, value in fragments.items():
+                self._data[key] = (expires, value)
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SharedFragmentCache(object):
+    """
+    Keeps the fragments in a Django cache shared by all the processes.
+
+    The keys are prefixed with a generation number kept in the cache,
+    so that clear() drops the fragments only, by moving to the next
+    generation.
+    """
+    key_prefix = 'fragment:'
+    generation_key = 'fragment-generation'
+
+    def __init__(self, alias='default', timeout=None):
+        if timeout is None:
+            timeout = getattr(settings, 'EVENT_FRAGMENT_CACHE_TIMEOUT', 3600)
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def get_prefix(self):
+        generation = self.cache.get(self.generation_key)
+        if generation is None:
+            self.cache.add(self.generation_key, 1, None)
+            generation = self.cache.get(self.generation_key, 1)
+        return '%s%d:' % (self.key_prefix, generation)
+
+    def get_many(self, keys):
+        prefix = self.get_prefix()
+        found = self.cache.get_many([prefix + key for key in keys])
+        return dict((key[len(prefix):], value) for key, value in found.items())
+
+    def set_many(self, fragments):
+        prefix = self.get_prefix()
+        self.cache.set_many(dict((prefix + key, value)
+                                 for key, value in fragments.items()), self.timeout)
+
+    def clear(self):
+        self.get_prefix()
+        try:
+            self.cache.incr(self.generation_key)
+        except ValueError:
+            # Evicted in between
+            self.cache.add(self.generation_key, 1, None)
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_fragment_cache():
+    """
+    Return the backend named by the EVENT_FRAGMENT_CACHE_BACKEND setting,
+    or None if the fragment cache is disabled.
+    """
+    path = getattr(settings, 'EVENT_FRAGMENT_CACHE_BACKEND', None)
+    if not path:
+        return None
+    with _backends_lock:
+        if path not in _backends:
+            _backends[path] = import_string(path)()
+        return _backends[path]
+
+
+def fragment_key(obj_id, last_modified_time, variant):
+    """
+    Return the cache key of an object rendered for `variant`, a JSON
+    serializable description of the request parameters which affect the
+    output. Objects without a modification time are not cached.
+    """
+    if last_modified_time is None:
+        return None
+    data = json.dumps([obj_id, last_modified_time.isoformat(), variant])
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
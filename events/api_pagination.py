@@ -1,16 +1,247 @@
+import base64
+import binascii
+import hashlib
+import json
+
+from dateutil.parser import parse as dateutil_parse
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import InvalidPage, Paginator
+from django.db import connections
+from django.db.models import Q
+from django.db.models.sql.datastructures import EmptyResultSet
 from rest_framework.response import Response
 from rest_framework.compat import OrderedDict
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 from rest_framework import pagination
 
 
+def estimate_count(queryset):
+    """
+    Return the PostgreSQL planner's row estimate for a queryset, or None
+    if the object list is not a database queryset.
+    """
+    if not hasattr(queryset, 'query'):
+        return None
+    try:
+        sql, params = queryset.order_by().query.sql_with_params()
+    except EmptyResultSet:
+        return 0
+    cursor = connections[queryset.db].cursor()
+    try:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class CountCachingPaginator(Paginator):
+    """
+    Paginator which caches the total count under `cache_key` and, if
+    `estimate` is set, reports the planner estimate for large results.
+    """
+    def __init__(self, object_list, per_page, cache_key=None, estimate=False,
+                 **kwargs):
+        super(CountCachingPaginator, self).__init__(object_list, per_page, **kwargs)
+        self.cache_key = cache_key
+        self.estimate = estimate
+        self.count_is_exact = True
+
+    def _get_count(self):
+        if self._count is not None:
+            return self._count
+
+        timeout = getattr(settings, 'PAGINATION_COUNT_CACHE_TIMEOUT', 0)
+        if self.cache_key and timeout:
+            cached = cache.get(self.cache_key)
+            if cached is not None:
+                self._count, self.count_is_exact = cached
+                return self._count
+
+        count = None
+        if self.estimate:
+            threshold = getattr(settings, 'PAGINATION_COUNT_ESTIMATE_THRESHOLD', 0)
+            count = estimate_count(self.object_list)
+            if count is not None and count >= threshold:
+                self.count_is_exact = False
+            else:
+                count = None
+        if count is None:
+            count = super(CountCachingPaginator, self)._get_count()
+
+        self._count = count
+        if self.cache_key and timeout:
+            cache.set(self.cache_key, (count, self.count_is_exact), timeout)
+        return count
+    count = property(_get_count)
+
+
 # This needs to be in its own file because of circular
 # imports.
 class CustomPagination(pagination.PageNumberPagination):
+    """
+    Page number pagination with an opt-in keyset (cursor) mode.
+
+    With `pagination=cursor`, views that define `cursor_ordering_fields`
+    are paged by the (sort field, id) pair of the last returned row
+    instead of an OFFSET, and no total count is computed. The `next`
+    link carries an opaque `cursor` token.
+
+    In page number mode the total count is cached for a short while,
+    keyed on the filtering query parameters. With `count=estimate`,
+    large results report the planner estimate instead of an exact count.
+    """
+    pagination_query_param = 'pagination'
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+
+    # Query parameters which do not affect the total count
+    count_ignored_params = ('page', 'page_size', 'sort', 'include', 'format')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self._handle_backwards_compat(view)
+        mode = request.query_params.get(self.pagination_query_param)
+        self.cursor_mode = (mode == 'cursor')
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        if self.cursor_mode:
+            return self.paginate_queryset_by_cursor(queryset, request, view,
+                                                    page_size)
+
+        estimate = request.query_params.get(self.count_query_param) == 'estimate'
+        paginator = CountCachingPaginator(
+            queryset, page_size, cache_key=self.get_count_cache_key(request),
+            estimate=estimate)
+        page_number = request.query_params.get(self.page_query_param, 1)
+        if page_number in self.last_page_strings:
+            page_number = paginator.num_pages
+
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            raise NotFound('Invalid page "%s": %s.' % (page_number, exc))
+
+        if paginator.num_pages > 1 and getattr(self, 'template', None) is not None:
+            # The browsable API should display pagination controls.
+            self.display_page_controls = True
+
+        self.request = request
+        return list(self.page)
+
+    def get_count_cache_key(self, request):
+        params = sorted(
+            (key, sorted(values)) for key, values in request.query_params.lists()
+            if key not in self.count_ignored_params)
+        data = json.dumps([request.path, params]).encode('utf-8')
+        return 'pagination-count:%s' % hashlib.md5(data).hexdigest()
+
+    def paginate_queryset_by_cursor(self, queryset, request, view, page_size):
+        field = self.get_cursor_field(request, view)
+        key = field.lstrip('-')
+        descending = field.startswith('-')
+        queryset = queryset.order_by(field, '-id' if descending else 'id')
+
+        token = request.query_params.get(self.cursor_query_param)
+        if token:
+            value, last_id = self.decode_cursor(token, field)
+            queryset = queryset.filter(
+                self.cursor_filter(key, descending, value, last_id))
+
+        # Fetch one extra row to find out whether there is a next page.
+        results = list(queryset[:page_size + 1])
+        self.next_cursor = None
+        if len(results) > page_size:
+            results = results[:page_size]
+            last = results[-1]
+            if isinstance(last, dict):
+                # A .values() queryset
+                value, last_id = last[key], last['id']
+            else:
+                value, last_id = getattr(last, key), last.pk
+            self.next_cursor = self.encode_cursor(field, value, last_id)
+
+        self.request = request
+        return results
+
+    def get_cursor_field(self, request, view):
+        allowed = getattr(view, 'cursor_ordering_fields', None)
+        if not allowed:
+            raise ParseError("Cursor pagination is not supported here")
+        sort = request.query_params.get(api_settings.ORDERING_PARAM)
+        if not sort:
+            return allowed[0]
+        fields = [x.strip() for x in sort.split(',') if x.strip()]
+        if len(fields) != 1 or fields[0].lstrip('-') not in allowed:
+            raise ParseError(
+                "Cursor pagination supports sorting only by one of: %s" %
+                ', '.join(allowed))
+        return fields[0]
+
+    @staticmethod
+    def cursor_filter(key, descending, value, last_id):
+        """
+        Return a Q object matching the rows after (value, last_id) in the
+        given ordering. PostgreSQL sorts NULLs last in ascending and first
+        in descending order.
+        """
+        op = 'lt' if descending else 'gt'
+        if value is None:
+            q = Q(**{key + '__isnull': True, 'id__' + op: last_id})
+            if descending:
+                q |= Q(**{key + '__isnull': False})
+            return q
+        q = Q(**{key + '__' + op: value}) | Q(**{key: value, 'id__' + op: last_id})
+        if not descending:
+            q |= Q(**{key + '__isnull': True})
+        return q
+
+    @staticmethod
+    def encode_cursor(field, value, last_id):
+        if value is not None:
+            value = value.isoformat()
+        data = json.dumps([field, value, last_id]).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(token, field):
+        try:
+            data = base64.urlsafe_b64decode(token.encode('ascii'))
+            token_field, value, last_id = json.loads(data.decode('utf-8'))
+            if value is not None:
+                value = dateutil_parse(value)
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise ParseError("Invalid cursor")
+        if token_field != field:
+            raise ParseError("Cursor does not match the requested sort order")
+        return value, last_id
+
+    def get_next_cursor_link(self):
+        if not self.next_cursor:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
     def get_paginated_response(self, data):
-        meta = OrderedDict([
-            ('count', self.page.paginator.count),
-            ('next', self.get_next_link()),
-            ('previous', self.get_previous_link()),
-        ])
+        if self.cursor_mode:
+            meta = OrderedDict([
+                ('count', None),
+                ('count_is_exact', None),
+                ('next', self.get_next_cursor_link()),
+                ('previous', None),
+            ])
+        else:
+            meta = OrderedDict([
+                ('count', self.page.paginator.count),
+                ('count_is_exact', self.page.paginator.count_is_exact),
+                ('next', self.get_next_link()),
+                ('previous', self.get_previous_link()),
+            ])
 
         return Response(OrderedDict([('meta', meta), ('data', data)]))
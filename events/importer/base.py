@@ -1,20 +1,25 @@
 import os
 import re
+import math
+import time
 import logging
 import itertools
 import datetime
-from collections import defaultdict
+from contextlib import contextmanager, ExitStack
+from collections import defaultdict, OrderedDict
 import operator
 
-from django.db import DataError
+from django.db import DataError, connections, transaction
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
-from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.geos import MultiPoint, Point, Polygon
 from django.contrib.gis.gdal import SpatialReference, CoordTransform
 
+import numpy
 from modeltranslation.translator import translator
 
-from .util import active_language
+from .fetch import Fetcher
+from .util import active_language, import_fingerprint
 from events.models import *
 
 
@@ -23,7 +28,122 @@ from events.models import *
 # with different languages on different passes.
 def recur_dict(): return defaultdict(recur_dict)
 
+
+# Transverse Mercator projections on the GRS80 ellipsoid which
+# transform_positions() computes with NumPy: central meridian, scale
+# factor, false easting and false northing. Other projections go
+# through GDAL.
+TM_PROJECTIONS = {
+    3067: (27.0, 0.9996, 500000.0, 0.0),   # ETRS-TM35FIN
+    3879: (25.0, 1.0, 25500000.0, 0.0),    # ETRS-GK25FIN
+}
+
+# Positions closer than this (in metres) to the old position are
+# considered unchanged
+POSITION_CHANGE_THRESHOLD = 0.10
+
+
+def _project_tm(lons, lats, projection):
+    """
+    Project WGS84 coordinate arrays with the Kruger series, which is
+    accurate to well below a millimetre within the projection zone.
+    Points far outside the zone may come out as NaN.
+    """
+    lon0, k0, false_easting, false_northing = projection
+    f = 1 / 298.257222101
+    n = f / (2 - f)
+    a = 6378137.0 / (1 + n) * (1 + n ** 2 / 4 + n ** 4 / 64)
+    alpha = (
+        n / 2 - 2 * n ** 2 / 3 + 5 * n ** 3 / 16 + 41 * n ** 4 / 180,
+        13 * n ** 2 / 48 - 3 * n ** 3 / 5 + 557 * n ** 4 / 1440,
+        61 * n ** 3 / 240 - 103 * n ** 4 / 140,
+        49561 * n ** 4 / 161280,
+    )
+    e = 2 * math.sqrt(n) / (1 + n)
+
+    sin_lat = numpy.sin(numpy.radians(lats))
+    lon = numpy.radians(lons - lon0)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        t = numpy.sinh(numpy.arctanh(sin_lat) - e * numpy.arctanh(e * sin_lat))
+        xi = numpy.arctan2(t, numpy.cos(lon))
+        eta = numpy.arctanh(numpy.sin(lon) / numpy.sqrt(1 + t ** 2))
+        x = eta.copy()
+        y = xi.copy()
+        for j, alpha_j in enumerate(alpha, 1):
+            x += alpha_j * numpy.cos(2 * j * xi) * numpy.sinh(2 * j * eta)
+            y += alpha_j * numpy.sin(2 * j * xi) * numpy.cosh(2 * j * eta)
+    return false_easting + k0 * a * x, false_northing + k0 * a * y
+
+
+def _project(lons, lats, target_srid):
+    lons = numpy.asarray(lons, dtype=float)
+    lats = numpy.asarray(lats, dtype=float)
+    if target_srid == 4326:
+        return lons, lats
+    if target_srid in TM_PROJECTIONS:
+        return _project_tm(lons, lats, TM_PROJECTIONS[target_srid])
+    # A single GDAL call for all the points
+    points = MultiPoint([Point(lon, lat) for lon, lat in zip(lons, lats)], srid=4326)
+    points.transform(target_srid)
+    coords = numpy.array(points.coords, dtype=float).reshape(-1, 2)
+    return coords[:, 0], coords[:, 1]
+
+
+def transform_positions(coords, old_positions=None, target_srid=None, bounding_box=None):
+    """
+    Transform a list of (longitude, latitude) pairs to Points in
+    target_srid (PROJECTION_SRID by default) in one pass.
+
+    Returns the list of positions and the list of the indices of the
+    pairs outside bounding_box, given in the target projection
+    (BOUNDING_BOX by default). Pairs with a missing or zero coordinate
+    and pairs outside the bounding box get no position. With
+    old_positions, a new position closer than 10 cm to the old one is
+    replaced by the old one, so that it does not count as a change.
+    """
+    if target_srid is None:
+        target_srid = settings.PROJECTION_SRID
+    if bounding_box is None:
+        bounding_box = getattr(settings, 'BOUNDING_BOX', None)
+
+    positions = [None] * len(coords)
+    indices = [i for i, c in enumerate(coords) if c and c[0] and c[1]]
+    if not indices:
+        return positions, []
+    xs, ys = _project([coords[i][0] for i in indices], [coords[i][1] for i in indices],
+                      target_srid)
+
+    valid = numpy.isfinite(xs) & numpy.isfinite(ys)
+    if bounding_box:
+        with numpy.errstate(invalid='ignore'):
+            valid &= ((xs >= bounding_box[0]) & (xs <= bounding_box[2]) &
+                      (ys >= bounding_box[1]) & (ys <= bounding_box[3]))
+    unchanged = numpy.zeros(len(indices), dtype=bool)
+    if old_positions:
+        old = [old_positions[i] for i in indices]
+        old_xs = numpy.array([p.x if p else numpy.nan for p in old])
+        old_ys = numpy.array([p.y if p else numpy.nan for p in old])
+        with numpy.errstate(invalid='ignore'):
+            unchanged = numpy.hypot(xs - old_xs, ys - old_ys) < POSITION_CHANGE_THRESHOLD
+    xs, ys = xs.tolist(), ys.tolist()
+    valid, unchanged = valid.tolist(), unchanged.tolist()
+
+    outside = []
+    for n, i in enumerate(indices):
+        if not valid[n]:
+            outside.append(i)
+        elif unchanged[n]:
+            assert old_positions[i].srid == target_srid
+            positions[i] = old_positions[i]
+        else:
+            positions[i] = Point(xs[n], ys[n], srid=target_srid)
+    return positions, outside
+
+
 class Importer(object):
+    # Number of events saved per transaction by save_events()
+    save_chunk_size = 500
+
     def __init__(self, options):
         super(Importer, self).__init__()
         self.options = options
@@ -51,11 +171,43 @@ class Importer(object):
             self.bounding_box = None
         self.gps_to_target_ct = CoordTransform(gps_srs, target_srs)
 
+        self.fetcher = Fetcher(
+            cache_path=os.path.join(settings.IMPORT_CACHE_PATH, 'fetch'),
+            force=options.get('force', False))
+
         self.setup()
 
     def setup(self):
         pass
 
+    @contextmanager
+    def delay_tree_updates(self):
+        """
+        Suspend the per-save MPTT bookkeeping of events and places for
+        the duration of the block. The trees which changed are rebuilt
+        once when the block exits, and the time that takes is stored in
+        tree_rebuild_time.
+        """
+        self.tree_rebuild_time = 0
+        with ExitStack() as stack:
+            for model in (Event, Place):
+                stack.enter_context(model._tree_manager.delay_mptt_updates())
+            yield
+            started = time.time()
+        self.tree_rebuild_time = time.time() - started
+
+    @staticmethod
+    def _rebuild_trees(model, tree_ids):
+        """
+        Rebuild the given trees of model from the parent links after bulk
+        writes, or at the end of delay_tree_updates() if it is active.
+        """
+        for tree_id in set(tree_ids):
+            if model._mptt_is_tracking:
+                model._mptt_track_tree_modified(tree_id)
+            else:
+                model._tree_manager.partial_rebuild(tree_id)
+
     @staticmethod
     def clean_text(text):
         text = text.replace('\n', ' ')
@@ -113,6 +265,8 @@ class Importer(object):
             return
         setattr(obj, field_name, val)
         obj._changed = True
+        if hasattr(obj, '_changed_fields'):
+            obj._changed_fields.add(field_name)
 
     def _update_fields(self, obj, info, skip_fields):
         obj_fields = list(obj._meta.fields)
@@ -153,26 +307,34 @@ class Importer(object):
             self._set_field(obj, field_name, info[field_name])
 
     def save_event(self, info):
+        self.save_events([info])
+
+    def save_events(self, infos):
+        """
+        Save imported events in chunks. The existing events with their
+        keywords, offers and links are fetched for a whole chunk at once
+        and only the changed rows are written, each chunk in its own
+        transaction. Returns the created and changed events; events
+        skipped as unchanged by their import fingerprint are left out.
+        The importers rely on the database for the full set.
+        """
+        infos = iter(infos)
+        saved = []
+        while True:
+            chunk = list(itertools.islice(infos, self.save_chunk_size))
+            if not chunk:
+                break
+            with transaction.atomic():
+                saved += self._save_event_chunk(chunk)
+        return saved
+
+    def _prepare_event_info(self, info):
         info = info.copy()
 
-        args = dict(data_source=info['data_source'], origin_id=info['origin_id'])
-        obj_id = "%s:%s" % (info['data_source'].id, info['origin_id'])
-        try:
-            obj = Event.objects.get(**args)
-            obj._created = False
-            assert obj.id == obj_id
-        except Event.DoesNotExist:
-            obj = Event(**args)
-            obj._created = True
-            obj.id = obj_id
-        obj._changed = False
-
-        location_id = None
-        location_extra_info = None
         if 'location' in info:
             location = info['location']
             if 'id' in location:
-                location_id = location['id']
+                info['location_id'] = location['id']
             info['location_extra_info'] = location.get('extra_info', None)
 
         assert info['start_time']
@@ -194,71 +356,238 @@ class Importer(object):
             info['end_time'] = info['end_time'].replace(hour=0, minute=0, second=0)
             info['end_time'] += datetime.timedelta(days=1)
 
-        skip_fields = ['id', 'location', 'publisher', 'offers', 'keywords']
-        self._update_fields(obj, info, skip_fields)
-
-        self._set_field(obj, 'location_id', location_id)
-
-        self._set_field(obj, 'publisher_id', info['publisher'].id)
-
-        if obj._created or obj._changed:
-            obj.save()
-
-        # many-to-many fields
-
-        keywords = info.get('keywords', [])
-        new_keywords = set([kw.id for kw in keywords])
-        old_keywords = set(obj.keywords.values_list('id', flat=True))
-        if new_keywords != old_keywords:
-            obj.keywords = new_keywords
-            obj._changed = True
-
-        # one-to-many fields with foreign key pointing to event
-
-        offers = []
-        for offer in info.get('offers', []):
-            offer_obj = Offer(event=obj)
-            self._update_fields(offer_obj, offer, skip_fields=['id'])
-            offers.append(offer_obj)
-
-        val = operator.methodcaller('simple_value')
-        if set(map(val, offers)) != set(map(val, obj.offers.all())):
-            obj.offers.all().delete()
-            for o in offers: o.save()
-            obj._changed = True
+        return info
 
+    def _make_event_links(self, info):
         links = []
         if 'external_links' in info:
             for lang in info['external_links'].keys():
                 for l in info['external_links'][lang]:
                     l['language'] = lang
                 links += info['external_links'][lang]
+        return links
+
+    def _get_event_fingerprints(self, data_source):
+        if not hasattr(self, '_event_fingerprints'):
+            self._event_fingerprints = {}
+        if data_source.id not in self._event_fingerprints:
+            queryset = Event.objects.filter(data_source=data_source)\
+                .exclude(import_fingerprint=None)
+            self._event_fingerprints[data_source.id] = dict(
+                queryset.values_list('id', 'import_fingerprint'))
+        return self._event_fingerprints[data_source.id]
+
+    def _save_event_chunk(self, infos):
+        # Later infos for the same event win
+        infos_by_id = OrderedDict()
+        for info in infos:
+            info = self._prepare_event_info(info)
+            obj_id = "%s:%s" % (info['data_source'].id, info['origin_id'])
+            fingerprints = self._get_event_fingerprints(info['data_source'])
+            info['import_fingerprint'] = import_fingerprint(info)
+            if fingerprints.get(obj_id) == info['import_fingerprint']:
+                # Same source record as on the previous import
+                infos_by_id.pop(obj_id, None)
+                continue
+            infos_by_id[obj_id] = info
+        if not infos_by_id:
+            return []
+
+        ids = list(infos_by_id.keys())
+        existing = Event.objects.filter(id__in=ids)\
+            .prefetch_related('offers', 'external_links').in_bulk(ids)
+        event_keywords = defaultdict(set)
+        through = Event.keywords.through
+        for event_id, keyword_id in through.objects.filter(event_id__in=ids)\
+                .values_list('event_id', 'keyword_id'):
+            event_keywords[event_id].add(keyword_id)
+
+        trans_fields = translator.get_options_for_model(Event).fields
+        translated_bases = {}
+        for field_name, lang_fields in trans_fields.items():
+            for lf in lang_fields:
+                translated_bases[lf.name] = field_name
 
-        # TODO: use simple_value logic like for offers above?
-        def obj_make_link_id(obj):
-            return '%s:%s:%s' % (obj.language_id, obj.name, obj.link)
-        def info_make_link_id(info):
-            return '%s:%s:%s' % (info['language'], info.get('name', ''), info['link'])
-
-        new_links = set([info_make_link_id(link) for link in links])
-        old_links = set([obj_make_link_id(link) for link in obj.external_links.all()])
-        if old_links != new_links:
-            obj.external_links.all().delete()
-            for link in links:
-                link_obj = EventLink(event=obj, language_id=link['language'], link=link['link'])
-                if len(link['link']) > 200:
-                    continue
-                if 'name' in link:
-                    link_obj.name = link['name']
-                link_obj.save()
-            obj._changed = True
-
-        if obj._changed or obj._created:
-            if obj._created:
-                verb = "created"
+        now = BaseModel.now()
+        created = []
+        updated = []
+        offers = []
+        offers_changed = []
+        links = []
+        links_changed = []
+        keywords = []
+        keywords_changed = []
+        places_changed = set()
+        keywords_touched = set()
+        results = []
+
+        for obj_id, info in infos_by_id.items():
+            obj = existing.get(obj_id)
+            if obj is not None:
+                obj._created = False
             else:
-                verb = "changed"
-            print("%s %s" % (obj, verb))
+                obj = Event(data_source=info['data_source'], origin_id=info['origin_id'])
+                obj._created = True
+                obj.id = obj_id
+            obj._changed = False
+            obj._changed_fields = set()
+            old_location_id = obj.location_id
+
+            skip_fields = ['id', 'location', 'publisher', 'offers', 'keywords',
+                           'import_fingerprint']
+            self._update_fields(obj, info, skip_fields)
+            self._set_field(obj, 'location_id', info.get('location_id'))
+            self._set_field(obj, 'publisher_id', info['publisher'].id)
+
+            fingerprint_changed = obj.import_fingerprint != info['import_fingerprint']
+            obj.import_fingerprint = info['import_fingerprint']
+            fields_changed = obj._changed
+            if obj._created or fields_changed:
+                places_changed.update([old_location_id, obj.location_id])
+
+            # many-to-many fields
+
+            new_keywords = set([kw.id for kw in info.get('keywords', [])])
+            old_keywords = event_keywords.get(obj.id, set())
+            if fields_changed and not obj._created:
+                # Changed times affect the usage of the existing keywords
+                keywords_touched |= old_keywords
+            if new_keywords != old_keywords:
+                if not obj._created:
+                    keywords_changed.append(obj.id)
+                for kw_id in new_keywords:
+                    keywords.append(through(event_id=obj.id, keyword_id=kw_id))
+                keywords_touched |= old_keywords | new_keywords
+                obj._changed = True
+
+            # one-to-many fields with foreign key pointing to event
+
+            event_offers = []
+            for offer in info.get('offers', []):
+                offer_obj = Offer(event=obj)
+                self._update_fields(offer_obj, offer, skip_fields=['id'])
+                event_offers.append(offer_obj)
+
+            old_offers = [] if obj._created else obj.offers.all()
+            val = operator.methodcaller('simple_value')
+            if set(map(val, event_offers)) != set(map(val, old_offers)):
+                if not obj._created:
+                    offers_changed.append(obj.id)
+                offers += event_offers
+                obj._changed = True
+
+            event_links = self._make_event_links(info)
+
+            # TODO: use simple_value logic like for offers above?
+            def obj_make_link_id(obj):
+                return '%s:%s:%s' % (obj.language_id, obj.name, obj.link)
+            def info_make_link_id(info):
+                return '%s:%s:%s' % (info['language'], info.get('name', ''), info['link'])
+
+            old_links = [] if obj._created else obj.external_links.all()
+            new_links = set([info_make_link_id(link) for link in event_links])
+            old_links = set([obj_make_link_id(link) for link in old_links])
+            if old_links != new_links:
+                if not obj._created:
+                    links_changed.append(obj.id)
+                for link in event_links:
+                    link_obj = EventLink(event=obj, language_id=link['language'], link=link['link'])
+                    if len(link['link']) > 200:
+                        continue
+                    if 'name' in link:
+                        link_obj.name = link['name']
+                    links.append(link_obj)
+                obj._changed = True
+
+            # Changes to the related objects bump the modification time too,
+            # as the API caches rendered events by it
+            if obj._created:
+                obj.created_time = now
+                obj.last_modified_time = now
+                obj.duration = obj.calculate_duration()
+                created.append(obj)
+            elif obj._changed:
+                update_fields = set(obj._changed_fields)
+                update_fields |= set(translated_bases[f] for f in obj._changed_fields
+                                     if f in translated_bases)
+                obj.last_modified_time = now
+                obj.duration = obj.calculate_duration()
+                update_fields |= set(['last_modified_time', 'duration', 'import_fingerprint'])
+                updated.append((obj, update_fields))
+            elif fingerprint_changed:
+                updated.append((obj, set(['import_fingerprint'])))
+
+            results.append(obj)
+
+        if created:
+            self._prepare_tree_roots(Event, created)
+            Event.objects.bulk_create(created)
+        for obj, update_fields in updated:
+            values = dict((f, getattr(obj, f)) for f in update_fields)
+            # Write the untranslated columns as they are, like save() does
+            Event.objects.rewrite(False).filter(id=obj.id).update(**values)
+
+        if keywords_changed:
+            through.objects.filter(event_id__in=keywords_changed).delete()
+        through.objects.bulk_create(keywords)
+        if offers_changed:
+            Offer.objects.filter(event_id__in=offers_changed).delete()
+        Offer.objects.bulk_create(offers)
+        if links_changed:
+            EventLink.objects.filter(event_id__in=links_changed).delete()
+        EventLink.objects.bulk_create(links)
+
+        fingerprints = {}
+        for obj in results:
+            fingerprints.setdefault(obj.data_source_id, {})[obj.id] = obj.import_fingerprint
+        for data_source_id, values in fingerprints.items():
+            self._event_fingerprints[data_source_id].update(values)
+
+        # Bulk writes do not send the signals which keep usage up to date
+        mark_event_usage_changed(Place, places_changed)
+        mark_event_usage_changed(Keyword, keywords_touched)
+
+        for obj in results:
+            if obj._changed or obj._created:
+                if obj._created:
+                    verb = "created"
+                else:
+                    verb = "changed"
+                print("%s %s" % (obj, verb))
+
+        return results
+
+    @staticmethod
+    def _prepare_tree_roots(model, objs):
+        """
+        Set up the MPTT fields of new objects so that they can be
+        inserted with bulk_create() as root nodes of their own trees.
+        """
+        opts = model._mptt_meta
+        tree_id = model._tree_manager._get_next_tree_id()
+        for obj in objs:
+            setattr(obj, opts.tree_id_attr, tree_id)
+            setattr(obj, opts.left_attr, 1)
+            setattr(obj, opts.right_attr, 2)
+            setattr(obj, opts.level_attr, 0)
+            tree_id += 1
+
+    @staticmethod
+    def _reserve_ids(model, count):
+        """
+        Reserve count values of the id sequence of model, so that the
+        objects can be inserted with bulk_create() with known ids.
+        """
+        if not count:
+            return []
+        cursor = connections[model.objects.db].cursor()
+        try:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [model._meta.db_table, count])
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
 
     def save_place(self, info):
         errors = set()
@@ -280,22 +609,10 @@ class Importer(object):
 
         n = info.get('latitude', 0)
         e = info.get('longitude', 0)
-        position = None
-        if n and e:
-            p = Point(e, n, srid=4326) # GPS coordinate system
-            if p.within(self.bounding_box):
-                if self.target_srid != 4326:
-                    p.transform(self.gps_to_target_ct)
-                position = p
-            else:
-                print("Invalid coordinates (%f, %f) for %s" % (n, e, obj))
-
-        if position and obj.position:
-            # If the distance is less than 10cm, assume the position
-            # hasn't changed.
-            assert obj.position.srid == settings.PROJECTION_SRID
-            if position.distance(obj.position) < 0.10:
-                position = obj.position
+        positions, outside = transform_positions([(e, n)], [obj.position], self.target_srid)
+        position = positions[0]
+        if outside:
+            print("Invalid coordinates (%f, %f) for %s" % (n, e, obj))
         if position != obj.position:
             obj._changed = True
             obj.position = position
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP fetching shared by the importers.
+"""
+import hashlib
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+
+class Source(object):
+    """
+    A document fetched with Fetcher.get_source(). `unchanged` tells
+    whether the content is the same as when it was last imported.
+    Streamed sources have no `content` but a `path` to it.
+    """
+    def __init__(self, url, status_code, content, content_hash=None, unchanged=False,
+                 path=None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.content_hash = content_hash
+        self.unchanged = unchanged
+        self.path = path
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def open(self):
+        """
+        Return a binary file object for reading the content.
+        """
+        if self.content is None and self.path is not None:
+            return open(self.path, 'rb')
+        return io.BytesIO(self.content)
+
+    def without_content(self):
+        """
+        Return a copy of the source without its content, for keeping
+        track of sources whose content has been consumed.
+        """
+        return Source(self.url, self.status_code, None, self.content_hash, self.unchanged)
+
+
+class FetchCache(object):
+    """
+    Keeps the validators (ETag and Last-Modified), the content and its
+    hash for each fetched source URL in a directory, along with the hash
+    of the content last imported.
+    """
+    # Bytes read or written at a time when streaming content
+    chunk_size = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+
+    def _filename(self, url, ext):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, name + ext)
+
+    def get(self, url):
+        try:
+            with open(self._filename(url, '.json'), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url or not os.path.exists(self._filename(url, '.body')):
+            return None
+        return meta
+
+    def get_content(self, url):
+        with open(self._filename(url, '.body'), 'rb') as f:
+            return f.read()
+
+    def get_content_path(self, url):
+        return self._filename(url, '.body')
+
+    def get_content_hash(self, url):
+        content_hash = hashlib.sha256()
+        with open(self._filename(url, '.body'), 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                content_hash.update(chunk)
+        return content_hash.hexdigest()
+
+    def _write(self, filename, data, mode):
+        tmp = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
+        with open(tmp, mode) as f:
+            f.write(data)
+        os.replace(tmp, filename)
+
+    def set_meta(self, url, meta):
+        os.makedirs(self.path, exist_ok=True)
+        meta = dict(meta, url=url)
+        self._write(self._filename(url, '.json'), json.dumps(meta), 'w')
+
+    def set(self, url, meta, content):
+        os.makedirs(self.path, exist_ok=True)
+        self._write(self._filename(url, '.body'), content, 'wb')
+        self.set_meta(url, meta)
+
+    def set_stream(self, url, chunks):
+        """
+        Write the content from an iterable of chunks without holding it
+        in memory. Returns its hash; set_meta() must follow.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        filename = self._filename(url, '.body')
+        tmp = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
+        content_hash = hashlib.sha256()
+        with open(tmp, 'wb') as f:
+            for chunk in chunks:
+                content_hash.update(chunk)
+                f.write(chunk)
+        os.replace(tmp, filename)
+        return content_hash.hexdigest()
+
+
+class Fetcher(object):
+    """
+    Fetches URLs over a pooled session which retries failed requests
+    with exponential backoff. At most `per_host` requests are in flight
+    to any one host; submit() and map() run requests concurrently in a
+    pool of `max_workers` threads.
+
+    With a `cache_path`, get_source() makes conditional requests and
+    tells whether a source has changed since it was last imported.
+    `force` makes every source count as changed.
+    """
+    retry_statuses = (500, 502, 503, 504)
+
+    def __init__(self, max_workers=6, per_host=3, retries=5, backoff_factor=1,
+                 timeout=120, cache_path=None, force=False):
+        self.cache = FetchCache(cache_path) if cache_path else None
+        self.force = force
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self._session = None
+        self._executor = None
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Created on first use so that a requests_cache installed by the
+        # importer setup applies to it.
+        with self._lock:
+            if self._session is None:
+                retry = Retry(total=self.retries, backoff_factor=self.backoff_factor,
+                              status_forcelist=self.retry_statuses)
+                adapter = HTTPAdapter(pool_maxsize=self.max_workers, max_retries=retry)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers)
+            return self._executor
+
+    def _host_semaphore(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_semaphores[host]
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        session = self.session
+        with self._host_semaphore(url):
+            return session.get(url, **kwargs)
+
+    def get_json(self, url, **kwargs):
+        resp = self.get(url, **kwargs)
+        resp.raise_for_status()
+        return resp.json()
+
+    def get_source(self, url, stream=False, **kwargs):
+        """
+        Fetch url, sending the validators of the previous fetch. A 304
+        response is answered from the cache.
+
+        With `stream`, the content is written to the cache as it arrives
+        instead of being held in memory, and is read with Source.open().
+        """
+        stream = stream and self.cache is not None
+        meta = self.cache.get(url) if self.cache else None
+        headers = dict(kwargs.pop('headers', {}))
+        if meta:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        resp = self.get(url, headers=headers, stream=stream, **kwargs)
+
+        content = path = None
+        if resp.status_code == 304 and meta:
+            if stream:
+                path = self.cache.get_content_path(url)
+                content_hash = self.cache.get_content_hash(url)
+            else:
+                content = self.cache.get_content(url)
+        elif resp.status_code == 200:
+            if stream:
+                try:
+                    content_hash = self.cache.set_stream(
+                        url, resp.iter_content(self.cache.chunk_size))
+                finally:
+                    resp.close()
+                path = self.cache.get_content_path(url)
+            else:
+                content = resp.content
+        else:
+            return Source(url, resp.status_code, resp.content)
+
+        if content is not None:
+            content_hash = hashlib.sha256(content).hexdigest()
+        imported_hash = meta.get('imported_hash') if meta else None
+        source = Source(url, 200, content, content_hash,
+                        unchanged=not self.force and content_hash == imported_hash,
+                        path=path)
+        if self.cache:
+            new_meta = dict(
+                etag=resp.headers.get('ETag'),
+                last_modified=resp.headers.get('Last-Modified'),
+                hash=content_hash,
+                imported_hash=imported_hash,
+            )
+            if resp.status_code == 304:
+                # A 304 response need not repeat the validators
+                new_meta['etag'] = new_meta['etag'] or meta.get('etag')
+                new_meta['last_modified'] = new_meta['last_modified'] or meta.get('last_modified')
+                self.cache.set_meta(url, new_meta)
+            elif stream:
+                self.cache.set_meta(url, new_meta)
+            else:
+                # The validators of the previous content do not apply to
+                # the new one; without them the content hash tells
+                self.cache.set(url, new_meta, content)
+        return source
+
+    def reload_source(self, source):
+        """
+        Return a source kept without its content with the content read
+        back from the cache. Only sources which are unchanged since
+        they were last imported are guaranteed to be cached.
+        """
+        content = self.cache.get_content(source.url)
+        return Source(source.url, source.status_code, content, source.content_hash,
+                      source.unchanged)
+
+    def get_sources(self, urls, **kwargs):
+        futures = [self.submit(self.get_source, url, **kwargs) for url in urls]
+        return [future.result() for future in futures]
+
+    def mark_imported(self, sources):
+        """
+        Record the sources as successfully imported, so that the same
+        content counts as unchanged on the next fetch.
+        """
+        if not self.cache:
+            return
+        for source in sources:
+            meta = self.cache.get(source.url)
+            if meta and meta.get('hash') == source.content_hash:
+                meta['imported_hash'] = source.content_hash
+                self.cache.set_meta(source.url, meta)
+
+    def submit(self, func, *args, **kwargs):
+        return self.executor.submit(func, *args, **kwargs)
+
+    def map(self, urls, **kwargs):
+        """
+        Fetch the URLs concurrently. Returns the responses in the order
+        of the URLs.
+        """
+        futures = [self.submit(self.get, url, **kwargs) for url in urls]
+        return [future.result() for future in futures]
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            if self._session is not None:
+                self._session.close()
+                self._session = None
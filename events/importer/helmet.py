@@ -6,7 +6,6 @@ import json
 import re
 import dateutil.parser
 from datetime import datetime, timedelta
-import time
 from django.utils.html import strip_tags
 from .base import Importer, register_importer, recur_dict
 from events.models import Event, Keyword, DataSource, Organization, Place
@@ -142,6 +141,13 @@ def clean_text(text, strip_newlines=False):
     # remove consecutive whitespaces
     return re.sub(r'\s\s+', ' ', text, re.U).strip()
 
+
+def parse_local_time(dt_str):
+    # Times are in UTC+02:00 timezone
+    dt = LOCAL_TZ.localize(dateutil.parser.parse(dt_str), is_dst=None)
+    return dt.astimezone(pytz.utc)
+
+
 class APIBrokenError(Exception):
     pass
 
@@ -207,10 +213,7 @@ class HelmetImporter(Importer):
         return ext_props
 
     def _import_event(self, lang, event_el, events):
-        # Times are in UTC+02:00 timezone
-        to_utc = lambda dt: LOCAL_TZ.localize(
-            dt, is_dst=None).astimezone(pytz.utc)
-        dt_parse = lambda dt_str: to_utc(dateutil.parser.parse(dt_str))
+        dt_parse = parse_local_time
 
         start_time = dt_parse(event_el['EventStartDate'])
         end_time = dt_parse(event_el['EventEndDate'])
@@ -372,58 +375,100 @@ class HelmetImporter(Importer):
 
         return event
 
-    def _recur_fetch_paginated_url(self, url, lang, events):
-        for _ in range(0,5):
-            response = requests.get(url)
-            if response.status_code != 200:
-                self.logger.error("HelMet API reported HTTP %d" % response.status_code)
-                time.sleep(2)
-                continue
-            try:
-                root_doc = response.json()
-            except ValueError:
-                self.logger.error("HelMet API returned invalid JSON")
-                time.sleep(5)
-                continue
-            break
-        else:
-            self.logger.error("HelMet API broken again, giving up")
+    def _fetch_page(self, url):
+        try:
+            source = self.fetcher.get_source(url)
+        except requests.RequestException as e:
+            self.logger.error("HelMet API request failed: %s" % e)
+            raise APIBrokenError()
+        if source.status_code != 200:
+            self.logger.error("HelMet API reported HTTP %d" % source.status_code)
+            raise APIBrokenError()
+        try:
+            return source, source.json()
+        except ValueError:
+            self.logger.error("HelMet API returned invalid JSON")
             raise APIBrokenError()
 
-        documents = root_doc['value']
-        earliest_end_time = None
-        for doc in documents:
-            event = self._import_event(lang, doc, events)
-            if not earliest_end_time or event['end_time'] < earliest_end_time:
-                earliest_end_time = event['end_time']
-
-        now = datetime.now().replace(tzinfo=LOCAL_TZ)
+    @staticmethod
+    def _next_page_url(root_doc, now):
+        end_times = [parse_local_time(doc['EventEndDate']) for doc in root_doc['value']]
         # We check only 90 days backwards.
-        if earliest_end_time < now - timedelta(days=90):
-            return
+        if end_times and min(end_times) < now - timedelta(days=90):
+            return None
+        if 'odata.nextLink' not in root_doc:
+            return None
+        return '%s/api/opennc/v1/%s%s' % (
+            HELMET_BASE_URL,
+            root_doc['odata.nextLink'],
+            "&$format=json"
+        )
 
-        if 'odata.nextLink' in root_doc:
-            self._recur_fetch_paginated_url(
-                '%s/api/opennc/v1/%s%s' % (
-                    HELMET_BASE_URL,
-                    root_doc['odata.nextLink'],
-                    "&$format=json"
-                ), lang, events)
+    def _iter_pages(self, page_future, sources):
+        """
+        Yield the fetched pages and their event documents, following the
+        OData nextLinks until the events are more than 90 days old. The
+        next page is fetched while the documents of the current one are
+        being consumed, and only one page is kept at a time. The fetched
+        pages are appended to sources without their content.
+        """
+        now = datetime.now().replace(tzinfo=LOCAL_TZ)
+        while page_future is not None:
+            source, root_doc = page_future.result()
+            source = source.without_content()
+            sources.append(source)
+            next_url = self._next_page_url(root_doc, now)
+            page_future = None
+            if next_url:
+                page_future = self.fetcher.submit(self._fetch_page, next_url)
+            documents = root_doc['value']
+            del root_doc
+            yield source, documents
+            del source, documents
 
     def import_events(self):
         print("Importing HelMet events")
         events = recur_dict()
+        # The first pages of all languages are fetched right away, but the
+        # languages are processed in order, as the translations are
+        # matched to the Finnish events.
+        languages = []
+        sources = []
         for lang in self.supported_languages:
             helmet_lang_id = HELMET_LANGUAGES[lang]
             url = HELMET_API_URL.format(lang_code=helmet_lang_id, start_date='2014-01-01')
+            print("Fetching lang %s from URL %s" % (lang, url))
+            first_page = self.fetcher.submit(self._fetch_page, url)
+            languages.append((lang, self._iter_pages(first_page, sources)))
+
+        # The events of unchanged pages are parsed only once some page
+        # has changed, from the content in the fetch cache.
+        changed = False
+        skipped = []
+        for lang, pages in languages:
             print("Processing lang " + lang)
-            print("from URL " + url)
             try:
-                self._recur_fetch_paginated_url(url, lang, events)
+                for source, documents in pages:
+                    if source.unchanged and not changed:
+                        skipped.append((lang, source))
+                        continue
+                    changed = True
+                    for skipped_lang, skipped_source in skipped:
+                        skipped_source = self.fetcher.reload_source(skipped_source)
+                        for doc in skipped_source.json()['value']:
+                            self._import_event(skipped_lang, doc, events)
+                    skipped = []
+                    for doc in documents:
+                        self._import_event(lang, doc, events)
             except APIBrokenError:
+                self.logger.error("HelMet API broken again, giving up")
                 return
 
+        if not changed:
+            print("HelMet events unchanged")
+            return
+
         event_list = sorted(events.values(), key=lambda x: x['start_time'])
-        for event in event_list:
-            self.save_event(event)
+        self.save_events(event_list)
+        self.fetcher.mark_imported(sources)
         print("%d events processed" % len(events.values()))
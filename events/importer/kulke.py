@@ -2,7 +2,9 @@
 from __future__ import unicode_literals
 import os
 import re
+import copy
 import functools
+from collections import defaultdict
 from lxml import etree
 from modeltranslation.translator import translator
 import dateutil
@@ -11,12 +13,13 @@ from django.conf import settings
 from django.utils.timezone import get_default_timezone
 from django.core.validators import URLValidator
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError
+from django.db import transaction
 
 from .sync import ModelSyncher
 from .base import Importer, register_importer, recur_dict
 from .util import unicodetext, active_language
-from events.models import DataSource, Place, Event, Keyword, KeywordLabel, Organization, EventAggregate, EventAggregateMember
+from events.models import DataSource, Place, Event, Keyword, KeywordLabel, Organization, EventAggregate, EventAggregateMember, \
+    Offer, EventLink, mark_event_usage_changed
 from events.keywords import KeywordMatcher
 from events.translation_utils import expand_model_fields
 
@@ -414,137 +417,242 @@ class KulkeImporter(Importer):
                         )
                         group.remove(inner_key)
 
-    def _update_super_event(self, super_event):
-        events = super_event.get_children()
-        first_event = events.order_by('start_time').first()
-        super_event.start_time = first_event.start_time
-        super_event.has_start_time = first_event.has_start_time
-        last_event = events.order_by('-end_time').first()
-        super_event.end_time = last_event.end_time
-        super_event.has_end_time = last_event.has_end_time
-
-        # Functions which map related models into simple comparable values.
-        def simple(field):
-            return frozenset(map(lambda x: x.simple_value(), field.all()))
-        value_mappers = {
-            'offers': simple,
-            'external_links': simple
-        }
+    @transaction.atomic
+    def _update_super_events(self, super_events):
+        """
+        Derive the times, the common fields and the common keywords of
+        the recurring super events from their children. The children are
+        fetched once with their offers, links and keywords, and the
+        changes are written in bulk. Super events which already match
+        their children are left untouched.
+        """
+        super_events = dict((e.id, e) for e in super_events)
+        if not super_events:
+            return
+        children = defaultdict(list)
+        queryset = Event.objects.filter(super_event_id__in=super_events.keys())\
+            .prefetch_related('offers', 'external_links', 'keywords')
+        for event in queryset:
+            children[event.super_event_id].append(event)
+        through = Event.keywords.through
+        old_keywords = defaultdict(set)
+        for event_id, keyword_id in through.objects.filter(event_id__in=super_events.keys())\
+                .values_list('event_id', 'keyword_id'):
+            old_keywords[event_id].add(keyword_id)
+
+        # Related models which are copied as a whole when they have the
+        # same simple values in all the events
+        related_fields = ('offers', 'external_links')
         fieldnames = expand_model_fields(
-            super_event, [
+            Event(), [
                 'info_url', 'description', 'short_description', 'headline',
                 'secondary_headline', 'provider', 'publisher', 'location',
-                'location_extra_info', 'audience', 'data_source',
-                'image', 'offers', 'external_links'])
-
-        # The set of fields which have common values for all events.
-        common_fields = set(
-            f for f in fieldnames
-            if 1 == len(set(map(
-                    value_mappers.get(f, lambda x: x),
-                    (getattr(event, f) for event in events.all())))))
-
-        for fieldname in common_fields:
-            value = getattr(events.first(), fieldname)
-            if hasattr(value, 'all'):
-                manager = getattr(super_event, fieldname)
-                simple = False
-                if hasattr(value.first(), 'simple_value'):
-                    # Simple related models can be deleted and copied.
-                    manager.all().delete()
-                    simple = True
-                for m in value.all():
-                    if simple:
+                'location_extra_info', 'audience', 'data_source', 'image'])
+        # Compare foreign keys by their ids
+        fieldnames = [Event._meta.get_field(f).attname for f in fieldnames]
+        trans_fields = translator.get_options_for_model(Event).fields
+        translated_bases = {}
+        for field_name, lang_fields in trans_fields.items():
+            for lf in lang_fields:
+                translated_bases[lf.name] = field_name
+
+        def simple(related):
+            return frozenset(x.simple_value() for x in related)
+
+        old_related = dict((f, defaultdict(list)) for f in related_fields)
+        for fieldname, model in (('offers', Offer), ('external_links', EventLink)):
+            for m in model.objects.filter(event_id__in=super_events.keys()):
+                old_related[fieldname][m.event_id].append(m)
+
+        now = Event.now()
+        copies = dict((f, []) for f in related_fields)
+        replaced = dict((f, []) for f in related_fields)
+        keywords = []
+        keywords_replaced = []
+        keywords_touched = set()
+        places_changed = set()
+        for super_id, super_event in super_events.items():
+            events = children.get(super_id)
+            if not events:
+                continue
+            old_event = copy.copy(super_event)
+
+            # Like ordering by start_time and -end_time, NULLs are last
+            # and first, respectively
+            first_event = min(events, key=lambda e: (e.start_time is None, e.start_time or 0))
+            last_event = max(events, key=lambda e: (e.end_time is None, e.end_time or 0))
+            super_event.start_time = first_event.start_time
+            super_event.has_start_time = first_event.has_start_time
+            super_event.end_time = last_event.end_time
+            super_event.has_end_time = last_event.has_end_time
+            update_fields = set(['start_time', 'has_start_time', 'end_time', 'has_end_time'])
+
+            # The fields which have common values for all events
+            for fieldname in fieldnames:
+                values = set(getattr(event, fieldname) for event in events)
+                if len(values) == 1:
+                    setattr(super_event, fieldname, values.pop())
+                    update_fields.add(fieldname)
+            related_changed = False
+            for fieldname in related_fields:
+                values = set(simple(getattr(event, fieldname).all()) for event in events)
+                if len(values) == 1 and \
+                        values.pop() != simple(old_related[fieldname][super_id]):
+                    related_changed = True
+                    replaced[fieldname].append(super_id)
+                    for m in getattr(events[0], fieldname).all():
+                        m = copy.copy(m)
                         m.id = None
-                        m.event_id = super_event.id
-                        m.save()
-                    manager.add(m)
-            else:
-                setattr(super_event, fieldname, value)
-
-        for lang in self.languages.keys():
-            headline = getattr(
-                super_event, 'headline_{}'.format(lang)
-            )
-            secondary_headline = getattr(
-                super_event, 'secondary_headline_{}'.format(lang)
-            )
-            setattr(super_event, 'name_{}'.format(lang),
-                    make_event_name(headline, secondary_headline)
+                        m.event_id = super_id
+                        copies[fieldname].append(m)
+
+            for lang in self.languages.keys():
+                headline = getattr(
+                    super_event, 'headline_{}'.format(lang)
+                )
+                secondary_headline = getattr(
+                    super_event, 'secondary_headline_{}'.format(lang)
+                )
+                setattr(super_event, 'name_{}'.format(lang),
+                        make_event_name(headline, secondary_headline)
+                )
+                update_fields.add('name_{}'.format(lang))
+
+            # Gather common keywords present in *all* subevents
+            common_keywords = functools.reduce(
+                lambda x, y: x & y,
+                (set(k.id for k in event.keywords.all()) for event in events)
             )
+            keywords_changed = common_keywords != old_keywords[super_id]
+            if keywords_changed:
+                keywords_replaced.append(super_id)
+                keywords += [through(event_id=super_id, keyword_id=k) for k in common_keywords]
+
+            super_event.duration = super_event.calculate_duration()
+            update_fields.add('duration')
+            update_fields = set(f for f in update_fields
+                                if getattr(super_event, f) != getattr(old_event, f))
+            update_fields |= set(translated_bases[f] for f in update_fields
+                                 if f in translated_bases)
+            if not (update_fields or related_changed or keywords_changed):
+                continue
 
-        # Gather common keywords present in *all* subevents
-        common_keywords = functools.reduce(
-            lambda x, y: x & y,
-            (set(event.keywords.all()) for event in events.all())
-        )
-        super_event.keywords.clear()
-        for k in common_keywords:
-            super_event.keywords.add(k)
+            # Times and locations affect the usage of the keywords and
+            # places too
+            keywords_touched |= common_keywords | old_keywords[super_id]
+            places_changed.update([old_event.location_id, super_event.location_id])
 
-        super_event.save()
+            super_event.last_modified_time = now
+            update_fields.add('last_modified_time')
+            values = dict((f, getattr(super_event, f)) for f in update_fields)
+            # Write the untranslated columns as they are, like save() does
+            Event.objects.rewrite(False).filter(id=super_id).update(**values)
+
+        Offer.objects.filter(event_id__in=replaced['offers']).delete()
+        Offer.objects.bulk_create(copies['offers'])
+        EventLink.objects.filter(event_id__in=replaced['external_links']).delete()
+        EventLink.objects.bulk_create(copies['external_links'])
+        through.objects.filter(event_id__in=keywords_replaced).delete()
+        through.objects.bulk_create(keywords)
+
+        # Bulk writes do not send the signals which keep usage up to date
+        mark_event_usage_changed(Place, places_changed)
+        mark_event_usage_changed(Keyword, keywords_touched)
 
     def _save_recurring_superevents(self, recurring_groups):
-        groups = map(frozenset, recurring_groups.values())
-        aggregates = set()
-        for group in groups:
-            kulke_ids = set(map(make_kulke_id, group))
-            superevent_aggregates = EventAggregate.objects.filter(
-                members__event__id__in=kulke_ids
-            ).distinct()
-            cnt = superevent_aggregates.count()
-
-            if cnt > 1:
+        """
+        Link the recurring groups of events to their aggregates and super
+        events. All groups are resolved against the existing aggregates
+        at once and the changes are written in bulk, in one transaction.
+        Returns the aggregates of the groups.
+        """
+        groups = set(frozenset(map(make_kulke_id, group))
+                     for group in recurring_groups.values() if len(group) > 1)
+        all_ids = set().union(*groups)
+        existing_ids = set(Event.objects.filter(id__in=all_ids).values_list('id', flat=True))
+        member_aggregates = dict(EventAggregateMember.objects.filter(event_id__in=all_ids)
+                                 .values_list('event_id', 'event_aggregate_id'))
+
+        # New aggregates get negative placeholder ids until they are saved
+        new_aggregates = []
+        new_members = []
+        aggregate_events = {}
+        for group in sorted(groups, key=sorted):
+            aggregate_ids = set(member_aggregates[event_id] for event_id in group
+                                if event_id in member_aggregates)
+            if len(aggregate_ids) > 1:
                 print('Error: the superevent has an ambiguous aggregate group.')
-                print('Aggregate ids: {}, group: {}'.format(
-                    superevent_aggregates.values_list('id', flat=True), group))
+                print('Aggregate ids: {}, group: {}'.format(sorted(aggregate_ids), group))
                 continue
 
-            events = Event.objects.filter(id__in=kulke_ids)
-            if events.count() < 2:
+            event_ids = group & existing_ids
+            if len(event_ids) < 2:
                 continue
 
-            aggregate = None
-            if cnt == 0:
-                if len(group) == 1:
-                    # Do not create aggregates of only one.
+            if aggregate_ids:
+                aggregate_id = aggregate_ids.pop()
+            else:
+                new_aggregates.append(-len(new_aggregates) - 1)
+                aggregate_id = new_aggregates[-1]
+            for event_id in event_ids:
+                if event_id not in member_aggregates:
+                    member_aggregates[event_id] = aggregate_id
+                    new_members.append((aggregate_id, event_id))
+            aggregate_events.setdefault(aggregate_id, set()).update(event_ids)
+
+        with transaction.atomic():
+            ids = dict(zip(new_aggregates, self._reserve_ids(EventAggregate, len(new_aggregates))))
+            now = Event.now()
+            super_events = [Event(
+                publisher=self.organization,
+                is_recurring_super=True,
+                data_source=self.data_source,
+                id="linkedevents:agg-{}".format(ids[aggregate_id]),
+                created_time=now,
+                last_modified_time=now) for aggregate_id in new_aggregates]
+            if super_events:
+                self._prepare_tree_roots(Event, super_events)
+                Event.objects.bulk_create(super_events)
+            EventAggregate.objects.bulk_create([
+                EventAggregate(id=ids[aggregate_id], super_event_id=super_event.id)
+                for aggregate_id, super_event in zip(new_aggregates, super_events)])
+            EventAggregateMember.objects.bulk_create([
+                EventAggregateMember(event_aggregate_id=ids.get(aggregate_id, aggregate_id),
+                                     event_id=event_id)
+                for aggregate_id, event_id in new_members])
+
+            aggregate_events = dict((ids.get(aggregate_id, aggregate_id), event_ids)
+                                    for aggregate_id, event_ids in aggregate_events.items())
+            aggregates = EventAggregate.objects.filter(id__in=aggregate_events.keys())\
+                .select_related('super_event')
+
+            linked_ids = set().union(*aggregate_events.values())
+            parents = dict(Event.objects.filter(id__in=linked_ids)
+                           .values_list('id', 'super_event_id'))
+            changed_trees = set()
+            for aggregate in aggregates:
+                super_event_id = aggregate.super_event_id
+                moved = [event_id for event_id in aggregate_events[aggregate.id]
+                         if parents[event_id] != super_event_id]
+                if not moved:
                     continue
-                aggregate = EventAggregate()
-                aggregate.save()
-                super_event = Event(
-                    publisher=self.organization,
-                    is_recurring_super=True,
-                    data_source=DataSource.objects.get(pk='kulke'), # TODO
-                    id="linkedevents:agg-{}".format(aggregate.id))
-                super_event.save()
-                aggregate.super_event = super_event
-                aggregate.save()
-                for event in events:
-                    aggregate.members.add(
-                        EventAggregateMember(event=event))
-            elif cnt == 1:
-                aggregate = superevent_aggregates.first()
-                if len(group) == 1:
-                    events = Event.objects.get(
-                        pk=make_kulke_id(group.pop()))
-                    # The imported event is not part of an aggregate
-                    # but one was found it in the db. Remove the event
-                    # from the aggregate. This is the only case when
-                    # an event is removed from a recurring aggregate.
-                    aggregate.members.remove(events)
-                else:
-                    for event in events:
-                        try:
-                            aggregate.members.add(EventAggregateMember(event=event))
-                        except IntegrityError:
-                            # Ignore unique violations. They
-                            # ensure that no duplicate members are added.
-                            pass
-            for event in events:
-                event.super_event = aggregate.super_event
-                event.save()
-            aggregates.add(aggregate)
-        return aggregates
+                Event.objects.filter(id__in=moved).update(
+                    super_event_id=super_event_id, last_modified_time=now)
+                changed_trees.add(super_event_id)
+                changed_trees.update(parents[event_id] for event_id in moved)
+
+            # The sub events of both the new and the old parents changed
+            changed_trees.discard(None)
+            if changed_trees:
+                Event.objects.filter(id__in=changed_trees).update(last_modified_time=now)
+
+            # The bulk updates bypass MPTT, so the trees the events moved
+            # between are rebuilt from the parent links.
+            tree_id_attr = Event._mptt_meta.tree_id_attr
+            self._rebuild_trees(Event, Event.objects.filter(id__in=changed_trees)
+                                .values_list(tree_id_attr, flat=True))
+
+        return set(aggregates)
 
     def import_events(self):
         print("Importing Kulke events")
@@ -566,19 +674,13 @@ class KulkeImporter(Importer):
             make_kulke_id,
             SKIP_EVENTS_WITH_CATEGORY
         ))
-        for eid, event in events.items():
-            skip = False
-            for kw in event['keywords']:
-                if kw.id in filter_out_keywords:
-                    skip = True
-                    break
-            if not skip:
-                self.save_event(event)
+        self.save_events(
+            event for event in events.values()
+            if not any(kw.id in filter_out_keywords for kw in event['keywords']))
 
         self._verify_recurs(recurring_groups)
         aggregates = self._save_recurring_superevents(recurring_groups)
-        for agg in aggregates:
-            self._update_super_event(agg.super_event)
+        self._update_super_events([agg.super_event for agg in aggregates])
 
     def import_keywords(self):
         print("Importing Kulke categories as keywords")
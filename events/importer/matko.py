@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 import re
 import dateutil.parser
-import requests
 import requests_cache
 import pytz
 from django.db.models import Count
@@ -369,24 +368,31 @@ class MatkoImporter(Importer):
             organizers[oid]['phone'].update(organizer['phone'])
         return organizers
 
-    def items_from_url(self, url):
-        resp = requests.get(url)
+    def items_from_response(self, resp):
         assert resp.status_code == 200
         root = etree.fromstring(resp.content)
         return root.xpath('channel/item')
 
+    def items_from_url(self, url):
+        return self.items_from_response(self.fetcher.get(url))
+
     def import_events(self):
         print("Importing Matko events")
         events = recur_dict()
         keyword_matcher = KeywordMatcher()
-        for lang, url in MATKO_URLS['events'].items():
-            items = self.items_from_url(url)
+        feeds = list(MATKO_URLS['events'].items())
+        sources = self.fetcher.get_sources([url for lang, url in feeds])
+        if all(source.unchanged for source in sources):
+            print("Matko events unchanged")
+            return
+        for (lang, url), source in zip(feeds, sources):
+            items = self.items_from_response(source)
             for item in items:
                 self._import_event_from_feed(lang, item, events, keyword_matcher)
             organizers = self._import_organizers_from_events(events)
 
-        for event in events.values():
-            self.save_event(event)
+        self.save_events(events.values())
+        self.fetcher.mark_imported(sources)
         print("%d events processed" % len(events.values()))
 
     def _fetch_places(self):
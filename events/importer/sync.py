@@ -1,3 +1,6 @@
+from events.models import BaseModel
+
+
 class ModelSyncher(object):
     def __init__(self, queryset, generate_obj_id, delete_func=None):
         d = {}
@@ -39,3 +42,80 @@ class ModelSyncher(object):
                 deleted = True
             if deleted:
                 print("Deleting object %s" % obj)
+
+
+class BulkModelSyncher(object):
+    """
+    A ModelSyncher which loads only the object ids and, optionally, a
+    fingerprint column of the queryset instead of whole objects. Full
+    objects are fetched on demand with get() or get_many(), so callers
+    can skip the unchanged ones by comparing fingerprints first.
+
+    Objects are marked by their id. finish() removes the unmarked
+    objects with a single query: a DELETE, or if `delete_values` is
+    given, an UPDATE soft-deleting the objects not yet flagged
+    `deleted`. The soft-deleted objects get a new last_modified_time,
+    so that API clients and caches notice the change.
+    """
+    def __init__(self, queryset, id_field, fingerprint_field=None, delete_values=None):
+        self.queryset = queryset
+        self.id_field = id_field
+        self.fingerprint_field = fingerprint_field
+        self.delete_values = delete_values
+        self.found = set()
+
+        fields = ['pk', id_field]
+        if fingerprint_field:
+            fields.append(fingerprint_field)
+        # obj_id -> (pk, fingerprint)
+        self.rows = {}
+        for row in queryset.values_list(*fields):
+            fingerprint = row[2] if fingerprint_field else None
+            self.rows[str(row[1])] = (row[0], fingerprint)
+
+    def __contains__(self, obj_id):
+        return obj_id in self.rows
+
+    def get_fingerprint(self, obj_id):
+        row = self.rows.get(obj_id)
+        return row[1] if row else None
+
+    def get(self, obj_id):
+        row = self.rows.get(obj_id)
+        if row is None:
+            return None
+        return self.queryset.get(pk=row[0])
+
+    def get_many(self, obj_ids):
+        """
+        Return a dict of the existing objects with the given ids, keyed
+        by id.
+        """
+        pks = [self.rows[obj_id][0] for obj_id in obj_ids if obj_id in self.rows]
+        if not pks:
+            return {}
+        objs = self.queryset.filter(pk__in=pks)
+        return dict((str(getattr(obj, self.id_field)), obj) for obj in objs)
+
+    def mark(self, obj_id):
+        if obj_id in self.found:
+            raise Exception("Object %s already marked" % obj_id)
+        self.found.add(obj_id)
+
+    def finish(self):
+        delete_pks = [pk for obj_id, (pk, fingerprint) in self.rows.items()
+                      if obj_id not in self.found]
+        if len(delete_pks) > 5 and len(delete_pks) > len(self.rows) * 0.2:
+            raise Exception("Attempting to delete more than 20% of total items")
+        if not delete_pks:
+            return 0
+        queryset = self.queryset.model._default_manager.filter(pk__in=delete_pks)
+        if self.delete_values:
+            values = dict(self.delete_values, last_modified_time=BaseModel.now())
+            count = queryset.exclude(deleted=True).update(**values)
+        else:
+            count = queryset.count()
+            queryset.delete()
+        if count:
+            print("Deleted %d objects" % count)
+        return count
@@ -1,27 +1,24 @@
 # -*- coding: utf-8 -*-
 import re
-import requests
 import requests_cache
 
 from django import db
-from django.conf import settings
-from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.geos import Polygon
 from django.contrib.gis.gdal import SpatialReference, CoordTransform
 from django.utils.translation import activate, get_language
+from modeltranslation.translator import translator
 
 from events.models import *
-from .sync import ModelSyncher
-from .base import Importer, register_importer
+from .sync import BulkModelSyncher
+from .base import Importer, register_importer, transform_positions
+from .util import import_fingerprint
 
 URL_BASE = 'http://www.hel.fi/palvelukarttaws/rest/v3/'
 GK25_SRID = 3879
 
-def mark_deleted(obj):
-    if obj.deleted:
-        return False
-    obj.deleted = True
-    obj.save(update_fields=['deleted'])
-    return True
+# Clearing the fingerprint makes a place which comes back to the source
+# compare as changed, so that it gets undeleted.
+DELETED_VALUES = dict(deleted=True, import_fingerprint=None)
 
 
 @register_importer
@@ -51,14 +48,17 @@ class TprekImporter(Importer):
         text = text.strip()
         return text
 
-    def pk_get(self, resource_name, res_id=None):
+    def pk_get_source(self, resource_name, res_id=None):
         url = "%s%s/" % (URL_BASE, resource_name)
         if res_id != None:
             url = "%s%s/" % (url, res_id)
         print("Fetching URL %s" % url)
-        resp = requests.get(url)
-        assert resp.status_code == 200
-        return resp.json()
+        source = self.fetcher.get_source(url)
+        assert source.status_code == 200
+        return source
+
+    def pk_get(self, resource_name, res_id=None):
+        return self.pk_get_source(resource_name, res_id).json()
 
     def _save_translated_field(self, obj, obj_field_name, info,
                                info_field_name, max_length=None):
@@ -84,20 +84,7 @@ class TprekImporter(Importer):
             obj._changed_fields.append(obj_key)
             obj._changed = True
 
-    @db.transaction.atomic
-    def _import_unit(self, syncher, info):
-        obj = syncher.get(str(info['id']))
-        obj_id = 'tprek:%s' % str(info['id'])
-        if not obj:
-            obj = Place(data_source=self.data_source, origin_id=info['id'])
-            obj._changed = True
-            obj._created = True
-            obj.id = obj_id
-        else:
-            assert obj.id == obj_id
-            obj._created = False
-        obj._changed_fields = []
-
+    def _update_unit(self, obj, info, position):
         self._save_translated_field(obj, 'name', info, 'name')
         self._save_translated_field(obj, 'description', info, 'desc')
         self._save_translated_field(obj, 'street_address', info, 'street_address')
@@ -123,24 +110,6 @@ class TprekImporter(Importer):
                 obj._changed_fields.append(obj_field)
                 obj._changed = True
 
-        n = info.get('latitude', 0)
-        e = info.get('longitude', 0)
-        position = None
-        if n and e:
-            p = Point(e, n, srid=4326) # GPS coordinate system
-            if p.within(self.bounding_box):
-                if self.target_srid != 4326:
-                    p.transform(self.gps_to_target_ct)
-                position = p
-            else:
-                print("Invalid coordinates (%f, %f) for %s" % (n, e, obj))
-
-        if position and obj.position:
-            # If the distance is less than 10cm, assume the location
-            # hasn't changed.
-            assert obj.position.srid == settings.PROJECTION_SRID
-            if position.distance(obj.position) < 0.10:
-                position = obj.position
         if position != obj.position:
             obj._changed = True
             obj._changed_fields.append('position')
@@ -153,33 +122,119 @@ class TprekImporter(Importer):
 
         if obj.deleted:
             obj.deleted = False
-            obj._changed_fields.append('undeleted')
+            obj._changed_fields.append('deleted')
             obj._changed = True
 
-        if obj._changed:
+    def _update_values(self, obj, translated_bases):
+        """
+        Return the column values to write for the changed fields of obj.
+        The untranslated columns are written as they are, like save()
+        does, and the fields which Place does not have are left out.
+        """
+        field_names = set(obj._changed_fields)
+        field_names |= set(translated_bases[f] for f in obj._changed_fields
+                           if f in translated_bases)
+        field_names |= set(['last_modified_time', 'import_fingerprint'])
+        concrete_fields = dict((f.name, f) for f in Place._meta.concrete_fields)
+        values = {}
+        for name in field_names:
+            if name in concrete_fields:
+                attname = concrete_fields[name].attname
+                values[attname] = getattr(obj, attname)
+        return values
+
+    def _import_unit_chunk(self, syncher, chunk):
+        existing = syncher.get_many([str(info['id']) for info, fingerprint in chunk])
+        old_positions = []
+        coords = []
+        for info, fingerprint in chunk:
+            obj = existing.get(str(info['id']))
+            old_positions.append(obj.position if obj else None)
+            coords.append((info.get('longitude', 0), info.get('latitude', 0)))
+        positions, outside = transform_positions(coords, old_positions, self.target_srid)
+        for idx in outside:
+            info = chunk[idx][0]
+            print("Invalid coordinates (%f, %f) for unit %s" % (
+                info['latitude'], info['longitude'], info['id']))
+
+        trans_fields = translator.get_options_for_model(Place).fields
+        translated_bases = {}
+        for field_name, lang_fields in trans_fields.items():
+            for lf in lang_fields:
+                translated_bases[lf.name] = field_name
+
+        now = BaseModel.now()
+        created = []
+        for (info, fingerprint), position in zip(chunk, positions):
+            origin_id = str(info['id'])
+            obj_id = 'tprek:%s' % origin_id
+            obj = existing.get(origin_id)
+            if not obj:
+                obj = Place(data_source=self.data_source, origin_id=origin_id)
+                obj._changed = True
+                obj._created = True
+                obj.id = obj_id
+            else:
+                assert obj.id == obj_id
+                obj._changed = False
+                obj._created = False
+            obj._changed_fields = []
+
+            self._update_unit(obj, info, position)
+            obj.import_fingerprint = fingerprint
+
             if obj._created:
-                verb = "created"
+                print("%s created" % obj)
+                obj.created_time = now
+                obj.last_modified_time = now
+                created.append(obj)
+            elif obj._changed:
+                print("%s changed (fields: %s)" % (obj, ', '.join(obj._changed_fields)))
+                obj.last_modified_time = now
+                Place.objects.rewrite(False).filter(pk=obj.pk).update(
+                    **self._update_values(obj, translated_bases))
             else:
-                verb = "changed (fields: %s)" % ', '.join(obj._changed_fields)
-            print("%s %s" % (obj, verb))
-            obj.save()
+                Place.objects.filter(pk=obj.pk).update(import_fingerprint=fingerprint)
 
-        syncher.mark(obj)
+        if created:
+            self._prepare_tree_roots(Place, created)
+            Place.objects.bulk_create(created)
 
     def import_places(self):
         if self.options['cached']:
             requests_cache.install_cache('tprek')
 
         queryset = Place.objects.filter(data_source=self.data_source)
+        source = None
         if self.options.get('single', None):
             obj_id = self.options['single']
             obj_list = [self.pk_get('unit', obj_id)]
             queryset = queryset.filter(id=obj_id)
         else:
-            obj_list = self.pk_get('unit')
+            source = self.pk_get_source('unit')
+            if source.unchanged:
+                print("TPREK units unchanged")
+                return
+            obj_list = source.json()
+
+        syncher = BulkModelSyncher(queryset, 'origin_id', fingerprint_field='import_fingerprint',
+                                   delete_values=DELETED_VALUES)
+        infos = []
+        fingerprints = []
+        for info in obj_list:
+            origin_id = str(info['id'])
+            fingerprint = import_fingerprint(info)
+            syncher.mark(origin_id)
+            if not self.options.get('force') and syncher.get_fingerprint(origin_id) == fingerprint:
+                continue
+            infos.append(info)
+            fingerprints.append(fingerprint)
 
-        syncher = ModelSyncher(queryset, lambda obj: obj.origin_id, delete_func=mark_deleted)
-        for idx, info in enumerate(obj_list):
-            self._import_unit(syncher, info)
+        units = list(zip(infos, fingerprints))
+        for start in range(0, len(units), self.save_chunk_size):
+            with db.transaction.atomic():
+                self._import_unit_chunk(syncher, units[start:start + self.save_chunk_size])
 
         syncher.finish()
+        if source:
+            self.fetcher.mark_imported([source])
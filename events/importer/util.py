@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import re
+import json
+import hashlib
+import datetime
 from lxml import etree
+from django.db import models
 from django.utils.translation.trans_real import activate, deactivate
 
 def clean_text(text):
@@ -43,3 +47,34 @@ class active_language:
 
     def __exit__(self, type, value, traceback):
         deactivate()
+
+
+# Bump when the normalization below or the way the importers use the
+# fingerprints changes, so that every record is compared again.
+IMPORT_FINGERPRINT_VERSION = 1
+
+
+def _normalize_for_fingerprint(value):
+    if isinstance(value, dict):
+        return sorted((str(k), _normalize_for_fingerprint(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_normalize_for_fingerprint(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted((_normalize_for_fingerprint(v) for v in value), key=json.dumps)
+    if isinstance(value, models.Model):
+        return '%s:%s' % (value._meta.db_table, value.pk)
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    # Other values are compared by their representation
+    return repr(value)
+
+
+def import_fingerprint(info):
+    """
+    Return a stable hash of an importer info dict, used to skip the
+    records which are unchanged since the previous import.
+    """
+    data = json.dumps([IMPORT_FINGERPRINT_VERSION, _normalize_for_fingerprint(info)])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
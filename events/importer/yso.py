@@ -1,26 +1,92 @@
 # -*- coding: utf-8 -*-
-import requests
+import os
+from collections import defaultdict
+
 import requests_cache
 
 import rdflib
 from rdflib import URIRef
 from rdflib import RDF
-from rdflib.namespace import FOAF, SKOS, OWL
+from rdflib.namespace import FOAF, SKOS, OWL, RDFS
+from rdflib.store import Store
+
+from django.conf import settings
+from django.db import transaction
 
-from events.models import Keyword, KeywordLabel, DataSource, BaseModel, Language, Organization
+from events.keywords import KeywordMatcher
+from events.models import Keyword, KeywordLabel, DataSource, BaseModel, Organization
 
-from sys import stdout
-from .util import active_language
-from .sync import ModelSyncher
 from .base import Importer, register_importer
 
 yso = rdflib.Namespace('http://www.yso.fi/onto/yso/')
 URL = 'http://finto.fi/rest/v1/yso/data'
+AGGREGATE_SCHEME = URIRef(yso + 'aggregateconceptscheme')
+
+
+def label_language(language):
+    if language == 'se':
+        # YSO doesn't contain se, assume an error.
+        return 'sv'
+    return language
+
+
+class ConceptStore(Store):
+    """
+    An rdflib store which keeps only the facts the importer needs about
+    each concept instead of the triples themselves, so that parsing the
+    whole ontology needs little memory.
+    """
+    # The turtle parser refuses stores which are not formula aware
+    formula_aware = True
+
+    def __init__(self):
+        super(ConceptStore, self).__init__()
+        self.concept_subjects = set()
+        self.pref_labels = defaultdict(dict)
+        self.rdfs_labels = defaultdict(dict)
+        self.alt_labels = defaultdict(set)
+        self.deprecated = set()
+        self.aggregates = set()
+
+    def add(self, triple, context, quoted=False):
+        subject, predicate, obj = triple
+        subject = str(subject)
+        if predicate == RDF.type:
+            if obj == SKOS.Concept:
+                self.concept_subjects.add(subject)
+        elif predicate == SKOS.prefLabel:
+            self.pref_labels[subject][obj.language] = str(obj)
+        elif predicate == RDFS.label:
+            self.rdfs_labels[subject][obj.language] = str(obj)
+        elif predicate == SKOS.altLabel:
+            if obj.language is not None:
+                self.alt_labels[subject].add((str(obj), label_language(obj.language)))
+        elif predicate == OWL.deprecated:
+            self.deprecated.add(subject)
+        elif predicate == SKOS.inScheme:
+            if obj == AGGREGATE_SCHEME:
+                self.aggregates.add(subject)
+
+    def __len__(self, context=None):
+        return 0
+
+    def get_concepts(self, make_id):
+        """
+        Return the collected facts as a dict of concepts keyed by
+        make_id(subject).
+        """
+        concepts = {}
+        for subject in self.concept_subjects:
+            # Like Graph.preferredLabel(), fall back to rdfs:label
+            names = self.pref_labels.get(subject) or self.rdfs_labels.get(subject, {})
+            concepts[make_id(subject)] = dict(
+                names=dict(names),
+                alt_labels=set(self.alt_labels.get(subject, ())),
+                aggregate=subject in self.aggregates,
+                deprecated=subject in self.deprecated,
+            )
+        return concepts
 
-def is_deprecated(graph, subject):
-    return (subject, OWL.deprecated, None) in graph
-def is_aggregate_concept(graph, subject):
-    return (subject, SKOS.inScheme, rdflib.term.URIRef(yso+'aggregateconceptscheme')) in graph
 
 @register_importer
 class YsoImporter(Importer):
@@ -28,7 +94,9 @@ class YsoImporter(Importer):
     supported_languages = ['fi', 'sv', 'en']
 
     def setup(self):
-        requests_cache.install_cache('yso')
+        # The fetcher revalidates the data with Finto by itself
+        if self.options['cached']:
+            requests_cache.install_cache('yso')
         defaults = dict(
             name='Yleinen suomalainen ontologia')
         self.data_source, _ = DataSource.objects.get_or_create(
@@ -44,159 +112,164 @@ class YsoImporter(Importer):
 
     def import_keywords(self):
         print("Importing YSO keywords")
-        graph = self.load_graph_into_memory(URL)
-        self.save_keywords(graph)
+        # A local N-Triples dump in the import data directory is streamed
+        # if one exists, otherwise the turtle data is fetched from Finto.
+        path = os.path.join(settings.IMPORT_FILE_PATH, 'yso', 'yso.nt')
+        source = None
+        if os.path.exists(path):
+            if self.verbosity >= 2:
+                print("Parsing %s" % path)
+            with open(path, 'rb') as f:
+                store = self.parse_concepts(file=f, format='nt')
+        else:
+            if self.verbosity >= 2:
+                print("Fetching %s" % URL)
+            # The dump is written to the fetch cache as it arrives and
+            # parsed from there
+            source = self.fetcher.get_source(URL, stream=True)
+            assert source.status_code == 200
+            if source.unchanged:
+                print("YSO keywords unchanged")
+                return
+            if self.verbosity >= 2:
+                print("Parsing RDF")
+            with source.open() as f:
+                store = self.parse_concepts(file=f, format='turtle')
 
-    def load_graph_into_memory(self, url):
-        if self.verbosity >= 2:
-            print("Fetching %s" % url)
-        resp = requests.get(url)
-        assert resp.status_code == 200
-        resp.encoding = 'UTF-8'
-        graph = rdflib.Graph()
-        if self.verbosity >= 2:
-            print("Parsing RDF")
-        graph.parse(data=resp.text, format='turtle')
-        return graph
+        self.save_keywords(store.get_concepts(self.yso_id))
+        if source:
+            self.fetcher.mark_imported([source])
+
+    def parse_concepts(self, **kwargs):
+        """
+        Parse the ontology into a ConceptStore. The arguments are passed
+        to Graph.parse().
+        """
+        store = ConceptStore()
+        rdflib.Graph(store=store).parse(**kwargs)
+        return store
+
+    @staticmethod
+    def new_concept():
+        return dict(names={}, alt_labels=set(), aggregate=False, deprecated=False)
 
-    def save_keywords(self, graph):
+    def save_keywords(self, concepts):
+        """
+        Synchronize the YSO keywords, their labels and the label
+        relations with the parsed concepts. Only the differences are
+        written. Keywords are never deleted, so that events keep their
+        keywords; concepts which are deprecated or gone from YSO are
+        marked deprecated instead.
+        """
         if self.verbosity >= 2:
             print("Saving data")
-        data_source = DataSource.objects.get(pk='yso')
+        with transaction.atomic():
+            self.save_keyword_labels(concepts)
+            self.save_keywords_in_bulk(concepts)
+            self.save_keyword_label_relationships_in_bulk(concepts)
+        KeywordMatcher.invalidate_snapshot()
 
-        assert not Keyword.objects.filter(data_source=self.data_source).exists()
-        bulk_mode = True
-        if not bulk_mode:
-            delete_func = lambda obj: obj.delete()
-            queryset = KeywordLabel.objects.filter(data_source=self.data_source)
-            label_syncher = ModelSyncher(
-                queryset, lambda obj: (obj.name, obj.language_id), delete_func=delete_func)
+    def save_keyword_labels(self, concepts):
+        self.label_ids = {}
+        for label_id, name, language in KeywordLabel.objects.values_list('id', 'name', 'language'):
+            self.label_ids[(name, language)] = label_id
 
-        keyword_labels = {}
         labels_to_create = set()
-        for subject, label in graph.subject_objects(SKOS.altLabel):
-            if (subject, RDF.type, SKOS.Concept) in graph:
-                yid = self.yso_id(subject)
-                if bulk_mode:
-                    if label.language is not None:
-                        language = label.language
-                        if label.language == 'se':
-                            # YSO doesn't contain se, assume an error.
-                            language = 'sv'
-                        labels_to_create.add((str(label), language))
-                        keyword_labels.setdefault(yid, []).append(label)
-                else:
-                    label = self.save_alt_label(label_syncher, graph, label, data_source)
-                    if label:
-                        keyword_labels.setdefault(yid, []).append(label)
-
-        if bulk_mode:
-            KeywordLabel.objects.bulk_create([
-                KeywordLabel(
-                    name=name,
-                    language_id=language
-                ) for name, language in labels_to_create])
-        else:
-            label_syncher.finish()
-
-        if bulk_mode:
-            # self.save_labels_in_bulk(graph, data_source)
-            self.save_keywords_in_bulk(graph, data_source)
-            self.save_keyword_label_relationships_in_bulk(keyword_labels)
-
-        if not bulk_mode:
-            queryset = Keyword.objects.filter(data_source=self.data_source)
-            syncher = ModelSyncher(
-                queryset, lambda obj: obj.url, delete_func=delete_func)
-            save_set=set()
-            for subject in graph.subjects(RDF.type, SKOS.Concept):
-                self.save_keyword(syncher, graph, subject, data_source, keyword_labels, save_set)
-            syncher.finish()
-
-    def save_keyword_label_relationships_in_bulk(self, keyword_labels):
-        yids = Keyword.objects.all().values_list('id', flat=True)
-        labels = KeywordLabel.objects.all().values('id', 'name', 'language')
-        label_id_from_name_and_language = {
-            (l['name'], l['language']): l['id'] for l in labels
-        }
-        KeywordAltLabels = Keyword.alt_labels.through
-        relations_to_create = []
-        for yid, url_labels in keyword_labels.items():
-            if yid not in yids:
-                continue
-            for label in url_labels:
-                params = dict(
-                    keyword_id = yid,
-                    keywordlabel_id = (
-                        label_id_from_name_and_language.get(
-                            (str(label), label.language))))
-                if params['keyword_id'] and params['keywordlabel_id']:
-                    relations_to_create.append(
-                        KeywordAltLabels(**params))
-        KeywordAltLabels.objects.bulk_create(relations_to_create)
+        for concept in concepts.values():
+            for name, language in concept['alt_labels']:
+                if language in self.languages and (name, language) not in self.label_ids:
+                    labels_to_create.add((name, language))
+        if not labels_to_create:
+            return
 
-    def yso_id(self, subject):
-        return ':'.join(subject.split('/')[-2:])
+        KeywordLabel.objects.bulk_create([
+            KeywordLabel(name=name, language_id=language)
+            for name, language in labels_to_create])
+        print("%d keyword labels created" % len(labels_to_create))
+        for label_id, name, language in KeywordLabel.objects.values_list('id', 'name', 'language'):
+            self.label_ids[(name, language)] = label_id
+
+    def save_keywords_in_bulk(self, concepts):
+        # Default language first
+        name_fields = ['name_%s' % lang for lang, _ in settings.LANGUAGES
+                       if lang in self.languages]
+        existing = {}
+        queryset = Keyword.objects.filter(data_source=self.data_source)
+        for row in queryset.values_list('id', 'aggregate', 'deprecated', *name_fields):
+            existing[row[0]] = row[1:]
 
-    def save_keywords_in_bulk(self, graph, data_source):
+        now = BaseModel.now()
         keywords = []
-        for subject in graph.subjects(RDF.type, SKOS.Concept):
-            if is_deprecated(graph, subject):
-                continue
-            keyword = Keyword(data_source=data_source)
-            keyword.aggregate = is_aggregate_concept(graph, subject)
-            keyword.id = self.yso_id(subject)
-            keyword.created_time = BaseModel.now()
-            keyword.last_modified_time = BaseModel.now()
-            for _, literal in graph.preferredLabel(subject):
-                with active_language(literal.language):
-                    keyword.name = str(literal)
-            keywords.append(keyword)
+        updated = 0
+        for yid, concept in concepts.items():
+            names = [concept['names'].get(f[len('name_'):]) for f in name_fields]
+            values = tuple([concept['aggregate'], concept['deprecated']] + names)
+            if yid not in existing:
+                if concept['deprecated']:
+                    continue
+                keyword = Keyword(id=yid, data_source=self.data_source)
+                keyword.aggregate = concept['aggregate']
+                for field_name, name in zip(name_fields, names):
+                    setattr(keyword, field_name, name)
+                keyword.created_time = now
+                keyword.last_modified_time = now
+                keywords.append(keyword)
+            elif existing[yid] != values:
+                update = dict(zip(name_fields, names))
+                # The untranslated name column follows the default language
+                update['name'] = names[0] or next((n for n in names if n), '')
+                update.update(aggregate=concept['aggregate'],
+                              deprecated=concept['deprecated'],
+                              last_modified_time=now)
+                Keyword.objects.rewrite(False).filter(id=yid).update(**update)
+                updated += 1
         Keyword.objects.bulk_create(keywords, batch_size=1000)
 
-    def save_alt_label(self, syncher, graph, label, data_source):
-        label_text = str(label)
-        if label.language is None:
-            print('Error:', str(label), 'has no language')
-            return None
-        label_object = syncher.get((label_text, str(label.language)))
-        if label_object is None:
-            language = Language.objects.get(id=label.language)
-            label_object = KeywordLabel(
-                name=label_text, language=language, data_source=data_source)
-            label_object._changed = True
-            label_object._created = True
-        else:
-            label_object._created = False
-        if label_object._created:
-            # Since there are duplicates, only save & mark them once.
-            label_object.save()
-
-        if not getattr(label_object, '_found', False):
-            syncher.mark(label_object)
-        return label_object
-
-    def save_keyword(self, syncher, graph, subject, data_source, keyword_labels, save_set):
-        keyword = syncher.get(subject)
-        if not keyword:
-            keyword = Keyword(
-                data_source=self.data_source, url=subject)
-            keyword._changed = True
-            keyword._created = True
-        else:
-            keyword._created = False
+        gone = [yid for yid, values in existing.items()
+                if yid not in concepts and not values[1]]
+        if gone:
+            queryset.filter(id__in=gone).update(deprecated=True, last_modified_time=now)
+        print("%d keywords created, %d changed, %d deprecated as missing" % (
+            len(keywords), updated, len(gone)))
 
-        for _, literal in graph.preferredLabel(subject):
-            with active_language(literal.language):
-                if keyword.name != str(literal):
-                    keyword.name = str(literal)
-                    keyword._changed = True
+    def save_keyword_label_relationships_in_bulk(self, concepts):
+        KeywordAltLabels = Keyword.alt_labels.through
+        yids = set(Keyword.objects.filter(data_source=self.data_source)
+                   .values_list('id', flat=True))
+        wanted = set()
+        for yid, concept in concepts.items():
+            if yid not in yids or concept['deprecated']:
+                continue
+            for label in concept['alt_labels']:
+                label_id = self.label_ids.get(label)
+                if label_id:
+                    wanted.add((yid, label_id))
 
-        if keyword._changed:
-            keyword.save()
+        to_delete = []
+        existing = set()
+        changed = set()
+        relations = KeywordAltLabels.objects.filter(keyword__data_source=self.data_source)
+        for rel_id, yid, label_id in relations.values_list('id', 'keyword_id', 'keywordlabel_id'):
+            concept = concepts.get(yid)
+            if concept is None or concept['deprecated']:
+                # Deprecated keywords keep their labels
+                continue
+            if (yid, label_id) in wanted:
+                existing.add((yid, label_id))
+            else:
+                to_delete.append(rel_id)
+                changed.add(yid)
 
-        keyword.alt_labels.add(keyword_labels.get(str(subject), []))
+        added = wanted - existing
+        changed.update(yid for yid, label_id in added)
+        if to_delete:
+            KeywordAltLabels.objects.filter(id__in=to_delete).delete()
+        KeywordAltLabels.objects.bulk_create([
+            KeywordAltLabels(keyword_id=yid, keywordlabel_id=label_id)
+            for yid, label_id in added])
+        # The alt labels are served with the keywords
+        if changed:
+            Keyword.objects.filter(id__in=changed).update(last_modified_time=BaseModel.now())
 
-        if not getattr(keyword, '_found', False):
-            syncher.mark(keyword)
-        return keyword
+    def yso_id(self, subject):
+        return ':'.join(subject.split('/')[-2:])
@@ -1,13 +1,119 @@
+import os
 import re
+import pickle
+from bisect import bisect_left
+from django.conf import settings
+from django.db.models import Count, Max
 from events.models import Keyword, KeywordLabel, DataSource
 from difflib import get_close_matches
 
 ENDING_PARENTHESIS_PATTERN = r' \([^)]+\)$'
+WORD_SPLIT_PATTERN = re.compile(r'\s+')
+
+# Texts which are known to match badly as such
+TEXT_REPLACEMENTS = {
+    'kokous': 'kokoukset',
+    'kuntoilu': 'kuntoliikunta',
+    'samba': 'sambat',
+}
+
+# Bump when the snapshotted index changes
+SNAPSHOT_VERSION = 3
+SNAPSHOT_FILENAME = 'keyword_matcher.pickle'
+
 
 class KeywordMatcher(object):
-    def __init__(self):
+    """
+    Matches free text to keywords by their Finnish labels and YSO
+    preferred names.
+
+    The labels are indexed once on construction: a dict for exact
+    lookups and a sorted list for prefix lookups. The matched Keyword
+    objects are loaded up front and the results are memoized per text,
+    so matching does not touch the database.
+
+    The index is stored in a snapshot file under IMPORT_CACHE_PATH and
+    reused as long as the keyword tables look unchanged. The YSO importer
+    also removes the snapshot whenever it saves keywords; other in-place
+    label edits must call invalidate_snapshot().
+    """
+    def __init__(self, snapshot_path=None):
+        self.results = {}
+        if snapshot_path is None:
+            snapshot_path = self.default_snapshot_path()
+        fingerprint = self.snapshot_fingerprint()
+        if not self.load_snapshot(snapshot_path, fingerprint):
+            self.build_index()
+            self.save_snapshot(snapshot_path, fingerprint)
+        if not self.skip:
+            print('Initialized', len(self.labels), 'keyword keys')
+
+    @staticmethod
+    def default_snapshot_path():
+        return os.path.join(settings.IMPORT_CACHE_PATH, SNAPSHOT_FILENAME)
+
+    @classmethod
+    def invalidate_snapshot(cls, snapshot_path=None):
+        if snapshot_path is None:
+            snapshot_path = cls.default_snapshot_path()
+        try:
+            os.remove(snapshot_path)
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def snapshot_fingerprint(cls):
+        """
+        Return a value which changes whenever keywords, labels or their
+        relations are added or removed, or keywords are edited. Labels
+        have no modification times, so editing them in place relies on
+        invalidate_snapshot().
+        """
+        through = Keyword.alt_labels.through
+        return (
+            tuple(sorted(Keyword.objects.aggregate(
+                count=Count('id'), modified=Max('last_modified_time')).items())),
+            tuple(sorted(KeywordLabel.objects.aggregate(
+                count=Count('id'), max_id=Max('id')).items())),
+            tuple(sorted(through.objects.aggregate(
+                count=Count('id'), max_id=Max('id')).items())),
+            DataSource.objects.filter(pk='yso').exists(),
+        )
+
+    def load_snapshot(self, path, fingerprint):
+        try:
+            with open(path, 'rb') as f:
+                version, snapshot_fingerprint, state = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            # A broken snapshot is simply rebuilt
+            print('Ignoring keyword matcher snapshot:', e)
+            return False
+        if version != SNAPSHOT_VERSION or snapshot_fingerprint != fingerprint:
+            return False
+        self.__dict__.update(state)
+        return True
+
+    def save_snapshot(self, path, fingerprint):
+        state = dict(
+            name_to_keyword_ids=self.name_to_keyword_ids,
+            keywords=self.keywords,
+            labels=self.labels,
+            skip=self.skip,
+        )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((SNAPSHOT_VERSION, fingerprint, state), f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def build_index(self):
         label_to_keyword_ids = {}
         self.name_to_keyword_ids = {}
+        self.keywords = {}
+        self.labels = []
         for label_id, keyword_id in Keyword.alt_labels.through.objects.all().values_list(
             'keywordlabel_id', 'keyword_id'):
             label_to_keyword_ids.setdefault(label_id, set()).add(keyword_id)
@@ -21,91 +127,110 @@ class KeywordMatcher(object):
             print('No YSO keyword data source')
             self.skip = True
             return
-        for kid, preflabel in Keyword.objects.filter(data_source=yso_source).values_list(
-            'id', 'name_fi'):
+        yso_keywords = Keyword.objects.filter(data_source=yso_source, deprecated=False)
+        for kid, preflabel in yso_keywords.values_list('id', 'name_fi'):
             if preflabel is not None:
                 text = preflabel.lower()
                 self.name_to_keyword_ids.setdefault(text, set()).add(kid)
                 without_parenthesis = re.sub(ENDING_PARENTHESIS_PATTERN, '', text)
                 if without_parenthesis != text:
                     self.name_to_keyword_ids.setdefault(without_parenthesis, set()).add(kid)
-        self.labels = self.name_to_keyword_ids.keys()
-        print('Initialized', len(self.labels), 'keyword keys')
+
+        keyword_ids = set()
+        for ids in self.name_to_keyword_ids.values():
+            keyword_ids |= ids
+        self.keywords = Keyword.objects.filter(deprecated=False).in_bulk(list(keyword_ids))
+        # Labels left without usable keywords must not hide the looser
+        # matches of the other labels
+        for name, ids in list(self.name_to_keyword_ids.items()):
+            ids = set(kid for kid in ids if kid in self.keywords)
+            if ids:
+                self.name_to_keyword_ids[name] = ids
+            else:
+                del self.name_to_keyword_ids[name]
+        self.labels = sorted(self.name_to_keyword_ids.keys())
+
+    def labels_with_prefix(self, prefix):
+        labels = self.labels
+        matches = []
+        for i in range(bisect_left(labels, prefix), len(labels)):
+            if not labels[i].startswith(prefix):
+                break
+            matches.append(labels[i])
+        return matches
+
+    def find_labels(self, text):
+        """
+        Return the matching labels for a normalized text and the type of
+        the match, trying the match types from the strictest to the
+        loosest.
+        """
+        names = self.name_to_keyword_ids
+        if text in names:
+            return [text], 'exact'
+        words = WORD_SPLIT_PATTERN.split(text)
+        if len(words) > 1:
+            matches = [word for word in words if word in names]
+            if matches:
+                return matches, 'subword'
+        matches = self.labels_with_prefix(text)
+        if matches:
+            return matches, 'prefix'
+        if text + 't' in names:
+            return [text + 't'], 'simple-plural'
+        matches = self.labels_with_prefix(text[0:-2])
+        if matches:
+            return matches, 'cut-two-letters'
+        if len(text) > 10:
+            matches = self.labels_with_prefix(text[0:-5])
+            if matches:
+                return matches, 'prefix'
+        for i in range(1, 10):
+            if text[i:] in names:
+                return [text[i:]], 'suffix'
+        return [], None
 
     def match(self, text):
         if self.skip:
             return None
-        wordsplit = re.compile(r'\s+')
-        #labels = KeywordLabel.objects
-        #match = labels.filter(name__iexact=text)
 
         text = text.lower()
-        if text == 'kokous': text = 'kokoukset'
-        elif text == 'kuntoilu': text = 'kuntoliikunta'
-        elif text == 'samba': text = 'sambat'
+        text = TEXT_REPLACEMENTS.get(text, text)
+        if text not in self.results:
+            self.results[text] = self._match(text)
+        result = self.results[text]
+        if result is None:
+            return None
+        return list(result)
 
-        exact_match = lambda x: x.lower() == text
-        labels = self.labels
-        matches = [l for l in labels if exact_match(l)]
-        success = lambda: len(matches) > 0
-        if success():
-            match_type = 'exact'
-        if not success():
-            words = wordsplit.split(text)
-            if len(words) > 1:
-                for word in words:
-                    exact_match = lambda x: x.lower() == word
-                    matches.extend([l for l in labels if exact_match(l)])
-                    if success(): match_type = 'subword'
-        if not success():
-            matches = [l for l in labels if l.lower().startswith(text)]
-            match_type = 'prefix'
-        if not success():
-            matches = [l for l in labels if l.lower() == text + 't']
-            if success(): match_type = 'simple-plural'
-        if not success():
-            matches = [l for l in labels if l.lower().startswith(text[0:-2])]
-            if success(): match_type = 'cut-two-letters'
-        if not success():
-            if len(text) > 10:
-                matches = [l for l in labels if l.lower().startswith(text[0:-5])]
-            if success(): match_type = 'prefix'
-        if not success():
-            for i in range(1, 10):
-                matches = [l for l in labels if l.lower() == text[i:]]
-                if success():
-                    match_type = 'suffix'
-                    break
-
-        if not success():
+    def _match(self, text):
+        matches, match_type = self.find_labels(text)
+        if not matches:
             print('no match', text)
             return None
-        if success():
-            keyword_ids = set()
-            if match_type not in ['exact', 'subword']:
-                cmatch = get_close_matches(
-                    text, [m.lower() for m in matches], n=1)
-                if len(cmatch) == 1:
-                    keyword_ids = self.name_to_keyword_ids.get(cmatch[0])
 
-            else:
-                for m in matches:
-                    keyword_ids.update(self.name_to_keyword_ids[m])
-
-            if len(keyword_ids) < 1:
-                print('no matches for', text)
-                return None
-
-            objects = Keyword.objects.filter(id__in=keyword_ids)
-            if len(keyword_ids) > 1:
-                try:
-                    aggregate_keyword = objects.get(aggregate=True)
-                    aggregate_name = re.sub(ENDING_PARENTHESIS_PATTERN, '' , aggregate_keyword.name_fi)
-                    result = [aggregate_keyword]
-                    for o in objects.exclude(name_fi__istartswith=aggregate_name):
-                        result.append(o)
-                    return result
-                except Keyword.DoesNotExist:
-                    pass
-                return objects
-            return objects
+        keyword_ids = set()
+        if match_type not in ['exact', 'subword']:
+            cmatch = get_close_matches(text, matches, n=1)
+            if len(cmatch) == 1:
+                keyword_ids = self.name_to_keyword_ids.get(cmatch[0])
+        else:
+            for m in matches:
+                keyword_ids.update(self.name_to_keyword_ids[m])
+
+        if len(keyword_ids) < 1:
+            print('no matches for', text)
+            return None
+
+        objects = [self.keywords[kid] for kid in sorted(keyword_ids) if kid in self.keywords]
+        aggregates = [o for o in objects if o.aggregate]
+        if len(objects) > 1 and len(aggregates) == 1:
+            aggregate_keyword = aggregates[0]
+            aggregate_name = re.sub(ENDING_PARENTHESIS_PATTERN, '',
+                                    aggregate_keyword.name_fi or '').lower()
+            result = [aggregate_keyword]
+            for o in objects:
+                if not (o.name_fi or '').lower().startswith(aggregate_name):
+                    result.append(o)
+            return result
+        return objects
@@ -1,10 +1,13 @@
 import os
+import time
+from contextlib import ExitStack
 from optparse import make_option
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.utils.translation import activate, get_language
 
 from events.importer.base import get_importers
+from events.models import defer_event_usage_updates
 
 
 class Command(BaseCommand):
@@ -14,6 +17,11 @@ class Command(BaseCommand):
         make_option('--all', action='store_true', dest='all', help='Import all entities'),
         make_option('--cached', action='store_true', dest='cached', help='Cache requests (if possible)'),
         make_option('--single', action='store', dest='single', help='Import only single entity'),
+        make_option('--force', action='store_true', dest='force',
+                    help='Import sources even if they are unchanged since the last import'),
+        make_option('--no-delay', action='store_true', dest='no_delay',
+                    help='Update the event and place trees on every save instead of '
+                         'rebuilding the changed trees at the end'),
     ))
 
     importer_types = ['places', 'events', 'keywords']
@@ -40,7 +48,8 @@ class Command(BaseCommand):
         importer = imp_class({'data_path': os.path.join(root_dir, 'data'),
                               'verbosity': int(options['verbosity']),
                               'cached': options['cached'],
-                              'single': options['single']})
+                              'single': options['single'],
+                              'force': options['force']})
 
         # Activate the default language for the duration of the import
         # to make sure translated fields are populated correctly.
@@ -58,6 +67,22 @@ class Command(BaseCommand):
                     continue
 
             if method:
-                method()
+                started = time.time()
+                # Update keyword and place usage once per import
+                with defer_event_usage_updates(), ExitStack() as stack:
+                    if not options['no_delay']:
+                        # Rebuild the changed event and place trees at
+                        # the end
+                        stack.enter_context(importer.delay_tree_updates())
+                    method()
+                total_time = time.time() - started
+                print("%s done in %.1f s" % (name, total_time))
+                if options['no_delay']:
+                    print("  updating the trees on every save")
+                    continue
+                rebuild_time = importer.tree_rebuild_time
+                print("  importing, with per-save tree updates delayed: %.1f s" % (
+                    total_time - rebuild_time))
+                print("  rebuilding the changed trees once at the end: %.1f s" % rebuild_time)
 
         activate(old_lang)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+TEXT_SEARCH_CONFIGS = (
+    ('fi', 'finnish'),
+    ('sv', 'swedish'),
+    ('en', 'english'),
+)
+
+# Translated Event fields and their text search weights
+FIELD_WEIGHTS = (
+    ('name', 'A'),
+    ('headline', 'A'),
+    ('secondary_headline', 'A'),
+    ('short_description', 'B'),
+    ('description', 'C'),
+    ('info_url', 'D'),
+    ('location_extra_info', 'D'),
+    ('provider', 'D'),
+)
+
+
+def vector_expression(lang, config):
+    return ' || '.join(
+        "setweight(to_tsvector('pg_catalog.%s', coalesce(NEW.%s_%s, '')), '%s')" % (
+            config, field, lang, weight)
+        for field, weight in FIELD_WEIGHTS)
+
+
+source_columns = ', '.join(
+    '%s_%s' % (field, lang)
+    for field, _ in FIELD_WEIGHTS for lang, _ in TEXT_SEARCH_CONFIGS)
+
+forward_sql = []
+for lang, config in TEXT_SEARCH_CONFIGS:
+    forward_sql += [
+        'ALTER TABLE events_event ADD COLUMN search_vector_%s tsvector' % lang,
+        'CREATE INDEX events_event_search_vector_%s ON events_event '
+        'USING gin(search_vector_%s)' % (lang, lang),
+    ]
+forward_sql += [
+    """
+    CREATE FUNCTION events_event_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+    %s
+    RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """ % '\n'.join(
+        'NEW.search_vector_%s := %s;' % (lang, vector_expression(lang, config))
+        for lang, config in TEXT_SEARCH_CONFIGS),
+    'CREATE TRIGGER events_event_search_vector_trigger '
+    'BEFORE INSERT OR UPDATE OF %s ON events_event '
+    'FOR EACH ROW EXECUTE PROCEDURE events_event_search_vector_update()' % source_columns,
+    # Fill in the vectors of existing events
+    'UPDATE events_event SET name_fi = name_fi',
+]
+
+reverse_sql = [
+    'DROP TRIGGER events_event_search_vector_trigger ON events_event',
+    'DROP FUNCTION events_event_search_vector_update()',
+] + [
+    'ALTER TABLE events_event DROP COLUMN search_vector_%s' % lang
+    for lang, _ in TEXT_SEARCH_CONFIGS
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0009_auto_20151129_0934'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward_sql, reverse_sql),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0010_event_search_vectors'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='duration',
+            field=models.DurationField(db_index=True, null=True, verbose_name='Duration', blank=True),
+        ),
+        migrations.RunSQL(
+            'UPDATE events_event SET duration = end_time - start_time '
+            'WHERE start_time IS NOT NULL AND end_time IS NOT NULL',
+            migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+USAGE_SQL = """
+UPDATE events_{table} SET
+    event_count = s.event_count,
+    first_event_time = s.first_event_time,
+    last_event_time = s.last_event_time
+FROM (
+    SELECT {column} AS id, count(*) AS event_count,
+           min(e.start_time) AS first_event_time,
+           greatest(max(e.start_time), max(e.end_time)) AS last_event_time
+    FROM {source}
+    WHERE {column} IS NOT NULL
+    GROUP BY {column}
+) s
+WHERE events_{table}.id = s.id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0011_event_duration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keyword',
+            name='event_count',
+            field=models.IntegerField(default=0, db_index=True, verbose_name='Event count'),
+        ),
+        migrations.AddField(
+            model_name='keyword',
+            name='first_event_time',
+            field=models.DateTimeField(db_index=True, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='keyword',
+            name='last_event_time',
+            field=models.DateTimeField(db_index=True, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='place',
+            name='event_count',
+            field=models.IntegerField(default=0, db_index=True, verbose_name='Event count'),
+        ),
+        migrations.AddField(
+            model_name='place',
+            name='first_event_time',
+            field=models.DateTimeField(db_index=True, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='place',
+            name='last_event_time',
+            field=models.DateTimeField(db_index=True, null=True, blank=True),
+        ),
+        migrations.RunSQL([
+            USAGE_SQL.format(
+                table='keyword', column='ek.keyword_id',
+                source='events_event_keywords ek JOIN events_event e ON e.id = ek.event_id'),
+            USAGE_SQL.format(
+                table='place', column='e.location_id', source='events_event e'),
+        ], migrations.RunSQL.noop),
+    ]
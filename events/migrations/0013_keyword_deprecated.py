@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0012_event_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keyword',
+            name='deprecated',
+            field=models.BooleanField(default=False, db_index=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0014_event_import_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='place',
+            name='import_fingerprint',
+            field=models.CharField(max_length=64, null=True, editable=False, blank=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0015_place_import_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keyword',
+            name='usage_modified_time',
+            field=models.DateTimeField(db_index=True, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='place',
+            name='usage_modified_time',
+            field=models.DateTimeField(db_index=True, null=True, blank=True),
+        ),
+    ]
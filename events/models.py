@@ -18,6 +18,8 @@ schema_org_type can be used to define custom types. Override jsonld_context
 attribute to change @context when need to define schemas for custom fields.
 """
 import datetime
+import threading
+from contextlib import contextmanager
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.generic import GenericForeignKey
@@ -30,6 +32,10 @@ from django.contrib.contenttypes.models import ContentType
 from events import translation_utils
 from django.utils.encoding import python_2_unicode_compatible
 from django.contrib.postgres.fields import HStoreField
+from django.db import transaction
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_init, post_save, pre_delete)
+from django.dispatch import receiver
 
 
 User = settings.AUTH_USER_MODEL
@@ -41,6 +47,22 @@ class SchemalessFieldMixin(models.Model):
         abstract = True
 
 
+class EventUsageMixin(models.Model):
+    """
+    Denormalized statistics of the events referring to the object, so
+    that "in use" listings need not scan the events. Kept up to date
+    by update_event_usage(), which also sets usage_modified_time when
+    they change.
+    """
+    event_count = models.IntegerField(verbose_name=_('Event count'), default=0, db_index=True)
+    first_event_time = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_event_time = models.DateTimeField(null=True, blank=True, db_index=True)
+    usage_modified_time = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        abstract = True
+
+
 @python_2_unicode_compatible
 class DataSource(models.Model):
     id = models.CharField(max_length=100, primary_key=True)
@@ -130,9 +152,11 @@ class KeywordLabel(models.Model):
         unique_together = (('name', 'language'),)
 
 
-class Keyword(BaseModel):
+class Keyword(BaseModel, EventUsageMixin):
     alt_labels = models.ManyToManyField(KeywordLabel, blank=True, related_name='keywords')
     aggregate = models.BooleanField(default=False)
+    # Kept for the events using it when removed from the source vocabulary
+    deprecated = models.BooleanField(default=False, db_index=True)
     objects = models.Manager()
 
     schema_org_type = "Thing/LinkedEventKeyword"
@@ -145,7 +169,7 @@ class Keyword(BaseModel):
         verbose_name_plural = _('keywords')
 
 
-class Place(MPTTModel, BaseModel, SchemalessFieldMixin):
+class Place(MPTTModel, BaseModel, SchemalessFieldMixin, EventUsageMixin):
     publisher = models.ForeignKey(Organization, verbose_name=_('Publisher'), db_index=True)
     info_url = models.URLField(verbose_name=_('Place home page'), null=True)
     description = models.TextField(verbose_name=_('Description'), null=True, blank=True)
@@ -168,6 +192,10 @@ class Place(MPTTModel, BaseModel, SchemalessFieldMixin):
 
     deleted = models.BooleanField(verbose_name=_('Deleted'), default=False)
 
+    # Hash of the source record the place was last imported from, see
+    # Event.import_fingerprint.
+    import_fingerprint = models.CharField(max_length=64, null=True, blank=True, editable=False)
+
     geo_objects = models.GeoManager()
 
     class Meta:
@@ -250,6 +278,8 @@ class Event(MPTTModel, BaseModel, SchemalessFieldMixin):
 
     start_time = models.DateTimeField(verbose_name=_('Start time'), null=True, db_index=True, blank=True)
     end_time = models.DateTimeField(verbose_name=_('End time'), null=True, db_index=True, blank=True)
+    # end_time - start_time, stored for indexed duration filtering and sorting
+    duration = models.DurationField(verbose_name=_('Duration'), null=True, db_index=True, blank=True)
     has_start_time = models.BooleanField(default=True)
     has_end_time = models.BooleanField(default=True)
 
@@ -262,6 +292,15 @@ class Event(MPTTModel, BaseModel, SchemalessFieldMixin):
     keywords = models.ManyToManyField(Keyword)
     audience = models.CharField(verbose_name=_('Audience'), max_length=255, null=True, blank=True)
 
+    # Hash of the source record the event was last imported from (see
+    # events.importer.util.import_fingerprint). Cleared on manual edits
+    # so that the next import compares the fields again.
+    import_fingerprint = models.CharField(max_length=64, null=True, blank=True, editable=False)
+
+    # The table also has per-language search_vector_* columns for the
+    # text filter. They are not model fields; a database trigger keeps
+    # them in sync with the translated fields (see migration 0010).
+
     class Meta:
         verbose_name = _('event')
         verbose_name_plural = _('events')
@@ -273,8 +312,14 @@ class Event(MPTTModel, BaseModel, SchemalessFieldMixin):
         if not self.id:
             self.created_time = BaseModel.now()
         self.last_modified_time = BaseModel.now()
+        self.duration = self.calculate_duration()
         super(Event, self).save(*args, **kwargs)
 
+    def calculate_duration(self):
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
     def __str__(self):
         name = ''
         for lang in settings.LANGUAGES:
@@ -347,3 +392,123 @@ class EventAggregate(models.Model):
 class EventAggregateMember(models.Model):
     event_aggregate = models.ForeignKey(EventAggregate, related_name='members')
     event = models.OneToOneField(Event)
+
+
+# Event usage statistics of keywords and places
+
+_event_usage = threading.local()
+
+
+def update_event_usage(model, ids):
+    """
+    Recalculate the EventUsageMixin columns of the given Keyword or
+    Place ids from their events.
+    """
+    ids = set(ids)
+    ids.discard(None)
+    if not ids:
+        return
+    stats = model.objects.filter(id__in=ids)\
+        .values_list('id', 'event_count', 'first_event_time', 'last_event_time')\
+        .annotate(models.Count('event'), models.Min('event__start_time'),
+                  models.Max('event__start_time'), models.Max('event__end_time'))
+    now = BaseModel.now()
+    with transaction.atomic():
+        for row in stats:
+            count, first_start, last_start, last_end = row[4:]
+            times = [t for t in (last_start, last_end) if t is not None]
+            values = (count, first_start, max(times) if times else None)
+            if values == tuple(row[1:4]):
+                continue
+            model.objects.filter(id=row[0]).update(
+                event_count=values[0], first_event_time=values[1],
+                last_event_time=values[2], usage_modified_time=now)
+
+
+def mark_event_usage_changed(model, ids):
+    """
+    Update the event usage of the given objects now, or when the
+    enclosing defer_event_usage_updates() block exits.
+    """
+    pending = getattr(_event_usage, 'pending', None)
+    if pending is None:
+        update_event_usage(model, ids)
+    else:
+        pending.setdefault(model, set()).update(ids)
+
+
+@contextmanager
+def defer_event_usage_updates():
+    """
+    Collect the event usage changes made within the block and update
+    each affected keyword and place only once at the end. Used by the
+    importers, which touch the same keywords and places over and over.
+    """
+    if getattr(_event_usage, 'pending', None) is not None:
+        # The outermost block does the updating
+        yield
+        return
+    _event_usage.pending = {}
+    try:
+        yield
+    finally:
+        pending = _event_usage.pending
+        _event_usage.pending = None
+        for model, ids in pending.items():
+            update_event_usage(model, ids)
+
+
+def mark_sub_events_changed(super_event_ids):
+    """
+    Bump the last_modified_time of super events whose sub events were
+    added, moved or deleted, as their rendered sub_events change.
+    """
+    super_event_ids = set(super_event_ids) - set([None])
+    if super_event_ids:
+        Event.objects.filter(id__in=super_event_ids).update(last_modified_time=BaseModel.now())
+
+
+@receiver(post_init, sender=Event)
+def _remember_event_location(sender, instance, **kwargs):
+    instance._usage_location_id = instance.__dict__.get('location_id')
+    instance._tree_super_event_id = instance.__dict__.get('super_event_id')
+
+
+@receiver(post_save, sender=Event)
+def _event_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    mark_event_usage_changed(Place, [instance._usage_location_id, instance.location_id])
+    instance._usage_location_id = instance.location_id
+    if created or instance.super_event_id != instance._tree_super_event_id:
+        mark_sub_events_changed([instance._tree_super_event_id, instance.super_event_id])
+        instance._tree_super_event_id = instance.super_event_id
+    if not created:
+        # Changed times affect the usage of the existing keywords
+        mark_event_usage_changed(Keyword, instance.keywords.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=Event)
+def _event_deleting(sender, instance, **kwargs):
+    instance._usage_keyword_ids = list(instance.keywords.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Event)
+def _event_deleted(sender, instance, **kwargs):
+    mark_event_usage_changed(Place, [instance.location_id])
+    mark_event_usage_changed(Keyword, getattr(instance, '_usage_keyword_ids', []))
+    mark_sub_events_changed([instance.super_event_id])
+
+
+@receiver(m2m_changed, sender=Event.keywords.through)
+def _event_keywords_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # Events were added to or removed from a keyword
+        if action.startswith('post_'):
+            mark_event_usage_changed(Keyword, [instance.pk])
+    elif action == 'pre_clear':
+        instance._usage_keyword_ids = list(instance.keywords.values_list('id', flat=True))
+    elif action == 'post_clear':
+        mark_event_usage_changed(Keyword, instance._usage_keyword_ids)
+    elif action in ('post_add', 'post_remove'):
+        mark_event_usage_changed(Keyword, pk_set)
@@ -2,6 +2,7 @@
 
 # django
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.utils import timezone
 from rest_framework.reverse import reverse
 
@@ -29,6 +30,12 @@ def api_client():
     return APIClient()
 
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # Cached list counts must not leak from one test to another
+    cache.clear()
+
+
 @pytest.mark.django_db
 @pytest.fixture
 def data_source():
@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+import time
+from datetime import timedelta
+
+import pytest
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date
+from rest_framework import serializers
+
+from events import api
+from events.api import LinkedEventsSerializer
+from events.api_cache import SharedFragmentCache, get_fragment_cache
+from events.models import Event, Keyword, Offer, Place
+
+
+# === util methods ===
+
+def create_events(data_source, organization, count):
+    now = timezone.now()
+    events = []
+    for i in range(count):
+        events.append(Event.objects.create(
+            id='%s:event-%d' % (data_source.id, i),
+            name='event %d' % i,
+            data_source=data_source,
+            publisher=organization,
+            start_time=now + timedelta(days=i % 3),
+            end_time=now + timedelta(days=i % 3, hours=2),
+        ))
+    return events
+
+
+def get_list(api_client, url):
+    response = api_client.get(url, format='json')
+    assert response.status_code == 200, str(response.content)
+    return response
+
+
+# === tests ===
+
+@pytest.mark.django_db
+def test__cursor_pagination_walks_all_events(api_client, data_source,
+                                             organization):
+    events = create_events(data_source, organization, 7)
+    expected = [e.id for e in sorted(events, key=lambda e: (e.start_time, e.id))]
+
+    url = '/v0.1/event/?pagination=cursor&page_size=3'
+    seen = []
+    while url:
+        response = get_list(api_client, url)
+        assert response.data['meta']['count'] is None
+        assert len(response.data['data']) <= 3
+        seen += [e['id'] for e in response.data['data']]
+        url = response.data['meta']['next']
+
+    assert seen == expected
+
+
+@pytest.mark.django_db
+def test__cursor_pagination_rejects_unsupported_sort(api_client, data_source,
+                                                     organization):
+    create_events(data_source, organization, 1)
+    response = api_client.get('/v0.1/event/?pagination=cursor&sort=end_time',
+                              format='json')
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test__list_count_is_exact_by_default(api_client, data_source,
+                                         organization):
+    create_events(data_source, organization, 4)
+    response = get_list(api_client, '/v0.1/event/?page_size=2')
+    assert response.data['meta']['count'] == 4
+    assert response.data['meta']['count_is_exact'] is True
+
+
+@pytest.mark.django_db
+def test__small_list_count_is_exact_when_estimating(api_client, data_source,
+                                                    organization):
+    create_events(data_source, organization, 4)
+    response = get_list(api_client, '/v0.1/event/?count=estimate')
+    assert response.data['meta']['count'] == 4
+    assert response.data['meta']['count_is_exact'] is True
+
+
+@pytest.mark.django_db
+def test__estimated_and_exact_counts_are_cached_apart(api_client, data_source,
+                                                      organization, settings):
+    settings.PAGINATION_COUNT_ESTIMATE_THRESHOLD = 0
+    create_events(data_source, organization, 4)
+    response = get_list(api_client, '/v0.1/event/?count=estimate')
+    assert response.data['meta']['count_is_exact'] is False
+    response = get_list(api_client, '/v0.1/event/')
+    assert response.data['meta']['count'] == 4
+    assert response.data['meta']['count_is_exact'] is True
+
+
+@pytest.mark.django_db
+def test__text_filter_matches_word_prefixes(api_client, data_source,
+                                            organization):
+    events = create_events(data_source, organization, 3)
+    Event.objects.filter(id=events[1].id).update(
+        description_fi='Jazzkonsertti kirjastossa')
+
+    response = get_list(api_client, '/v0.1/event/?text=jazzkonsert')
+    assert [e['id'] for e in response.data['data']] == [events[1].id]
+
+
+@pytest.mark.django_db
+def test__duration_filters_use_event_duration(api_client, data_source,
+                                              organization):
+    short, long_ = create_events(data_source, organization, 2)
+    long_.end_time = long_.start_time + timedelta(days=3)
+    long_.save()
+
+    response = get_list(api_client, '/v0.1/event/?max_duration=1d')
+    assert [e['id'] for e in response.data['data']] == [short.id]
+    response = get_list(api_client, '/v0.1/event/?min_duration=1d')
+    assert [e['id'] for e in response.data['data']] == [long_.id]
+
+
+@pytest.mark.django_db
+def test__included_objects_reuse_serializer_fields(api_client, data_source,
+                                                   organization, place,
+                                                   monkeypatch):
+    keyword = Keyword.objects.create(id='test:kw', name='kw',
+                                     data_source=data_source)
+    for event in create_events(data_source, organization, 3):
+        event.location = place
+        event.save()
+        event.keywords.add(keyword)
+
+    url = '/v0.1/event/?include=location,keywords'
+    response = get_list(api_client, url)
+    for event in response.data['data']:
+        assert event['location']['id'] == place.id
+        assert [kw['id'] for kw in event['keywords']] == [keyword.id]
+
+    built = []
+    get_fields = serializers.ModelSerializer.get_fields
+
+    def counting_get_fields(self):
+        built.append(type(self))
+        return get_fields(self)
+    monkeypatch.setattr(serializers.ModelSerializer, 'get_fields',
+                        counting_get_fields)
+    assert get_list(api_client, url).data == response.data
+    assert not [cls for cls in built if issubclass(cls, LinkedEventsSerializer)]
+
+
+def create_linked_events(data_source, organization, place, count):
+    keyword = Keyword.objects.create(id='test:kw', name='kw',
+                                     data_source=data_source)
+    events = create_events(data_source, organization, count)
+    for i, event in enumerate(events):
+        event.location = place
+        event.description_en = 'description %d' % i
+        event.has_end_time = bool(i % 2)
+        if i:
+            event.super_event = events[0]
+        event.save()
+        event.keywords.add(keyword)
+        Offer.objects.create(event=event, price='%d e' % i, is_free=False)
+    return events
+
+
+@pytest.mark.django_db
+def test__fast_list_serializer_gives_same_output(api_client, data_source,
+                                                 organization, place,
+                                                 settings, monkeypatch):
+    events = create_linked_events(data_source, organization, place, 5)
+    # Related lists of several items come in the same order
+    for kw_id in ('test:z', 'test:a', 'test:m'):
+        events[1].keywords.add(Keyword.objects.create(id=kw_id, name=kw_id,
+                                                      data_source=data_source))
+    for price in ('3 e', '1 e'):
+        Offer.objects.create(event=events[1], price=price, is_free=False)
+    assert len(get_list(api_client, '/v0.1/event/%s/' % events[1].id).data['keywords']) == 4
+
+    used = []
+    serialize = api.FastEventListSerializer.serialize
+
+    def recording_serialize(self, rows):
+        used.append(self.supported)
+        return serialize(self, rows)
+    monkeypatch.setattr(api.FastEventListSerializer, 'serialize',
+                        recording_serialize)
+
+    for url in ('/v0.1/event/', '/v0.1/event/?sort=days_left',
+                '/v0.1/event/?pagination=cursor&page_size=2'):
+        settings.EVENT_LIST_FAST_SERIALIZER = False
+        expected = get_list(api_client, url).content
+        assert used == []
+        settings.EVENT_LIST_FAST_SERIALIZER = True
+        assert get_list(api_client, url).content == expected
+        # The fast path must not fall back to EventSerializer
+        assert used == [True]
+        del used[:]
+
+
+@pytest.mark.benchmark
+@pytest.mark.django_db
+def test__benchmark_fast_list_serializer(api_client, data_source,
+                                         organization, place, settings):
+    """
+    Report the event list throughput of both serializers. Run with
+    `py.test -m benchmark -s`.
+    """
+    create_linked_events(data_source, organization, place, 50)
+    url = '/v0.1/event/?page_size=50'
+
+    for fast in False, True:
+        settings.EVENT_LIST_FAST_SERIALIZER = fast
+        get_list(api_client, url)
+        rounds = 10
+        start = time.perf_counter()
+        for i in range(rounds):
+            get_list(api_client, url)
+        elapsed = time.perf_counter() - start
+        print('%s serializer: %.0f events/s' % ('fast' if fast else 'regular',
+                                                rounds * 50 / elapsed))
+
+
+@pytest.mark.django_db
+def test__list_resolves_each_view_url_once(api_client, data_source,
+                                           organization, place, monkeypatch):
+    create_linked_events(data_source, organization, place, 5)
+    expected = get_list(api_client, '/v0.1/event/').data
+
+    resolved = []
+    reverse = api.reverse
+
+    def counting_reverse(view_name, *args, **kwargs):
+        resolved.append(view_name)
+        return reverse(view_name, *args, **kwargs)
+    monkeypatch.setattr(api, 'reverse', counting_reverse)
+    assert get_list(api_client, '/v0.1/event/').data == expected
+    assert sorted(resolved) == ['event-detail', 'keyword-detail', 'place-detail']
+
+
+@pytest.mark.django_db
+def test__fragment_cache_serves_unchanged_events(api_client, data_source,
+                                                 organization, place,
+                                                 settings):
+    events = create_linked_events(data_source, organization, place, 5)
+    url = '/v0.1/event/?include=location'
+    expected = get_list(api_client, url).data
+
+    settings.EVENT_FRAGMENT_CACHE_BACKEND = 'events.api_cache.LocalFragmentCache'
+    get_fragment_cache().clear()
+    assert get_list(api_client, url).data == expected
+    with CaptureQueriesContext(connection) as queries:
+        assert get_list(api_client, url).data == expected
+    # Only the page keys and the versions of the places are queried
+    assert not [q for q in queries.captured_queries if 'events_offer' in q['sql']]
+
+    # Embedded objects are rendered again when they change
+    place.save()
+    data = get_list(api_client, url).data['data']
+    modified = set(e['location']['last_modified_time'] for e in data)
+    assert len(modified) == 1
+    assert modified.isdisjoint(e['location']['last_modified_time'] for e in expected['data'])
+
+    events[2].name = 'renamed'
+    events[2].save()
+    data = get_list(api_client, url).data['data']
+    assert [e['name']['fi'] for e in data if e['id'] == events[2].id] == ['renamed']
+    response = api_client.get('/v0.1/event/%s/' % events[2].id, format='json')
+    assert response.data['name']['fi'] == 'renamed'
+
+    # Events sorted by days_left are rendered with it, and only then
+    sorted_url = '/v0.1/event/?sort=days_left'
+    for i in range(2):
+        data = get_list(api_client, sorted_url).data['data']
+        assert all('days_left' in e for e in data)
+        data = get_list(api_client, '/v0.1/event/').data['data']
+        assert not [e for e in data if 'days_left' in e]
+
+
+def test__shared_fragment_cache_clears_only_fragments():
+    fragments = SharedFragmentCache()
+    fragments.set_many({'event': {'id': 'event'}})
+    cache.set('other', 'value')
+    assert fragments.get_many(['event', 'missing']) == {'event': {'id': 'event'}}
+
+    fragments.clear()
+    assert fragments.get_many(['event']) == {}
+    assert cache.get('other') == 'value'
+    fragments.set_many({'event': {'id': 'new'}})
+    assert fragments.get_many(['event']) == {'event': {'id': 'new'}}
+
+
+@pytest.mark.django_db
+def test__unchanged_event_list_is_not_modified(api_client, data_source,
+                                               organization):
+    events = create_events(data_source, organization, 3)
+    url = '/v0.1/event/'
+    etag = get_list(api_client, url)['ETag']
+
+    with CaptureQueriesContext(connection) as queries:
+        response = api_client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    # The latest modification time and the count
+    assert len(queries) == 1
+
+    events[0].delete()
+    response = api_client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response['ETag'] != etag
+
+    # Deletions do not move the latest modification time of a list
+    assert not response.has_header('Last-Modified')
+    headers = dict(HTTP_IF_MODIFIED_SINCE=http_date())
+    assert api_client.get(url, format='json', **headers).status_code == 200
+
+
+@pytest.mark.django_db
+def test__unchanged_event_is_not_modified(api_client, data_source,
+                                          organization):
+    event = create_events(data_source, organization, 1)[0]
+    url = '/v0.1/event/%s/' % event.id
+    response = api_client.get(url, format='json')
+    assert response.status_code == 200
+
+    headers = dict(HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+    assert api_client.get(url, format='json', **headers).status_code == 304
+    headers = dict(HTTP_IF_NONE_MATCH=response['ETag'])
+    assert api_client.get(url, format='json', **headers).status_code == 304
+
+    event.last_modified_time += timedelta(seconds=1)
+    Event.objects.filter(id=event.id).update(last_modified_time=event.last_modified_time)
+    assert api_client.get(url, format='json', **headers).status_code == 200
+
+
+@pytest.mark.django_db
+def test__sub_event_changes_modify_super_event(api_client, data_source,
+                                               organization, settings):
+    settings.EVENT_FRAGMENT_CACHE_BACKEND = 'events.api_cache.LocalFragmentCache'
+    parent, other, child = create_events(data_source, organization, 3)
+    parent_url, other_url = ['/v0.1/event/%s/' % e.id for e in (parent, other)]
+
+    def get_sub_events(url):
+        response = get_list(api_client, url)
+        return len(response.data['sub_events']), response['ETag']
+
+    def status(url, etag):
+        return api_client.get(url, format='json', HTTP_IF_NONE_MATCH=etag).status_code
+
+    count, parent_etag = get_sub_events(parent_url)
+    assert count == 0
+
+    child.super_event = parent
+    child.save()
+    assert status(parent_url, parent_etag) == 200
+    count, parent_etag = get_sub_events(parent_url)
+    assert count == 1
+
+    count, other_etag = get_sub_events(other_url)
+    child = Event.objects.get(id=child.id)
+    child.super_event = other
+    child.save()
+    assert status(parent_url, parent_etag) == 200
+    assert status(other_url, other_etag) == 200
+    assert get_sub_events(parent_url)[0] == 0
+    count, other_etag = get_sub_events(other_url)
+    assert count == 1
+
+    child.delete()
+    assert status(other_url, other_etag) == 200
+    assert get_sub_events(other_url)[0] == 0
+
+
+@pytest.mark.django_db
+def test__uncounted_event_lists_are_validated_by_content(api_client, data_source,
+                                                         organization, place):
+    create_linked_events(data_source, organization, place, 3)
+
+    for url in ('/v0.1/event/?include=location',
+                '/v0.1/event/?pagination=cursor'):
+        with CaptureQueriesContext(connection) as queries:
+            etag = get_list(api_client, url)['ETag']
+        assert not [q for q in queries.captured_queries if 'MAX(' in q['sql'].upper()]
+        response = api_client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+
+    # The embedded place changes without touching the events
+    etag = get_list(api_client, '/v0.1/event/?include=location')['ETag']
+    Place.objects.filter(id=place.id).update(event_count=42)
+    response = api_client.get('/v0.1/event/?include=location', format='json',
+                              HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
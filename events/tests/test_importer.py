@@ -0,0 +1,661 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+from concurrent.futures import Future
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import numpy
+import pytest
+import rdflib
+import requests
+from httmock import HTTMock, all_requests
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from events.importer import helmet, yso
+from events.importer.base import TM_PROJECTIONS, Importer, _project_tm, transform_positions
+from events.importer.fetch import Fetcher, Source
+from events.importer.kulke import KulkeImporter
+from events.importer.sync import BulkModelSyncher
+from events.importer.tprek import TprekImporter
+from events.keywords import KeywordMatcher
+from events.models import (
+    DataSource, Event, EventAggregate, EventAggregateMember, Keyword, KeywordLabel,
+    Language, Offer, Place
+)
+
+
+class DummyImporter(Importer):
+    name = 'dummy'
+    supported_languages = ['fi', 'sv']
+
+
+class PagingHelmetImporter(helmet.HelmetImporter):
+    # Skips loading the places and keywords
+    def setup(self):
+        pass
+
+
+class StubFetcher(object):
+    """
+    Serves canned JSON documents by URL, running the submitted calls
+    right away.
+    """
+    def __init__(self, documents):
+        self.documents = documents
+        self.fetched = []
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        future.set_result(func(*args, **kwargs))
+        return future
+
+    def get_source(self, url):
+        self.fetched.append(url)
+        content = json.dumps(self.documents[url]).encode('utf-8')
+        return Source(url, 200, content, str(len(self.fetched)))
+
+
+class CannedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class CannedHandler(BaseHTTPRequestHandler):
+    """
+    Answers with the next of the server's canned statuses, or 200, and
+    the requested path as the body, after the server's delay. Keeps
+    count of the requests in flight.
+    """
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.paths.append(self.path)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            status = server.statuses.pop(0) if server.statuses else 200
+        time.sleep(server.delay)
+        with server.lock:
+            server.in_flight -= 1
+        body = self.path.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LinkingKulkeImporter(KulkeImporter):
+    # Skips reading the category files
+    def setup(self):
+        self.data_source = DataSource.objects.create(id='kulke')
+        self.organization = self.options['organization']
+
+
+# === util methods ===
+
+def make_importer():
+    return DummyImporter({'verbosity': 0, 'cached': False, 'single': None})
+
+
+def event_info(data_source, organization, origin_id, **kwargs):
+    start = timezone.now().replace(microsecond=0)
+    info = {
+        'data_source': data_source,
+        'origin_id': origin_id,
+        'publisher': organization,
+        'name': {'fi': 'tapahtuma %s' % origin_id},
+        'start_time': start,
+        'end_time': start + timedelta(hours=2),
+    }
+    info.update(kwargs)
+    return info
+
+
+def helmet_page_url(next_link):
+    return '%s/api/opennc/v1/%s&$format=json' % (helmet.HELMET_BASE_URL, next_link)
+
+
+def helmet_page(days_ago, next_link=None):
+    # Noon is never ambiguous in local time
+    now = timezone.now().astimezone(helmet.LOCAL_TZ).replace(
+        tzinfo=None, hour=12, minute=0, second=0, microsecond=0)
+    page = {'value': [
+        {'EventEndDate': (now - timedelta(days=days)).isoformat()} for days in days_ago]}
+    if next_link:
+        page['odata.nextLink'] = next_link
+    return page
+
+
+# === fixtures ===
+
+@pytest.fixture
+def http_server(monkeypatch):
+    for name in ('http_proxy', 'HTTP_PROXY', 'all_proxy', 'ALL_PROXY'):
+        monkeypatch.delenv(name, raising=False)
+    server = CannedServer(('127.0.0.1', 0), CannedHandler)
+    server.lock = threading.Lock()
+    server.paths = []
+    server.statuses = []
+    server.delay = 0
+    server.in_flight = server.max_in_flight = 0
+    server.url = 'http://127.0.0.1:%d' % server.server_port
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+# === tests ===
+
+@pytest.mark.django_db
+def test__save_events_creates_and_updates_in_bulk(data_source, organization):
+    keyword = Keyword.objects.create(id='test:kw', name='kw',
+                                     data_source=data_source)
+    importer = make_importer()
+    infos = [event_info(data_source, organization, i, keywords=[keyword],
+                        offers=[{'is_free': True}])
+             for i in range(3)]
+    created = importer.save_events(infos)
+    assert all(e._created for e in created)
+    assert Event.objects.count() == 3
+    assert Offer.objects.count() == 3
+    assert Keyword.objects.get(id='test:kw').event_count == 3
+
+    infos[1]['name'] = {'fi': 'uusi nimi'}
+    infos[2]['keywords'] = []
+    results = importer.save_events(infos)
+    # The unchanged event is skipped by its import fingerprint
+    assert [e.origin_id for e in results] == ['1', '2']
+    assert all(e._changed for e in results)
+    assert Event.objects.get(origin_id='1').name_fi == 'uusi nimi'
+    assert Keyword.objects.get(id='test:kw').event_count == 2
+    assert Offer.objects.count() == 3
+
+    with CaptureQueriesContext(connection) as queries:
+        assert make_importer().save_events(infos) == []
+    # Only the fingerprints are loaded
+    selects = [q for q in queries if q['sql'].startswith('SELECT')]
+    assert len(selects) == 1
+    assert not [q for q in queries if q['sql'].startswith(('UPDATE', 'INSERT', 'DELETE'))]
+
+
+@pytest.mark.django_db
+def test__related_changes_refresh_cached_events(api_client, data_source,
+                                                organization, settings):
+    settings.EVENT_FRAGMENT_CACHE_BACKEND = 'events.api_cache.LocalFragmentCache'
+    keyword = Keyword.objects.create(id='test:kw', name='kw',
+                                     data_source=data_source)
+    importer = make_importer()
+    info = event_info(data_source, organization, 1,
+                      offers=[{'price': {'fi': '5 e'}}])
+    event = importer.save_events([info])[0]
+    url = '/v0.1/event/%s/' % event.id
+    response = api_client.get(url, format='json')
+    assert response.data['keywords'] == []
+    modified = response.data['last_modified_time']
+
+    info['keywords'] = [keyword]
+    info['offers'] = [{'price': {'fi': '10 e'}}]
+    importer.save_events([info])
+    response = api_client.get(url, format='json')
+    assert response.data['last_modified_time'] != modified
+    assert len(response.data['keywords']) == 1
+    assert [o['price']['fi'] for o in response.data['offers']] == ['10 e']
+
+
+@pytest.mark.django_db
+def test__bulk_syncher_loads_lazily_and_deletes_in_bulk(data_source, organization):
+    for i in range(6):
+        Place.objects.create(id='test:%d' % i, origin_id=str(i), data_source=data_source,
+                             publisher=organization, import_fingerprint='fp%d' % i)
+    syncher = BulkModelSyncher(Place.objects.filter(data_source=data_source), 'origin_id',
+                               fingerprint_field='import_fingerprint',
+                               delete_values={'deleted': True, 'import_fingerprint': None})
+    assert syncher.get_fingerprint('2') == 'fp2'
+    assert syncher.get('2').id == 'test:2'
+    assert sorted(syncher.get_many(['1', '3', 'missing']).keys()) == ['1', '3']
+
+    for i in range(5):
+        syncher.mark(str(i))
+    modified = Place.objects.get(id='test:5').last_modified_time
+    with CaptureQueriesContext(connection) as queries:
+        assert syncher.finish() == 1
+    assert len([q for q in queries if q['sql'].startswith('UPDATE')]) == 1
+    deleted = Place.objects.get(id='test:5')
+    assert deleted.deleted and deleted.import_fingerprint is None
+    assert deleted.last_modified_time > modified
+    assert Place.objects.filter(deleted=True).count() == 1
+
+    # Already deleted objects are left alone
+    Place.objects.filter(id='test:5').update(import_fingerprint='fp5')
+    assert syncher.finish() == 0
+    assert Place.objects.get(id='test:5').last_modified_time == deleted.last_modified_time
+
+
+def test__transform_positions_matches_gdal():
+    coords = [(24.9522, 60.1703), (25.0, 0), (151.2, -33.9), (22.2667, 60.4518)]
+    old = Point(24.9522, 60.1703, srid=4326)
+    old.transform(settings.PROJECTION_SRID)
+    old_positions = [Point(old.x + 0.05, old.y, srid=settings.PROJECTION_SRID), None, None, None]
+
+    positions, outside = transform_positions(coords, old_positions)
+    # Less than 10 cm away counts as the same position
+    assert positions[0] is old_positions[0]
+    assert positions[1] is None
+    assert positions[2] is None and outside == [2]
+
+    expected = Point(22.2667, 60.4518, srid=4326)
+    expected.transform(settings.PROJECTION_SRID)
+    assert positions[3].srid == settings.PROJECTION_SRID
+    assert positions[3].distance(expected) < 0.001
+
+
+def test__project_tm_matches_geos():
+    # Helsinki, Espoo, Vantaa and Porvoo
+    coords = [(24.9384, 60.1699), (24.6559, 60.2055), (25.0378, 60.2934),
+              (25.6651, 60.3932)]
+    lons = numpy.array([c[0] for c in coords])
+    lats = numpy.array([c[1] for c in coords])
+    for srid, projection in TM_PROJECTIONS.items():
+        xs, ys = _project_tm(lons, lats, projection)
+        for x, y, (lon, lat) in zip(xs, ys, coords):
+            expected = Point(lon, lat, srid=4326)
+            expected.transform(srid)
+            assert abs(x - expected.x) < 0.001 and abs(y - expected.y) < 0.001
+
+
+@pytest.mark.django_db
+def test__tprek_imports_units_in_batches():
+    units = [
+        {'id': 1, 'name_fi': 'Kirjasto', 'latitude': 60.17, 'longitude': 24.94},
+        {'id': 2, 'name_fi': 'Uimahalli', 'latitude': 60.19, 'longitude': 24.92},
+        {'id': 3, 'name_fi': 'Kaukana', 'latitude': -33.9, 'longitude': 151.2},
+    ]
+
+    @all_requests
+    def tprek_api(url, request):
+        return {'status_code': 200, 'content': json.dumps(units).encode('utf-8')}
+
+    importer = TprekImporter({'verbosity': 0, 'cached': False, 'single': None})
+    importer.fetcher = Fetcher()
+    with HTTMock(tprek_api):
+        importer.import_places()
+    places = Place.objects.filter(data_source='tprek').order_by('origin_id')
+    assert [p.name_fi for p in places] == ['Kirjasto', 'Uimahalli', 'Kaukana']
+    assert places[0].position.srid == settings.PROJECTION_SRID
+    assert places[2].position is None
+
+    units[1]['name_fi'] = 'Maauimala'
+    with HTTMock(tprek_api), CaptureQueriesContext(connection) as queries:
+        importer.import_places()
+    assert Place.objects.get(id='tprek:2').name_fi == 'Maauimala'
+    # Only the changed unit is written
+    assert len([q for q in queries if q['sql'].startswith('UPDATE')]) == 1
+
+
+@pytest.mark.django_db
+def test__kulke_links_recurring_events_in_bulk(organization):
+    importer = LinkingKulkeImporter({'verbosity': 0, 'cached': False, 'single': None,
+                                     'organization': organization})
+    now = timezone.now()
+    for i in range(1, 5):
+        Event.objects.create(id='kulke:%d' % i, name='event %d' % i, origin_id=str(i),
+                             data_source=importer.data_source, publisher=organization,
+                             start_time=now, end_time=now)
+    groups = {1: {1, 2, 3}, 2: {1, 2, 3}, 3: {1, 2, 3}, 4: {4}}
+
+    aggregates = importer._save_recurring_superevents(groups)
+    assert len(aggregates) == 1
+    super_event = aggregates.pop().super_event
+    assert super_event.is_recurring_super
+    assert sorted(e.id for e in super_event.get_children()) == ['kulke:1', 'kulke:2', 'kulke:3']
+    assert Event.objects.get(id='kulke:4').super_event is None
+
+    with CaptureQueriesContext(connection) as queries:
+        aggregates = importer._save_recurring_superevents(groups)
+    assert [a.super_event_id for a in aggregates] == [super_event.id]
+    assert EventAggregate.objects.count() == 1
+    assert not [q for q in queries if q['sql'].startswith(('UPDATE', 'INSERT'))]
+
+
+@pytest.mark.django_db
+def test__kulke_moved_events_refresh_cached_super_events(api_client, organization, settings):
+    settings.EVENT_FRAGMENT_CACHE_BACKEND = 'events.api_cache.LocalFragmentCache'
+    importer = LinkingKulkeImporter({'verbosity': 0, 'cached': False, 'single': None,
+                                     'organization': organization})
+    now = timezone.now()
+    for i in range(1, 5):
+        Event.objects.create(id='kulke:%d' % i, name='event %d' % i, origin_id=str(i),
+                             data_source=importer.data_source, publisher=organization,
+                             start_time=now, end_time=now)
+    aggregates = importer._save_recurring_superevents({1: {1, 2}, 3: {3, 4}})
+    first, second = sorted(aggregates, key=lambda a: a.id)
+    urls = ['/v0.1/event/%s/' % a.super_event_id for a in (first, second)]
+    before = [api_client.get(url, format='json').data for url in urls]
+    assert [len(data['sub_events']) for data in before] == [2, 2]
+
+    # Event 2 moves to the aggregate of events 3 and 4
+    EventAggregateMember.objects.filter(event_id='kulke:2').update(event_aggregate=second)
+    importer._save_recurring_superevents({2: {2, 3, 4}})
+    after = [api_client.get(url, format='json').data for url in urls]
+    assert [len(data['sub_events']) for data in after] == [1, 3]
+    for old, new in zip(before, after):
+        assert new['last_modified_time'] != old['last_modified_time']
+
+
+@pytest.mark.django_db
+def test__kulke_trees_are_rebuilt_when_delay_ends(organization):
+    importer = LinkingKulkeImporter({'verbosity': 0, 'cached': False, 'single': None,
+                                     'organization': organization})
+    now = timezone.now()
+    for i in range(1, 3):
+        Event.objects.create(id='kulke:%d' % i, name='event %d' % i, origin_id=str(i),
+                             data_source=importer.data_source, publisher=organization,
+                             start_time=now, end_time=now)
+
+    with importer.delay_tree_updates():
+        aggregate = importer._save_recurring_superevents({1: {1, 2}}).pop()
+        super_event = Event.objects.get(id=aggregate.super_event_id)
+        # The tree fields are stale until the delay ends
+        assert super_event.get_descendant_count() == 0
+    super_event = Event.objects.get(id=aggregate.super_event_id)
+    assert super_event.get_descendant_count() == 2
+    assert importer.tree_rebuild_time >= 0
+
+
+@pytest.mark.django_db
+def test__kulke_super_event_gets_common_values(organization):
+    importer = LinkingKulkeImporter({'verbosity': 0, 'cached': False, 'single': None,
+                                     'organization': organization})
+    common = Keyword.objects.create(id='test:common', name='common',
+                                    data_source=importer.data_source)
+    other = Keyword.objects.create(id='test:other', name='other',
+                                   data_source=importer.data_source)
+    start = timezone.now().replace(microsecond=0)
+    for i in range(1, 4):
+        event = Event.objects.create(
+            id='kulke:%d' % i, name='event %d' % i, origin_id=str(i),
+            data_source=importer.data_source, publisher=organization,
+            headline_fi='Sarja', audience='aikuiset' if i < 3 else 'lapset',
+            start_time=start + timedelta(days=i), end_time=start + timedelta(days=i, hours=2))
+        event.keywords.add(common, *([other] if i == 1 else []))
+        Offer.objects.create(event=event, is_free=True)
+    aggregate = importer._save_recurring_superevents({1: {1, 2, 3}}).pop()
+
+    importer._update_super_events([aggregate.super_event])
+    super_event = Event.objects.get(id=aggregate.super_event_id)
+    assert super_event.start_time == start + timedelta(days=1)
+    assert super_event.end_time == start + timedelta(days=3, hours=2)
+    assert super_event.name_fi == 'Sarja'
+    assert super_event.audience is None
+    assert list(super_event.keywords.all()) == [common]
+    assert [o.is_free for o in super_event.offers.all()] == [True]
+
+    # Running again with unchanged children changes nothing
+    with CaptureQueriesContext(connection) as queries:
+        importer._update_super_events([Event.objects.get(id=super_event.id)])
+    assert not [q for q in queries if q['sql'].startswith(('UPDATE', 'DELETE', 'INSERT'))]
+    assert Event.objects.get(id=super_event.id).last_modified_time == \
+        super_event.last_modified_time
+
+
+@pytest.mark.django_db
+def test__keyword_matcher_matches_without_queries(tmpdir):
+    yso = DataSource.objects.create(id='yso')
+    concerts = Keyword.objects.create(id='yso:p11185', name_fi='konsertit',
+                                      data_source=yso)
+    dance = Keyword.objects.create(id='yso:p1278', name_fi='tanssi (liikunta)',
+                                   data_source=yso)
+    matcher = KeywordMatcher(str(tmpdir.join('matcher.pickle')))
+
+    with CaptureQueriesContext(connection) as queries:
+        assert matcher.match('Konsertit') == [concerts]
+        assert matcher.match('konsertti') == [concerts]
+        assert matcher.match('tanssi') == [dance]
+        assert matcher.match('xyzzy') is None
+    assert len(queries) == 0
+
+
+@pytest.mark.django_db
+def test__keyword_matcher_skips_labels_of_deprecated_keywords(tmpdir):
+    yso = DataSource.objects.create(id='yso')
+    Language.objects.get_or_create(id='fi')
+    concerts = Keyword.objects.create(id='yso:p11185', name_fi='konsertit',
+                                      data_source=yso)
+    old = Keyword.objects.create(id='yso:p1', name_fi='vanha', data_source=yso,
+                                 deprecated=True)
+    old.alt_labels.add(KeywordLabel.objects.create(name='konsertti', language_id='fi'))
+
+    # The exact label belongs to a deprecated keyword only
+    matcher = KeywordMatcher(str(tmpdir.join('matcher.pickle')))
+    assert matcher.match('konsertti') == [concerts]
+
+
+@pytest.mark.django_db
+def test__keyword_matcher_snapshot_follows_keyword_edits(tmpdir):
+    path = str(tmpdir.join('matcher.pickle'))
+    yso = DataSource.objects.create(id='yso')
+    keyword = Keyword.objects.create(id='yso:p11185', name_fi='konsertit',
+                                     data_source=yso)
+    assert KeywordMatcher(path).match('konsertit') == [keyword]
+
+    with CaptureQueriesContext(connection) as queries:
+        matcher = KeywordMatcher(path)
+    assert len(queries) == 4
+    assert matcher.match('konsertit') == [keyword]
+
+    keyword.name_fi = 'jazz'
+    keyword.save()
+    matcher = KeywordMatcher(path)
+    assert matcher.match('konsertit') is None
+    assert matcher.match('jazz') == [Keyword.objects.get(id='yso:p11185')]
+
+
+@pytest.mark.django_db
+def test__keyword_matcher_snapshot_is_invalidated_on_label_renames(tmpdir):
+    path = str(tmpdir.join('matcher.pickle'))
+    yso = DataSource.objects.create(id='yso')
+    Language.objects.get_or_create(id='fi')
+    keyword = Keyword.objects.create(id='yso:p11185', name_fi='konsertit',
+                                     data_source=yso)
+    label = KeywordLabel.objects.create(name='keikat', language_id='fi')
+    keyword.alt_labels.add(label)
+    assert KeywordMatcher(path).match('keikat') == [keyword]
+
+    # Neither the label count nor the largest label id changes, so the
+    # snapshot is invalidated explicitly, like the YSO importer does
+    KeywordLabel.objects.filter(id=label.id).update(name='gigit')
+    assert KeywordMatcher(path).match('keikat') == [keyword]
+    KeywordMatcher.invalidate_snapshot(path)
+    matcher = KeywordMatcher(path)
+    assert matcher.match('keikat') is None
+    assert matcher.match('gigit') == [keyword]
+
+
+@pytest.mark.django_db
+def test__yso_sync_applies_only_differences(monkeypatch, data_source,
+                                            organization):
+    monkeypatch.setattr(yso.requests_cache, 'install_cache', lambda name: None)
+    monkeypatch.setattr(yso.KeywordMatcher, 'invalidate_snapshot', lambda: None)
+    importer = yso.YsoImporter({'verbosity': 0, 'cached': False, 'single': None})
+
+    def concept(name, labels=(), deprecated=False):
+        c = importer.new_concept()
+        c['names'] = {'fi': name}
+        c['alt_labels'] = set((label, 'fi') for label in labels)
+        c['deprecated'] = deprecated
+        return c
+
+    importer.save_keywords({
+        'yso:p1': concept('konsertit', ['konsertti']),
+        'yso:p2': concept('tanssi'),
+        'yso:p3': concept('vanha', deprecated=True),
+    })
+    assert sorted(Keyword.objects.values_list('id', flat=True)) == ['yso:p1', 'yso:p2']
+
+    event = Event.objects.create(id='test:event', name='event',
+                                 data_source=data_source, publisher=organization)
+    event.keywords.add('yso:p2')
+    modified = Keyword.objects.get(id='yso:p1').last_modified_time
+
+    importer.save_keywords({
+        'yso:p1': concept('konsertit', ['konsertti', 'keikka']),
+    })
+    assert Keyword.objects.get(id='yso:p2').deprecated
+    assert list(event.keywords.values_list('id', flat=True)) == ['yso:p2']
+    keyword = Keyword.objects.get(id='yso:p1')
+    labels = keyword.alt_labels.values_list('name', flat=True)
+    assert sorted(labels) == ['keikka', 'konsertti']
+    # Changed alt labels are changes of the keyword
+    assert keyword.last_modified_time > modified
+
+
+def test__yso_concept_store_keeps_only_concept_facts():
+    data = b"""
+<http://www.yso.fi/onto/yso/p1> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://www.w3.org/2004/02/skos/core#Concept> .
+<http://www.yso.fi/onto/yso/p1> <http://www.w3.org/2004/02/skos/core#prefLabel> "konsertit"@fi .
+<http://www.yso.fi/onto/yso/p1> <http://www.w3.org/2004/02/skos/core#altLabel> "konsertti"@se .
+<http://www.yso.fi/onto/yso/p1> <http://www.w3.org/2004/02/skos/core#inScheme> <http://www.yso.fi/onto/yso/aggregateconceptscheme> .
+<http://www.yso.fi/onto/yso/p2> <http://www.w3.org/2004/02/skos/core#prefLabel> "ei konsepti"@fi .
+"""
+    store = yso.ConceptStore()
+    rdflib.Graph(store=store).parse(data=data, format='nt')
+    concepts = store.get_concepts(lambda subject: subject.rsplit('/', 1)[-1])
+    assert concepts == {'p1': {
+        'names': {'fi': 'konsertit'},
+        'alt_labels': set([('konsertti', 'sv')]),
+        'aggregate': True,
+        'deprecated': False,
+    }}
+
+
+def test__fetcher_reports_unchanged_sources(tmpdir):
+    content = {'body': b'<rss/>'}
+    requests_seen = []
+
+    @all_requests
+    def feed(url, request):
+        requests_seen.append(request.headers.get('If-None-Match'))
+        etag = '"%d"' % len(content['body'])
+        if request.headers.get('If-None-Match') == etag:
+            return {'status_code': 304}
+        headers = {'ETag': etag} if content.get('etag', True) else {}
+        return {'status_code': 200, 'content': content['body'],
+                'headers': headers}
+
+    fetcher = Fetcher(cache_path=str(tmpdir))
+    url = 'http://example.com/feed'
+    with HTTMock(feed):
+        source = fetcher.get_source(url)
+        assert not source.unchanged
+        fetcher.mark_imported([source])
+
+        source = fetcher.get_source(url)
+        assert source.unchanged
+        assert source.content == b'<rss/>'
+
+        content['body'] = b'<rss></rss>'
+        assert not fetcher.get_source(url).unchanged
+
+        # Content served without an ETag drops the old one
+        content.update(body=b'<rss>  </rss>', etag=False)
+        fetcher.get_source(url)
+        source = fetcher.get_source(url)
+        assert source.content == b'<rss>  </rss>'
+
+    assert requests_seen == [None, '"6"', '"6"', '"11"', None]
+
+
+@pytest.mark.django_db
+def test__helmet_walks_pages_in_order_until_cutoff():
+    importer = PagingHelmetImporter({'verbosity': 0, 'cached': False, 'single': None})
+    first_url = 'http://example.com/events'
+    importer.fetcher = StubFetcher({
+        first_url: helmet_page([0, 1], 'page2'),
+        # Empty pages do not stop the walk
+        helmet_page_url('page2'): helmet_page([], 'page3'),
+        helmet_page_url('page3'): helmet_page([10, 100], 'page4'),
+        helmet_page_url('page4'): helmet_page([200]),
+    })
+    sources = []
+    pages = importer._iter_pages(importer.fetcher.submit(importer._fetch_page, first_url),
+                                 sources)
+
+    source, documents = next(pages)
+    assert source.url == first_url
+    assert len(documents) == 2
+    # The next page is fetched before the current one is consumed
+    assert importer.fetcher.fetched == [first_url, helmet_page_url('page2')]
+
+    rest = [(source.url, len(documents)) for source, documents in pages]
+    # The page with events older than 90 days is the last one
+    assert rest == [(helmet_page_url('page2'), 0), (helmet_page_url('page3'), 2)]
+    assert importer.fetcher.fetched == [first_url, helmet_page_url('page2'),
+                                        helmet_page_url('page3')]
+    assert [s.url for s in sources] == importer.fetcher.fetched
+    assert all(s.content is None for s in sources)
+
+
+def test__helmet_next_page_url_stops_at_last_page():
+    now = timezone.now()
+    assert helmet.HelmetImporter._next_page_url(helmet_page([1]), now) is None
+    assert helmet.HelmetImporter._next_page_url(helmet_page([], 'next'), now) == \
+        helmet_page_url('next')
+    assert helmet.HelmetImporter._next_page_url(helmet_page([91], 'next'), now) is None
+
+
+def test__fetcher_retries_server_errors(http_server):
+    fetcher = Fetcher(retries=2, backoff_factor=0)
+    http_server.statuses = [503]
+    assert fetcher.get(http_server.url + '/feed').content == b'/feed'
+    assert http_server.paths == ['/feed', '/feed']
+
+    # Gives up after the retries
+    http_server.statuses = [503, 503, 503]
+    with pytest.raises(requests.exceptions.RetryError):
+        fetcher.get(http_server.url + '/broken')
+    assert http_server.paths[2:] == ['/broken'] * 3
+    fetcher.close()
+
+
+def test__fetcher_limits_requests_per_host(http_server):
+    fetcher = Fetcher(max_workers=6, per_host=2)
+    http_server.delay = 0.05
+    urls = [http_server.url + '/page-%d' % i for i in range(6)]
+    # The results are in the order of the URLs
+    responses = fetcher.map(urls)
+    assert [r.content for r in responses] == [('/page-%d' % i).encode('utf-8') for i in range(6)]
+    assert http_server.max_in_flight == 2
+
+    sources = fetcher.get_sources(reversed(urls))
+    assert [s.content for s in sources] == [('/page-%d' % i).encode('utf-8')
+                                            for i in reversed(range(6))]
+    assert http_server.max_in_flight == 2
+    fetcher.close()
+
+
+def test__fetcher_streams_sources_to_cache(http_server, tmpdir):
+    fetcher = Fetcher(cache_path=str(tmpdir))
+    url = http_server.url + '/dump'
+    source = fetcher.get_source(url, stream=True)
+    assert source.content is None
+    with source.open() as f:
+        assert f.read() == b'/dump'
+    assert not source.unchanged
+    fetcher.mark_imported([source])
+
+    source = fetcher.get_source(url, stream=True)
+    assert source.unchanged
+    with source.open() as f:
+        assert f.read() == b'/dump'
+    fetcher.close()
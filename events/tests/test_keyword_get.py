@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from events.models import Event, Keyword, Place
+
+
+# === util methods ===
+
+def get_list(api_client, url):
+    response = api_client.get(url, format='json')
+    assert response.status_code == 200, str(response.content)
+    return response
+
+
+# === tests ===
+
+@pytest.mark.django_db
+def test__keyword_and_place_lists_use_event_usage(api_client, data_source,
+                                                  organization):
+    used = Keyword.objects.create(id='test:used', name='used',
+                                  data_source=data_source)
+    Keyword.objects.create(id='test:unused', name='unused',
+                           data_source=data_source)
+    place = Place.objects.create(id='test:place', name='place',
+                                 data_source=data_source,
+                                 publisher=organization)
+    now = timezone.now()
+    event = Event.objects.create(id='test:event', name='event',
+                                 data_source=data_source,
+                                 publisher=organization, location=place,
+                                 start_time=now, end_time=now + timedelta(hours=2))
+    event.keywords.add(used)
+
+    response = get_list(api_client, '/v0.1/keyword/')
+    assert [(k['id'], k['event_count']) for k in response.data['data']] == \
+        [('test:used', 1)]
+    response = get_list(api_client, '/v0.1/place/')
+    assert [(p['id'], p['event_count']) for p in response.data['data']] == \
+        [('test:place', 1)]
+
+    start = (now + timedelta(days=2)).strftime('%Y-%m-%d')
+    response = get_list(api_client, '/v0.1/keyword/?start=%s' % start)
+    assert response.data['data'] == []
+
+    event.delete()
+    assert Keyword.objects.get(id='test:used').event_count == 0
+    assert Place.objects.get(id='test:place').event_count == 0
+
+
+@pytest.mark.django_db
+def test__keyword_and_place_lists_filter_by_event_text(api_client, data_source,
+                                                       organization):
+    place = Place.objects.create(id='test:place', name='place',
+                                 data_source=data_source,
+                                 publisher=organization)
+    now = timezone.now()
+    for name in 'jazz', 'rock':
+        keyword = Keyword.objects.create(id='test:%s' % name, name=name,
+                                         data_source=data_source)
+        event = Event.objects.create(id='test:event-%s' % name,
+                                     name='%skonsertti' % name,
+                                     data_source=data_source,
+                                     publisher=organization,
+                                     location=place if name == 'jazz' else None,
+                                     start_time=now,
+                                     end_time=now + timedelta(hours=2))
+        event.keywords.add(keyword)
+
+    response = get_list(api_client, '/v0.1/keyword/?text=jazzkons')
+    assert [k['id'] for k in response.data['data']] == ['test:jazz']
+    response = get_list(api_client, '/v0.1/place/?text=jazzkons')
+    assert [p['id'] for p in response.data['data']] == ['test:place']
+    response = get_list(api_client, '/v0.1/place/?text=rockkons')
+    assert response.data['data'] == []
+
+
+@pytest.mark.django_db
+def test__keyword_list_etag_follows_event_usage(api_client, data_source,
+                                                organization):
+    first = Keyword.objects.create(id='test:first', name='first',
+                                   data_source=data_source)
+    second = Keyword.objects.create(id='test:second', name='second',
+                                    data_source=data_source)
+    now = timezone.now()
+    event = Event.objects.create(id='test:event', name='event',
+                                 data_source=data_source,
+                                 publisher=organization,
+                                 start_time=now, end_time=now + timedelta(hours=2))
+    event.keywords.add(first)
+
+    url = '/v0.1/keyword/?show_all_keywords=1'
+    etag = get_list(api_client, url)['ETag']
+    with CaptureQueriesContext(connection) as queries:
+        response = api_client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    # The latest modification times and the count
+    assert len(queries) == 1
+
+    # Moving the event keeps the count and the modification times of the
+    # keywords, but not their usage
+    event.keywords.remove(first)
+    event.keywords.add(second)
+    response = api_client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert [(k['id'], k['event_count']) for k in response.data['data']] == \
+        [('test:first', 0), ('test:second', 1)]
+
+    # The listing of used keywords changes too
+    url = '/v0.1/keyword/'
+    etag = get_list(api_client, url)['ETag']
+    event.keywords.remove(second)
+    event.keywords.add(first)
+    response = api_client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response['ETag'] != etag
+    assert [k['id'] for k in response.data['data']] == ['test:first']
@@ -115,6 +115,8 @@ LOCALE_PATHS = (
 )
 
 IMPORT_FILE_PATH = os.path.join(BASE_DIR, 'data')
+# Snapshots and other derived data the importers may rebuild at any time
+IMPORT_CACHE_PATH = os.path.join(IMPORT_FILE_PATH, 'cache')
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/1.6/howto/static-files/
@@ -155,6 +157,29 @@ REST_FRAMEWORK = {
 
 }
 
+# Total counts of paginated lists are cached for this many seconds,
+# keyed on the filter parameters. Set to 0 to count on every request.
+PAGINATION_COUNT_CACHE_TIMEOUT = 30
+# With ?count=estimate, results estimated to be at least this large
+# report the database planner estimate instead of an exact count.
+PAGINATION_COUNT_ESTIMATE_THRESHOLD = 10000
+
+# Serialize event list pages from plain database rows instead of model
+# instances and DRF fields. The output is the same; lists which include
+# related objects (?include=...) always use the regular serializer.
+EVENT_LIST_FAST_SERIALIZER = False
+
+# Rendered events are cached per event, last modification time and
+# request parameters. 'events.api_cache.LocalFragmentCache' keeps the
+# EVENT_FRAGMENT_CACHE_SIZE most recently used events in process memory,
+# 'events.api_cache.SharedFragmentCache' keeps them in the default
+# Django cache. Fragments expire after EVENT_FRAGMENT_CACHE_TIMEOUT
+# seconds, which bounds how long changes to included related objects
+# take to show. None disables the cache.
+EVENT_FRAGMENT_CACHE_BACKEND = None
+EVENT_FRAGMENT_CACHE_SIZE = 10000
+EVENT_FRAGMENT_CACHE_TIMEOUT = 3600
+
 CORS_ORIGIN_ALLOW_ALL = True
 
 TEMPLATE_DIRS = (